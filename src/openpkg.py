@@ -1,19 +1,86 @@
 #!/usr/bin/python
 
-import yaml
 import re
 import os
-import subprocess
-import ConfigParser
 import time
-import hashlib
 import sys
+import zlib
+import struct
+import collections
+import copy
+import StringIO
+import threading
+import stat
+import shutil
+import errno
+import fcntl
+import json
+import pwd
+import grp
+
+'''Modules that only some of the actions use are imported on first use, for commands like ls to start fast'''
+class LazyModule():
+    def __init__(self,module_name):
+        self.__dict__['_module_name']=module_name
+        self.__dict__['_module']=None
+
+    def __getattr__(self,attr):
+        if self._module is None:
+            __import__(self._module_name)
+            self.__dict__['_module']=sys.modules[self._module_name]
+
+        return getattr(self._module,attr)
+
+yaml=LazyModule('yaml')
+ConfigParser=LazyModule('ConfigParser')
+hashlib=LazyModule('hashlib')
+tarfile=LazyModule('tarfile')
+subprocess=LazyModule('subprocess')
+sqlite3=LazyModule('sqlite3')
+httplib=LazyModule('httplib')
+urlparse=LazyModule('urlparse')
+socket=LazyModule('socket')
+cProfile=LazyModule('cProfile')
+pstats=LazyModule('pstats')
+bz2=LazyModule('bz2')
+signal=LazyModule('signal')
+traceback=LazyModule('traceback')
+ctypes=LazyModule('ctypes')
 
 '''This file will be looked up under OPKG_DIR/conf'''
 OPKG_CONF_FILE='/etc/opkg/conf/opkg.env'
 
 META_FILE_PREVIOUS='Previous.meta'
 META_FILE_LATEST='Latest.meta'
+INSTALL_DB_FILE='installs.db'
+DEPLOY_PROFILE_FILE='deploy_profile.log'
+HOOK_LOG_DIR='hooks'
+RUNTIME_ACTIONS=['start','stop','restart','reload']
+READY_TIMEOUT=60 #seconds a package is waited on to be ready after start or reload, unless set with ready_timeout in its manifest
+READY_INTERVAL=0.1 #first wait before the ready probes of a package are run again, doubled after each attempt
+READY_MAX_INTERVAL=5
+CURRENT_DIR='current'
+FILES_MANIFEST_EXT='.files'
+COMPILED_MANIFEST_EXT='.json'
+TARBALL_INFO_EXT='.info'
+TARBALL_USED_EXT='.used'
+ARCHIVE_MTIME=315532800 #1980-01-01, the mtime of the members of the tarballs, unless SOURCE_DATE_EPOCH is set
+DIGEST_CACHE_FILE='digests.cache'
+DEFAULT_DIGEST_ALGO='md5'
+DIGEST_ALGOS=['md5','sha1','sha224','sha256','sha384','sha512'] #those hashlib provides on every host
+OBJECT_STORE_DIR='objects'
+OBJECT_STORE_MODES=['reflink','hardlink','off']
+DEFAULT_OBJECT_STORE='reflink'
+OBJECT_STORE_LOCK='.lock'
+OBJECT_REFS_DIR='refs'
+DEFAULT_PKGS_CACHE_SIZE='1G'
+DEFAULT_CLEAN_COUNT=2
+REPO_INDEX_FILE='index.json'
+REPO_LOCK_FILE='index.lock'
+LOCAL_REPO_TYPES=['local','fs','nfs']
+HTTP_REPO_TYPES=['http','https','s3']
+HOST_NAME=os.uname()[1]
+CPU_COUNT=os.sysconf('SC_NPROCESSORS_ONLN')
 EXTRA_PARAM_DELIM=','
 EXTRA_PARAM_KEY_VAL_SEP='='
 
@@ -48,14 +115,25 @@ class EnvConfig():
 '''Class to read opkg manifest '''
 class Manifest():
 
-    def __init__(self, manifest_path):
+    '''The manifest is loaded from manifest_path, or from content if given, like that read from a tarball.
+    A manifest compiled to JSON by create, with a .json extension, is loaded without parsing YAML.
+    '''
+    def __init__(self, manifest_path, content=None):
         self.manifest_file=manifest_path
         self.manifest_dict=None
         self.rel_num=None
 
-        with open(self.manifest_file, 'r') as stream:
+        if content is None: content=loadFile(self.manifest_file)
+        if self.manifest_file.endswith(COMPILED_MANIFEST_EXT):
+            try:
+                self.manifest_dict=encodeStrings(json.loads(content))
+            except ValueError as exc:
+                print "Error: Problem loading manifest file "+self.manifest_file
+                print(exc)
+                return
+        else:
             try:
-                self.manifest_dict=yaml.load(stream)
+                self.manifest_dict=yaml.load(content,Loader=getattr(yaml,'CSafeLoader',yaml.SafeLoader))
             except yaml.YAMLError as exc:
                 print "Error: Problem loading manifest file "+self.manifest_file
                 print(exc)
@@ -71,11 +149,19 @@ class Manifest():
     def getConfig(self):
         return self.manifest_dict
 
+    '''Resolves the vars in the values and keys of the parsed manifest, so it's not written out and parsed again'''
+    def resolveVars(self,vars_dict):
+        self.manifest_dict=Tmpl.renderObject(self.manifest_dict,vars_dict)
+        self.rel_num=self.manifest_dict['rel_num']
+
+    def getCompiled(self):
+        return json.dumps(self.manifest_dict,sort_keys=True,default=str)
+
     '''The action lines are available as dictionaries and converting those to a list is easier to deal with down the road.
     It could be a mixed-bag, plain list item or a dict element.
     '''
     def getSectionItems(self, section):
-        if section not in self.manifest_dict: return None
+        if not self.manifest_dict.get(section): return None
         lines = list()
         for item in self.manifest_dict[section]:
             if type(item) is str:
@@ -91,6 +177,50 @@ class Manifest():
 
         return lines
 
+    '''Returns the steps of a hook section like pre_deploy and post_deploy, as a list of the groups of HookStep run one after the other.
+    A step is a command, or a dict with the command in cmd and its timeout in seconds, hook_timeout of the manifest or
+    default_timeout by default. A dict with the list of steps in parallel is a group of steps run concurrently.
+    Returns None if a step is not in any of those formats.
+    '''
+    def getHookSteps(self, section, default_timeout=None):
+        timeout=self.manifest_dict.get('hook_timeout',default_timeout)
+        groups=list()
+        for item in self.manifest_dict.get(section) or []:
+            items=[item]
+            if type(item) is dict and 'parallel' in item: items=item['parallel'] or []
+            group=list()
+            for step in items:
+                if type(step) is str:
+                    group.append(HookStep(step,timeout))
+                elif type(step) is dict and 'cmd' in step:
+                    group.append(HookStep(str(step['cmd']),step.get('timeout',timeout)))
+                elif type(step) is dict and len(step) == 1:
+                    '''A command with ": " in it is parsed as a dict'''
+                    key,val=step.items()[0]
+                    group.append(HookStep(str(key)+':'+str(val),timeout))
+                else:
+                    print "Error: Unknown format in "+self.manifest_file+", section: "+section
+                    return None
+            for step in group:
+                try:
+                    step.timeout=float(step.timeout) if step.timeout else None
+                except ValueError:
+                    print "Error: Invalid timeout "+str(step.timeout)+" in "+self.manifest_file+", section: "+section
+                    return None
+            if group: groups.append(group)
+
+        return groups
+
+    '''Returns names of the packages listed in a section like depends and conflicts.
+    An entry is a package name, optionally followed by release number info separated by space.
+    '''
+    def getPkgNames(self, section):
+        names = list()
+        for item in self.manifest_dict.get(section) or list():
+            names.append(str(item).split()[0])
+
+        return names
+
 '''Class for core Open Pkg'''
 class Pkg():
     def __init__(self,name):
@@ -102,34 +232,41 @@ class Pkg():
         self.rel_ts=None
         self.is_release=False
         self.manifest_file = name + '.yml'
+        self.files_manifest_file = name + FILES_MANIFEST_EXT
+        self.compiled_manifest_file = name + COMPILED_MANIFEST_EXT
         self.tarball_name = name + '.tgz'
-        self.md5=None #md5 of package being installed.
+        self.pkg_digest=None #digest of package being installed.
+        self.digest_algo=DEFAULT_DIGEST_ALGO
+        self.digest_cache=None
         self.manifest=None
         self.build_root = os.getcwd()
         self.manifest_path=self.build_root+'/'+self.manifest_file
-
-        '''stage_dir - where files to create a tarball are staged and
-        files from a tarball are extracted for deployment.
-        By default, the stage_dir is set for action create pkg.
-        '''
-        self.stage_dir = self.build_root + '/.pkg/' + name
-        self.deploy_dir=self.stage_dir+'/.deploy'
+        self.jobs=1 #threads used to compress the archive in create.
+        self.codec_spec=None #codec[:level] to compress the archive with in create, overriding codec in the manifest.
+        self.fingerprint_mode='stat' #stat or content, how the files are fingerprinted to find if create has to build again.
+        self.force=False #create builds the tarball even if its inputs are unchanged.
 
         self.env_conf=None
         self.install_meta=None #meta data of existing installation
-        self.install_md5=None #md5 of currently installed version
+        self.install_digest=None #digest of currently installed version
+        self.files_manifest_path=None #per-file manifest of package being installed.
+        self.deploy_ts=None #deploy_ts of the installation, set when it's prepared by an earlier deploy.
+        self.vars=dict() #extra-vars and OPKG_ vars of this installation
 
     @staticmethod
     def parseName(pkg_label):
         '''pkg can be specified in following ways:
         - /path/to/mypkg.tgz -- tarball available on locally
         - /path/to/mypkg-rel_num.tgz -- tarball available on locally
+        - the tarball can have the extension of any of the codecs, like .txz, instead of .tgz
         - mypkg
         - mypkg-rel_num
         '''
         pkg_name_rel_num = os.path.basename(pkg_label)
-        pkg_name_rel_num = pkg_name_rel_num.replace('.tgz', '')
-        tarball_name = pkg_name_rel_num + '.tgz'
+        ext = Codec.getTarballExt(pkg_name_rel_num)
+        if ext: pkg_name_rel_num = pkg_name_rel_num[:-len(ext)]
+        else: ext = Codec.CODECS[Codec.DEFAULT]['ext']
+        tarball_name = pkg_name_rel_num + ext
         pkg_name = re.split('-', pkg_name_rel_num)[0]
 
         return pkg_name,pkg_name_rel_num,tarball_name
@@ -138,11 +275,14 @@ class Pkg():
     def parseTarballName(tarball_name):
         rel_num, rel_ts = 'dev', None
         '''The dev version will not have any rel_num or rel_ts
-        The parsing is based on the assumption that the tarball names can have only 2 formats:
+        The parsing is based on the assumption that the tarball names can have only 3 formats:
          name.tgz - dev
+         name-rel_num.tgz - release, as created by opkg create --release
          name-rel_num-rel_ts.tgz - release
+        with .tgz being any of the extensions of the codecs.
         '''
-        m = re.search('.+?-(.+?)-(.+).tgz', tarball_name)
+        exts='|'.join(re.escape(ext) for ext in Codec.getTarballExts())
+        m = re.search('^[^-]+-([^-]+?)(?:-(.+))?(?:'+exts+')$', os.path.basename(tarball_name))
         if m:
             rel_num = m.group(1)
             rel_ts = m.group(2)
@@ -159,25 +299,24 @@ class Pkg():
     def setRelTs(self,rel_ts):
         self.rel_ts=rel_ts
 
-    '''Meta file has this syntax: pkg_name,rel_num,rel_ts,pkg_md5,deploy_ts'''
+    '''Loads the latest and previous installations of the package at install_root from the install db'''
     def loadMeta(self):
         self.install_meta=dict()
-        meta_dir=self.env_conf['basic']['opkg_dir'] + '/meta/' + self.name
-        meta_path = meta_dir + "/" + META_FILE_LATEST
-        self.install_meta['latest_install']=self.loadMetaFile(meta_path)
+        install_db=InstallDB.getInstance(self.env_conf)
+        latest,previous=install_db.getInstalls(self.name,self.env_conf['basic']['install_root'])
+        self.install_meta['latest_install']=latest
         if not self.install_meta['latest_install']:
             print "Info: No active installation of "+self.name+" found at "+self.env_conf['basic']['opkg_dir']
-        meta_path = meta_dir + "/" + META_FILE_PREVIOUS
-        self.install_meta['previous_install'] = self.loadMetaFile(meta_path)
+        self.install_meta['previous_install'] = previous
         if not self.install_meta['previous_install']:
             print "Info: No previous installation of "+self.name+" found."
         if self.install_meta['latest_install']:
-            self.install_md5 = self.install_meta['latest_install']['pkg_md5']
+            self.install_digest = self.install_meta['latest_install']['pkg_digest']
 
     def getMeta(self):
         return self.install_meta
 
-    '''Load .meta files that keep track of deployments and verifies the data in those.
+    '''Load .meta files that kept track of deployments before the install db, and verifies the data in those.
     The meta data on package deployment is a single line with attrs delimited by , in the following order:
     pkg_name,pkg_rel_num,pkg_ts,pkg_md5,deploy_ts
     '''
@@ -190,144 +329,398 @@ class Pkg():
         meta['pkg_name']=install_info[0]
         meta['pkg_rel_num'] = install_info[1]
         meta['pkg_ts'] = install_info[2]
-        meta['pkg_md5'] = install_info[3]
+        meta['pkg_digest'] = install_info[3]
         meta['deploy_ts'] = install_info[4]
+        meta['digest_algo'] = 'md5'
 
         return meta
 
-    '''Reset install meta files upon successful installation of a package.'''
+    '''Records the installation in the install db, along with its per-file manifest, in a single transaction'''
     def registerInstall(self,deploy_inst):
-        meta_dir=deploy_inst.opkg_dir + "/meta/" + self.name
-        meta_file_previous = meta_dir + "/" + META_FILE_PREVIOUS
-        meta_file_latest = meta_dir + "/" + META_FILE_LATEST
-        runCmd("mkdir -p "+meta_dir)
-
-        if os.path.exists(meta_file_latest):
-            if not execOSCommand("mv -f " + meta_file_latest + " " + meta_file_previous):
-                print "Problem moving " + meta_file_latest + " as " + meta_file_previous
-                return False
+        files=None
+        if self.files_manifest_path and os.path.exists(self.files_manifest_path): files=loadFile(self.files_manifest_path)
 
-        '''Meta file has this syntax: pkg_name,rel_num,rel_ts,pkg_md5,deploy_dir'''
         rel_num=''
         if self.rel_num: rel_num=self.rel_num
         rel_ts=0
         if self.rel_ts: rel_ts=self.rel_ts
-        strx = self.name+','+rel_num+','+str(rel_ts)+','+self.pkg_md5+','+deploy_inst.deploy_ts
-        cmd = "echo " + strx + ">" + meta_file_latest
-        if not execOSCommand(cmd):
+        install={'pkg_name':self.name,'pkg_rel_num':rel_num,'pkg_ts':str(rel_ts),'pkg_digest':self.pkg_digest,
+                 'deploy_ts':self.deploy_ts or deploy_inst.deploy_ts,'digest_algo':self.digest_algo,
+                 'manifest':self.manifest.getCompiled() if self.manifest else None,'files':files}
+        if not InstallDB.getInstance(deploy_inst.env_conf).addInstall(install,deploy_inst.install_root):
             print "Error: Couldn't record the package installation."
             return False
         self.loadMeta()
 
         return True
 
+    def setVars(self,vars_dict):
+        self.vars=vars_dict
+
+    '''Reads the manifest from a package tarball without extracting it, from the info of the tarball'''
+    @staticmethod
+    def readManifest(pkg_name,tarball_path,digest_cache=None):
+        info=Pkg.readInfo(pkg_name,tarball_path,digest_cache)
+        if not info: return None
+
+        return Manifest(tarball_path+':'+info['manifest_name'],info['manifest'])
+
+    '''Returns the info of a package tarball, its manifest, codec and the files in it as in the per-file manifest.
+    Those are read from the sidecar index written by create next to the tarball, if it's of the tarball,
+    or else from the head of the tarball, where the manifests are, so the payload is not read either way.
+    '''
+    @staticmethod
+    def readInfo(pkg_name,tarball_path,digest_cache=None):
+        info=Pkg.loadSidecar(tarball_path,digest_cache)
+        if info: return info
+
+        return Pkg.readArchiveHead(pkg_name,tarball_path)
+
+    '''Prints the info of a tarball, with the files in it if files is set'''
+    @staticmethod
+    def printInfo(info,files=False):
+        manifest=Manifest(info['manifest_name'],info['manifest'])
+        if not manifest.getConfig(): return False
+        print "name: "+info['pkg_name']
+        print "rel_num: "+str(manifest.rel_num)
+        print "codec: "+info['codec']
+        print "size: "+str(info['size'])
+        if info['digest']: print "digest: "+info['digest_algo']+':'+info['digest']
+        print "depends: "+', '.join(manifest.getPkgNames('depends'))
+        print "conflicts: "+', '.join(manifest.getPkgNames('conflicts'))
+        if info['files'] is not None:
+            print "files: "+str(len(info['files']))+", "+str(sum(f[2] for f in info['files'].values()))+" bytes"
+        print "source: "+info['source']
+        if files and info['files']:
+            for path in sorted(info['files']):
+                digest,mode,size=info['files'][path]
+                print oct(mode)+'\t'+str(size)+'\t'+digest+'\t'+path
+
+        return True
+
+    '''Loads the sidecar index of the tarball, None if there is none or it is of another tarball, like one left from an earlier build'''
+    @staticmethod
+    def loadSidecar(tarball_path,digest_cache=None):
+        info_path=tarball_path+TARBALL_INFO_EXT
+        if not os.path.isfile(info_path): return None
+        try:
+            info=encodeStrings(json.loads(loadFile(info_path)))
+            if info.get('size') != os.path.getsize(tarball_path): return None
+        except (EnvironmentError,ValueError):
+            return None
+        if digest_cache and digest_cache.lookup(tarball_path,info['digest_algo']) not in (None,info['digest']): return None
+        info['source']='sidecar'
+
+        return info
+
+    '''Reads the manifest and the per-file manifest from the head of the tarball.
+    Those are the first members in the tarballs created by opkg, followed by the payload, which is not read.
+    The manifest is the compiled one, or the YAML one in tarballs created before those were added.
+    '''
+    @staticmethod
+    def readArchiveHead(pkg_name,tarball_path):
+        manifest_names=['.deploy/'+pkg_name+COMPILED_MANIFEST_EXT,'.deploy/'+pkg_name+'.yml']
+        files_name='.deploy/'+pkg_name+FILES_MANIFEST_EXT
+        info={'pkg_name':pkg_name,'manifest':None,'files_algo':None,'files':None,'digest':None,'digest_algo':None,'source':'archive'}
+        try:
+            info['size']=os.path.getsize(tarball_path)
+            codec,f=Codec.openTarball(tarball_path)
+            with f:
+                info['codec']=codec.name
+                tar=codec.openTar(f)
+                for member in tar:
+                    name=os.path.normpath(member.name)
+                    if name in manifest_names and not info['manifest']:
+                        info['manifest_name']=name
+                        info['manifest']=tar.extractfile(member).read()
+                    elif name == files_name:
+                        info['files_algo'],info['files']=Pkg.parseFilesManifest(tar.extractfile(member).read())
+                    elif info['manifest'] and name != '.deploy' and not name.startswith('.deploy/'):
+                        break
+                    if info['manifest'] and info['files'] is not None: break
+                tar.close()
+                codec.close()
+        except (IOError,OSError,tarfile.TarError) as e:
+            print(e)
+        if not info['manifest']:
+            print "Error: Package manifest is not found in "+tarball_path
+            return None
+
+        return info
+
     def setRelease(self,is_release=True):
         self.is_release=is_release
 
     def setEnvConfig(self,env_conf):
         self.env_conf=env_conf
+        self.digest_algo=env_conf['basic'].get('digest_algo',DEFAULT_DIGEST_ALGO)
+        self.digest_cache=DigestCache.getInstance(env_conf['basic']['opkg_dir']+'/meta/'+DIGEST_CACHE_FILE)
+
+    def setJobs(self,jobs):
+        self.jobs=jobs
+
+    '''Sets the directory the manifest and the relative paths of the files: entries are in, the working directory by default'''
+    def setBuildRoot(self,build_root):
+        self.build_root=os.path.abspath(build_root)
+        self.manifest_path=self.build_root+'/'+self.manifest_file
 
+    def setCodec(self,codec_spec):
+        self.codec_spec=codec_spec
+
+    def setFingerprintMode(self,fingerprint_mode):
+        self.fingerprint_mode=fingerprint_mode
+
+    def setForce(self,force=True):
+        self.force=force
+
+    '''Build the package tarball by streaming the manifest and the files: entries straight from build_root
+    into the archive, no staging copy is made. Compression runs on self.jobs threads, with the codec
+    set by --codec or in the manifest, gzip by default, and the tarball is named with the extension of the codec.
+    The inputs are fingerprinted first, and the tarball is not built again if they are the same as for the last build,
+    recorded in its sidecar index. The archive is reproducible, so the same inputs give a tarball with the same digest.
+    '''
     def create(self):
         self.loadManifest() #the default manifest points to that in build dir
+        if not self.manifest.getConfig(): return False
+        codec=Codec.parse(self.codec_spec or self.manifest.getConfig().get('codec') or Codec.DEFAULT)
+        if not codec: return False
 
-        runCmd("mkdir -p " + self.stage_dir)
-        os.chdir(self.stage_dir)
-        runCmd("rm -rf *")
-
-        '''Copy manifest to the deploy folder in archive'''
-        runCmd('mkdir -p ' + self.deploy_dir)
-        if not execOSCommand('cp ' + self.manifest_path + ' ' + self.deploy_dir + '/'):
-            print "Error: Problem copying package manifest."
-            return False
+        self.tarball_name = self.name + codec.ext
+        if self.is_release:
+            rel_num=self.manifest.rel_num
+            self.tarball_name = self.name + '-' + str(rel_num) + codec.ext
+        tarball_path=self.build_root+'/'+self.tarball_name
+        tmp_path=tarball_path+'.tmp'
 
-        '''Stage files content for archiving'''
+        '''Resolve the files: entries up front so a missing source fails before the archive is started'''
+        contents=list()
         content_lines=self.manifest.getSectionItems('files')
         if content_lines:
             for content_line in content_lines:
                 tgt,src=re.split(':',content_line)
-                if not self.stageContent(self.build_root+'/'+src,tgt):
-                    print "Error: Cannot copy content at "+src+" for archiving."
+                src_path=src
+                if not re.match("^\/", src): src_path=self.build_root+'/'+src
+                if not os.path.exists(src_path) and not os.path.islink(src_path):
+                    print "Error: Cannot find content at "+src+" for archiving."
                     return False
+                contents.append((src_path,tgt))
 
-        '''Make tarball and clean up the staging area'''
-        if self.is_release:
-            rel_num=self.manifest['rel_num']
-            self.tarball_name = self.name + '-' + rel_num + '.tgz'
-        os.chdir(self.stage_dir)
-        rc = runCmd("tar czf " + self.tarball_name + ' * .deploy')
-        if rc != 0:
+        try:
+            inputs=self.listInputs(contents)
+            digests=dict()
+            fingerprint=self.getFingerprint(inputs,codec,digests)
+            info=Pkg.loadSidecar(tarball_path,self.digest_cache)
+            if info and info.get('fingerprint') == fingerprint and not self.force:
+                print "Package " + self.tarball_name + " is up to date."
+                return True
+
+            '''All the members get the same mtime, SOURCE_DATE_EPOCH if set, for the tarball not to depend on when its inputs were written'''
+            mtime=int(os.environ.get('SOURCE_DATE_EPOCH') or ARCHIVE_MTIME)
+            files_manifest=self.getFilesManifest(inputs,digests)
+            with open(tmp_path,'wb') as f:
+                writer=DigestWriter(f,newDigest(self.digest_algo))
+                gz=codec.openWriter(writer,self.jobs)
+                tar=tarfile.open(mode='w|',fileobj=gz,format=tarfile.GNU_FORMAT)
+                '''Manifests go first, in the deploy folder in archive.
+                The manifest compiled to JSON is the first, for deploy to load it without parsing YAML.
+                '''
+                self.addArchiveMember(tar,'.deploy/'+self.compiled_manifest_file,self.manifest.getCompiled(),mtime)
+                self.addArchivePath(tar,self.manifest_path,'.deploy/'+self.manifest_file,mtime)
+                self.addArchiveMember(tar,'.deploy/'+self.files_manifest_file,files_manifest,mtime)
+                for src_path,arcname,st in inputs:
+                    self.addArchivePath(tar,src_path,arcname,mtime)
+                tar.close()
+                gz.close()
+        except (IOError,OSError,tarfile.TarError) as e:
             print "Error: Couldn't create package " + self.tarball_name
-            return False
-        os.chdir(self.build_root)
-        rc = runCmd('mv ' + self.stage_dir + '/' + self.tarball_name + ' ./')
-        if rc == 0:
-            runCmd("rm -rf " + self.stage_dir)
-            print "Package " + self.tarball_name + " has been created."
-        else:
-            print "Error: Package " + self.tarball_name + " couldn't be created."
+            print(e)
+            if os.path.exists(tmp_path): os.remove(tmp_path)
             return False
 
-    def stageContent(self,src,tgt):
-        os.chdir(self.stage_dir)
-        if os.path.isdir(src):
-            '''skip build folder silently, but individual files can still be added.'''
-            if runCmd("mkdir -p " + tgt) != 0: return False
-            if runCmd("cp -r " + src + '/. ' + tgt + '/') != 0: return False
-        else:
-            tgt_dir = os.path.dirname(tgt)
-            if tgt_dir != '':
-                if runCmd("mkdir -p " + tgt_dir) != 0: return False
-            if runCmd("cp " + src + ' ' + tgt) != 0: return False
+        os.rename(tmp_path,tarball_path)
+        st=os.stat(tarball_path)
+        if self.digest_cache: self.digest_cache.update(tarball_path,self.digest_algo,writer.hexdigest(),st)
+
+        '''The sidecar index next to the tarball has its manifest and table of contents, read without opening the tarball'''
+        files_algo,files=Pkg.parseFilesManifest(files_manifest)
+        info={'pkg_name':self.name,'rel_num':str(self.manifest.rel_num),'codec':codec.name,'level':codec.level,
+              'size':st.st_size,'digest':writer.hexdigest(),'digest_algo':self.digest_algo,'created':int(st.st_mtime),
+              'manifest_name':'.deploy/'+self.compiled_manifest_file,'manifest':self.manifest.getCompiled(),
+              'files_algo':files_algo,'files':files,'fingerprint':fingerprint,'fingerprint_mode':self.fingerprint_mode}
+        if not writeFileAtomic(tarball_path+TARBALL_INFO_EXT,json.dumps(info,sort_keys=True)+'\n'):
+            print "Warning: Couldn't write the sidecar index of "+self.tarball_name
+        print "Package " + self.tarball_name + " has been created."
 
         return True
 
-    '''Execute the deploy playbook for a package specified in the manifest'''
-    def install(self,tarball_path,deploy_inst):
-        deploy_inst.logHistory("Installing package "+self.name+" using "+tarball_path)
+    '''Returns the paths to archive for the files: entries, as (path,arcname,lstat) in the order those are archived.
+    Directories are followed by their entries sorted by name, symlinks are archived as such.
+    '''
+    def listInputs(self,contents):
+        inputs=list()
+        for src_path,tgt in contents:
+            pending=[(src_path,os.path.normpath(tgt).lstrip('/'))]
+            while pending:
+                path,arcname=pending.pop()
+                st=os.lstat(path)
+                inputs.append((path,arcname,st))
+                if stat.S_ISDIR(st.st_mode):
+                    pending.extend((path+'/'+name,arcname+'/'+name) for name in sorted(os.listdir(path),reverse=True))
 
-        ''' Track the md5 of package being installed '''
-        self.pkg_md5=getFileMD5(tarball_path)
+        return inputs
 
-        '''Extract the tarball in stage_dir, to prepare for deploy playbook to  execute steps'''
-        stage_dir=deploy_inst.opkg_dir+'/pkgs/'+self.name+'/'+deploy_inst.deploy_ts
-        if not execOSCommand('mkdir -p ' + stage_dir):
-                return
-        os.chdir(stage_dir)
+    '''Returns the fingerprint of the inputs of the package: the manifest, the codec and the tarball name, and the path,
+    type, mode and size of each input, along with its mtime, or its content digest if fingerprint_mode is content.
+    The digests computed in content mode are added to digests, path: digest, to be used in the per-file manifest.
+    '''
+    def getFingerprint(self,inputs,codec,digests):
+        fingerprint=newDigest(self.digest_algo)
+        fingerprint.update(loadFile(self.manifest_path))
+        fingerprint.update('\0'.join([self.tarball_name,codec.name,str(codec.level),os.environ.get('SOURCE_DATE_EPOCH','')])+'\n')
+        for path,arcname,st in inputs:
+            entry=[arcname,oct(st.st_mode),str(st.st_size)]
+            if stat.S_ISLNK(st.st_mode):
+                entry.append(os.readlink(path))
+            elif stat.S_ISREG(st.st_mode):
+                if self.fingerprint_mode == 'content':
+                    digests[path]=getFileDigest(path,self.digest_algo)
+                    entry.append(digests[path])
+                else:
+                    entry.append(repr(st.st_mtime))
+            fingerprint.update('\0'.join(entry)+'\n')
 
-        if not execOSCommand('tar xzf ' + tarball_path):
-            print "Error: Problem extracting " + tarball_path + " in " + stage_dir
-            return False
+        return fingerprint.hexdigest()
+
+    '''Members are added with the same mtime, and owned by root, for the archive to depend only on the inputs'''
+    def addArchiveMember(self,tar,name,content,mtime):
+        info=tarfile.TarInfo(name)
+        info.size=len(content)
+        info.mtime=mtime
+        info.mode=0644
+        info.uname=info.gname='root'
+        tar.addfile(info,StringIO.StringIO(content))
+
+    def addArchivePath(self,tar,path,arcname,mtime):
+        info=tar.gettarinfo(path,arcname)
+        info.mtime=mtime
+        info.uid=info.gid=0
+        info.uname=info.gname='root'
+        if info.isreg():
+            with open(path,'rb') as f: tar.addfile(info,f)
+        else:
+            tar.addfile(info)
+
+    '''Returns the per-file manifest of the package content, which lists the regular files as in the archive.
+    The first line has the digest algorithm, followed by a line for each file with digest,mode,size,path delimited by tabs.
+    '''
+    def getFilesManifest(self,inputs,digests):
+        lines=['#'+self.digest_algo]
+        for path,arcname,st in inputs:
+            if not stat.S_ISREG(st.st_mode): continue
+            digest=digests.get(path) or getFileDigest(path,self.digest_algo)
+            lines.append('\t'.join([digest,oct(stat.S_IMODE(st.st_mode)),str(st.st_size),arcname]))
+
+        return '\n'.join(lines)+'\n'
+
+    '''Loads a per-file manifest, returns the digest algorithm and a dict of path: (digest,mode,size)'''
+    @staticmethod
+    def loadFilesManifest(file_path):
+        return Pkg.parseFilesManifest(loadFile(file_path))
+
+    @staticmethod
+    def parseFilesManifest(content):
+        files=dict()
+        lines=content.splitlines()
+        if not lines or not lines[0].startswith('#'): return None,files
+        for line in lines[1:]:
+            fields=line.split('\t',3)
+            if len(fields) != 4: continue
+            digest,mode,size,path=fields
+            files[path]=(digest,int(mode,8),int(size))
+
+        return lines[0][1:],files
+
+    '''Execute the deploy playbook for a package specified in the manifest, recording the time and work done in each phase
+    and step of it in the deploy profile. stage_dir is given when the tarball has been extracted already, with pkg_digest set,
+    to be installed at several install roots.
+    '''
+    def install(self,tarball_path,deploy_inst,stage_dir=None):
+        return self.runProfiled(deploy_inst,self.installSteps,tarball_path,deploy_inst,stage_dir)
+
+    '''Runs func with args and the profiler of this package installation, which is logged when it's done'''
+    def runProfiled(self,deploy_inst,func,*args):
+        profiler=Profiler(self.name,deploy_inst.deploy_profile)
+        profiler.activate()
+        status=False
+        try:
+            status=func(*(args+(profiler,)))
+        finally:
+            deploy_inst.logProfile(profiler.finish(status))
+
+        return status
+
+    def installSteps(self,tarball_path,deploy_inst,stage_dir,profiler):
+        '''Extract the tarball in stage_dir, to prepare for deploy playbook to  execute steps.
+        The digest of package being installed is computed while extracting, so the tarball is read only once.
+        A stage_dir shared by several install roots is extracted by the caller, and removed by it.
+        '''
+        shared_stage=stage_dir is not None
+        if not shared_stage:
+            stage_dir=deploy_inst.opkg_dir+'/pkgs/'+self.name+'/'+deploy_inst.deploy_ts
+            if not makeDirs(stage_dir): return False
+
+            profiler.startPhase('extract')
+            self.pkg_digest=self.extract(tarball_path,stage_dir,deploy_inst.object_store)
+            Profiler.count('bytes_read',os.path.getsize(tarball_path))
+            if not self.pkg_digest:
+                print "Error: Problem extracting " + tarball_path + " in " + stage_dir
+                return False
+
+        if self.isInstalledDigest(self.pkg_digest) and not deploy_inst.deploy_force:
+            print "Info: This revision of package "+self.name+" is already installed at "+deploy_inst.install_root+'/installs/'+self.install_meta['latest_install']['deploy_ts']+'/'+self.name
+            print "Info: Use --force option to override."
+            if not shared_stage: deploy_inst.removeStage(stage_dir)
+            return True
+
+        deploy_inst.logHistory("Installing package "+self.name+" using "+tarball_path)
+        self.reportChanges(deploy_inst)
 
         '''Setup install location for the new deployment of pkg'''
         deploy_dir = deploy_inst.deploy_root + '/' + self.name
-        deploy_inst.extra_vars['OPKG_DEPLOY_DIR'] = deploy_dir
-        if not execOSCommand('mkdir -p ' + deploy_dir):
+        self.vars['OPKG_DEPLOY_DIR'] = deploy_dir
+        current_path = deploy_inst.install_root + '/' + CURRENT_DIR + '/' + self.name
+        self.vars['OPKG_CURRENT_DIR'] = current_path
+        self.vars['OPKG_INSTALL_ROOT'] = deploy_inst.install_root
+        if os.path.lexists(deploy_dir):
+            print "Error: "+deploy_dir+" exists already, a package is not installed over another installation."
             return False
+        if not makeDirs(deploy_dir): return False
 
         '''Resolve manifest, and files defined under templates and replaces with actual values 
-        defined for this specific deployment.'''
-        os.chdir('.deploy')
-        manifest_path=os.getcwd()+'/'+self.manifest_file
-        tmpl_inst=Tmpl(manifest_path)
-        if not tmpl_inst.resolveVars(deploy_inst.getVars()):
+        defined for this specific deployment.
+        The deploy steps are run in the .deploy folder of stage_dir.'''
+        profiler.startPhase('manifest')
+        steps_dir=stage_dir+'/.deploy'
+        manifest_path=steps_dir+'/'+self.compiled_manifest_file
+        if not os.path.isfile(manifest_path): manifest_path=steps_dir+'/'+self.manifest_file
+        pkg_manifest=Manifest(manifest_path)
+        if not pkg_manifest.getConfig():
             print "Error: Problem resolving "+self.manifest_file
             return False
-        pkg_manifest=Manifest(manifest_path)
+        pkg_manifest.resolveVars(self.vars)
 
         '''Run pre-deploy steps. 
         These are run immediately after the tarball is extracted in stage_dir
         '''
-        steps = pkg_manifest.getSectionItems('pre_deploy')
-        if steps:
-            for step in steps:
-                if not execOSCommand(step):
-                    print "Error: Problem executing the following step in pre_deploy phase: "+step
-                    return False
+        profiler.startPhase('pre_deploy')
+        if not self.runHook(deploy_inst,pkg_manifest,'pre_deploy',steps_dir,profiler): return False
 
         '''copy targets entries to install_root'''
+        profiler.startPhase('targets')
         targets=pkg_manifest.getSectionItems('targets')
         if targets:
             for target in targets:
+                profiler.startStep(target)
                 tgt,src=re.split(':',target)
                 source_path,target_path = src,tgt
                 if not re.match("^\/", src): source_path = stage_dir + "/" + src
@@ -336,26 +729,28 @@ class Pkg():
                 if not createTargetPath(source_path, target_path):
                     print "Error: Base dir of " + target_path + " cannot be created."
                     return False
-                cmd='cp '+source_path+' '+target_path #if a file
-                if os.path.isdir(source_path): cmd='cp -r '+source_path+'/* '+target_path+'/'
-                if not execOSCommand(cmd):
-                    print "Error: Problem copying from " + stage_dir + ". command: " + cmd
+                if not deploy_inst.object_store.installPath(source_path,target_path):
+                    print "Error: Problem copying from " + source_path + " to " + target_path
                     return False
 
         '''Generate deployed template files with actual values, variables are marked as {{ var }} '''
+        profiler.startPhase('templates')
         templates = pkg_manifest.getSectionItems('templates')
         if templates:
             for tmpl in templates:
+                profiler.startStep(tmpl)
                 tmpl_path=tmpl
                 if not re.match("^\/", tmpl): tmpl_path = deploy_dir + "/" + tmpl
                 tmpl_inst=Tmpl(tmpl_path)
-                if not tmpl_inst.resolveVars(deploy_inst.getVars()):
+                if not tmpl_inst.resolveVars(self.vars):
                     print "Error: Couldn't install resolved files for those marked as templates, with real values."
                     return False
 
         '''Replaces tokens in files flagged for that, tokens are unmarked like PORT=80 etc'''
+        profiler.startPhase('replaces')
         if 'replaces' in pkg_manifest.getConfig():
             for replaces_file in pkg_manifest.getConfig()['replaces']:
+                profiler.startStep(replaces_file)
                 '''Each entry for replacement in the replaces_file is a dict as replacement entries are delimited with :'''
                 replaces_list=list()
                 for token_dict in pkg_manifest.getConfig()['replaces'][replaces_file]:
@@ -370,67 +765,413 @@ class Pkg():
                     return False
 
         '''Symlinks'''
+        profiler.startPhase('symlinks')
         symlinks = pkg_manifest.getSectionItems('symlinks')
         if symlinks:
             for symlink in symlinks:
+                profiler.startStep(symlink)
                 tgt_path,src_path=re.split(':',symlink)
+                '''Symlinks from outside the deploy dir point through the current link, so that those follow a rollback'''
+                if not re.match("^\/", src_path):
+                    if re.match("^\/", tgt_path): src_path = current_path + "/" + src_path
+                    else: src_path = deploy_dir + "/" + src_path
                 if not re.match("^\/", tgt_path): tgt_path = deploy_dir + "/" + tgt_path
-                if not re.match("^\/", src_path): src_path = deploy_dir + "/" + src_path
-                cmd = "ln -sfn " + src_path + " " + tgt_path
-                if not execOSCommand(cmd):
-                    print "Error: Problem creating symlink " + cmd
+                if not swapSymlink(src_path,tgt_path):
+                    print "Error: Problem creating symlink " + tgt_path + " to " + src_path
                     return False
 
         '''Permissions
         The list items will be returned in the format, dir:owner:group mod; eg: 'apps:root:root 0444'
         Parse each line accordingly.
         '''
+        profiler.startPhase('permissions')
         perms = pkg_manifest.getSectionItems('permissions')
         if perms:
+            perms_inst=Permissions(deploy_inst.object_store)
             for perm in perms:
                 fpath, perm_opt = perm.split(':',1)
-                chown_opt,chmod_opt = perm_opt.split(' ')
+                chown_opt,chmod_opt = perm_opt.split()
                 if not re.match("^\/", fpath): fpath = deploy_dir + "/" + fpath
-                cmd="chown -R "+chown_opt+" "+fpath+';chmod -R '+chmod_opt+' '+fpath
-                if not execOSCommand(cmd):
-                    print "Error: Problem setting permissions on " + fpath+'. Command: '+cmd
+                if not perms_inst.addRule(fpath,chown_opt,chmod_opt):
+                    print "Error: Invalid permissions entry " + perm
                     return False
+            if not perms_inst.apply():
+                print "Error: Problem setting permissions for "+self.name
+                return False
+
+        if not deploy_inst.object_store.saveRefs(deploy_dir):
+            print "Error: Couldn't record the objects used by "+deploy_dir
+            return False
+
+        '''With --prepare, the staged release is left to be activated by deploy --activate'''
+        if deploy_inst.deploy_mode == 'prepare':
+            return self.savePrepared(deploy_inst,tarball_path,stage_dir,deploy_dir,pkg_manifest)
+
+        if not self.activateSteps(deploy_inst,stage_dir,deploy_dir,current_path,pkg_manifest,profiler): return False
+        if not shared_stage: deploy_inst.removeStage(stage_dir)
+
+        return True
+
+    '''Activates the installation at deploy_dir, runs the post-deploy steps in the .deploy folder of stage_dir, and registers it'''
+    def activateSteps(self,deploy_inst,stage_dir,deploy_dir,current_path,pkg_manifest,profiler):
+        steps_dir=stage_dir+'/.deploy'
+        '''Make this installation the current one, before post-deploy steps which would start it.
+        The current link is pointed back to the installation it pointed to if the post-deploy steps or the registration fail.
+        '''
+        profiler.startPhase('activate')
+        previous_target=os.readlink(current_path) if os.path.islink(current_path) else None
+        if not Pkg.activate(deploy_dir,current_path): return False
+        self.manifest=pkg_manifest
 
         '''Post-deploy steps'''
-        steps = pkg_manifest.getSectionItems('post_deploy')
-        if steps:
-            for step in steps:
-                if not execOSCommand(step):
-                    print "Error: Problem executing the following step in post_deploy phase: " + step
-                    return False
-        
-        ''' Register the installation '''
-        self.registerInstall(deploy_inst)
+        profiler.startPhase('post_deploy')
+        if not self.runHook(deploy_inst,pkg_manifest,'post_deploy',steps_dir,profiler):
+            Pkg.deactivate(current_path,previous_target)
+            return False
 
-        '''delete the stage_dir upon successful installation of the package'''
-        os.chdir("/tmp")  # a workaround to avoid system warning when curr dir stage_dir is deleted.
-        if not execOSCommand('rm -r ' + stage_dir):
-            print "Warning: Couldn't delete " + stage_dir
+        ''' Register the installation '''
+        profiler.startPhase('register')
+        if not self.registerInstall(deploy_inst):
+            Pkg.deactivate(current_path,previous_target)
+            return False
 
         print "Info: Package "+self.name+" has been installed at "+deploy_dir
 
         return True
 
-    def isInstalled(self,tarball_path):
+    '''Runs the steps of a hook section of the manifest in cwd. The exit status of each step is recorded in the deploy history,
+    and its output in the hook log of the package, history/hooks/PKG_NAME/DEPLOY_TS.SECTION.log in opkg_dir.
+    '''
+    def runHook(self,deploy_inst,pkg_manifest,section,cwd,profiler=None):
+        groups=pkg_manifest.getHookSteps(section,deploy_inst.hook_timeout)
+        if groups is None: return False
+        if not groups: return True
+        log_path=deploy_inst.history_dir+'/'+HOOK_LOG_DIR+'/'+self.name+'/'+deploy_inst.deploy_ts+'.'+section+'.log'
+        hook=Hook(self.name,groups,cwd,log_path)
+        status=hook.run(profiler)
+        for step in hook.steps:
+            if step.rc is None and not step.timed_out: continue
+            deploy_inst.logHistory("Step of "+section+" of package "+self.name+" at "+deploy_inst.install_root+": "+step.describe())
+        if not status:
+            failed=[step for step in hook.steps if step.rc != 0 or step.timed_out]
+            print "Error: Problem executing the following step in "+section+" phase: "+failed[0].describe()+", see "+log_path
+
+        return status
+
+    '''Records the installation prepared at deploy_dir, along with the stage_dir the post-deploy steps are to be run in.
+    The tree is fingerprinted from the attributes of its files, which is cheap to check again on activation.
+    '''
+    def savePrepared(self,deploy_inst,tarball_path,stage_dir,deploy_dir,pkg_manifest):
+        install_db=InstallDB.getInstance(deploy_inst.env_conf)
+        stale=install_db.getPrepared(self.name,deploy_inst.install_root)
+        prepared={'pkg_name':self.name,'install_root':deploy_inst.install_root,'pkg_rel_num':self.rel_num or '','pkg_ts':str(self.rel_ts or 0),
+                  'pkg_digest':self.pkg_digest,'digest_algo':self.digest_algo,'deploy_ts':deploy_inst.deploy_ts,
+                  'tarball_path':tarball_path,'stage_dir':stage_dir,'deploy_dir':deploy_dir,
+                  'files_manifest_path':self.files_manifest_path,'manifest':pkg_manifest.getCompiled(),
+                  'tree_digest':getTreeDigest(deploy_dir,self.digest_algo)}
+        if not install_db.setPrepared(prepared,deploy_inst.install_root):
+            print "Error: Couldn't record the prepared installation of "+self.name
+            return False
+        '''A release prepared earlier, and not activated, is replaced'''
+        if stale and stale['deploy_dir'] != deploy_dir:
+            if not removePath(stale['deploy_dir']): print "Warning: Couldn't delete " + stale['deploy_dir']
+            deploy_inst.removeStage(stale['stage_dir'])
+            try:
+                os.rmdir(os.path.dirname(stale['deploy_dir']))
+            except OSError:
+                pass
+        deploy_inst.logHistory("Prepared package "+self.name+" at "+deploy_dir)
+        print "Info: Package "+self.name+" has been prepared at "+deploy_dir+", use deploy --activate to activate it."
+
+        return True
+
+    def activatePrepared(self,deploy_inst,prepared,tarball_path=None):
+        return self.runProfiled(deploy_inst,self.activatePreparedSteps,deploy_inst,prepared,tarball_path)
+
+    '''Activates the installation prepared by an earlier deploy --prepare.
+    The tarball, tarball_path if given or else the one prepared from, must still have the digest of the one prepared,
+    and the prepared tree must not have been changed since.
+    '''
+    def activatePreparedSteps(self,deploy_inst,prepared,tarball_path,profiler):
+        profiler.startPhase('verify')
+        algo=prepared['digest_algo']
+        if not tarball_path: tarball_path=prepared['tarball_path']
+        if not os.path.isfile(tarball_path):
+            print "Error: Tarball "+tarball_path+" of the prepared installation of "+self.name+" is not found."
+            return False
+        if getCachedDigest(self.digest_cache,tarball_path,algo) != prepared['pkg_digest']:
+            print "Error: Tarball "+tarball_path+" doesn't match the prepared installation of "+self.name+" at "+prepared['deploy_dir']
+            return False
+        if not os.path.isdir(prepared['deploy_dir']) or getTreeDigest(prepared['deploy_dir'],algo) != prepared['tree_digest']:
+            print "Error: Prepared installation of "+self.name+" at "+prepared['deploy_dir']+" has been changed, deploy it again."
+            return False
+
+        self.rel_num=prepared['pkg_rel_num']
+        self.rel_ts=prepared['pkg_ts']
+        self.pkg_digest=prepared['pkg_digest']
+        self.digest_algo=algo
+        self.deploy_ts=prepared['deploy_ts']
+        self.files_manifest_path=prepared['files_manifest_path']
+        pkg_manifest=Manifest(self.name+COMPILED_MANIFEST_EXT,prepared['manifest'])
+        if not pkg_manifest.getConfig(): return False
+
+        deploy_inst.logHistory("Activating package "+self.name+" prepared at "+prepared['deploy_dir'])
+        current_path=deploy_inst.install_root+'/'+CURRENT_DIR+'/'+self.name
+        if not self.activateSteps(deploy_inst,prepared['stage_dir'],prepared['deploy_dir'],current_path,pkg_manifest,profiler): return False
+        if not InstallDB.getInstance(deploy_inst.env_conf).removePrepared(self.name,deploy_inst.install_root): return False
+        deploy_inst.removeStage(prepared['stage_dir'])
+
+        return True
+
+    '''Points the current link of the package to deploy_dir, replacing the link in a single rename'''
+    @staticmethod
+    def activate(deploy_dir,current_path):
+        if not makeDirs(os.path.dirname(current_path)): return False
+        if not swapSymlink(deploy_dir,current_path):
+            print "Error: Couldn't activate the installation at "+deploy_dir
+            return False
+
+        return True
+
+    '''Points the current link of the package back to previous_target, or removes it if there was none'''
+    @staticmethod
+    def deactivate(current_path,previous_target):
+        if previous_target:
+            if not swapSymlink(previous_target,current_path): return False
+        elif os.path.islink(current_path):
+            os.remove(current_path)
+        print "Info: The current link "+current_path+" has been restored."
+
+        return True
+
+    '''Rolls back the package at the install root of deploy_inst to its previous installation.
+    The current link is pointed back to that, which is still there as installed, and the rollback steps of the
+    installation rolled back are run. Then the one before the previous becomes the previous installation.
+    '''
+    def rollback(self,deploy_inst):
+        install_db=InstallDB.getInstance(deploy_inst.env_conf)
+        latest,previous=install_db.getInstalls(self.name,deploy_inst.install_root)
+        if not latest:
+            print "Error: Package "+self.name+" is not installed at "+deploy_inst.install_root
+            return False
+        if not previous:
+            print "Error: No previous installation of "+self.name+" to roll back to."
+            return False
+        previous_dir=deploy_inst.install_root+'/installs/'+previous['deploy_ts']+'/'+self.name
+        if not os.path.isdir(previous_dir):
+            print "Error: The previous installation of "+self.name+" is not found at "+previous_dir+", it has to be deployed again."
+            return False
+
+        current_path=deploy_inst.install_root+'/'+CURRENT_DIR+'/'+self.name
+        latest_dir=deploy_inst.install_root+'/installs/'+latest['deploy_ts']+'/'+self.name
+        if not Pkg.activate(previous_dir,current_path): return False
+        if not install_db.rollback(self.name,deploy_inst.install_root):
+            Pkg.activate(latest_dir,current_path)
+            return False
+        deploy_inst.logHistory("Rolled back package "+self.name+" from "+latest_dir+" to "+previous_dir)
+
+        if latest.get('manifest'):
+            manifest=Manifest(self.name+COMPILED_MANIFEST_EXT,latest['manifest'])
+            for step in manifest.getSectionItems('rollback') or list():
+                if not execOSCommand(step,previous_dir):
+                    print "Error: Problem executing the following step in rollback: "+step
+                    return False
+        print "Info: Package "+self.name+" has been rolled back to release "+(previous['pkg_rel_num'] or 'dev')+" at "+previous_dir
+
+        return True
+
+    '''Runs the steps of the start, stop or reload section of manifest, that of the current installation, in its current dir.
+    After start and reload, waits for the package to be ready.
+    '''
+    def runAction(self,deploy_inst,action,manifest):
+        current_path=deploy_inst.install_root+'/'+CURRENT_DIR+'/'+self.name
+        if not self.runHook(deploy_inst,manifest,action,current_path): return False
+        if action in ('start','reload') and not self.waitReady(deploy_inst,manifest,current_path): return False
+        deploy_inst.logHistory("Ran "+action+" of package "+self.name+" at "+deploy_inst.install_root)
+        print "Info: Package "+self.name+" has been "+{'start':'started','stop':'stopped','reload':'reloaded'}[action]+"."
+
+        return True
+
+    '''Waits for the package to be ready, till each of the probes in the ready section of its manifest succeeds once.
+    The probes failing are run again after an interval doubling from READY_INTERVAL up to READY_MAX_INTERVAL,
+    for up to ready_timeout seconds in all. The output of the probes is written to the hook log, not printed.
+    '''
+    def waitReady(self,deploy_inst,manifest,cwd):
+        groups=manifest.getHookSteps('ready')
+        if groups is None: return False
+        probes=[probe for group in groups for probe in group]
+        if not probes: return True
+        try:
+            timeout=float(manifest.getConfig().get('ready_timeout',READY_TIMEOUT))
+        except ValueError:
+            print "Error: Invalid ready_timeout in the manifest of "+self.name
+            return False
+        log_path=deploy_inst.history_dir+'/'+HOOK_LOG_DIR+'/'+self.name+'/'+deploy_inst.deploy_ts+'.ready.log'
+        if not makeDirs(os.path.dirname(log_path)): return False
+        start=time.time()
+        interval=READY_INTERVAL
+        attempts=0
+        probe_timeouts=dict((probe,probe.timeout) for probe in probes)
+        with open(log_path,'a',1) as log:
+            while True:
+                attempts+=1
+                for probe in probes:
+                    '''A probe runs for what's left of ready_timeout at most, or its own timeout if shorter'''
+                    remaining=max(timeout-(time.time()-start),READY_INTERVAL)
+                    probe.timeout=min(probe_timeouts[probe],remaining) if probe_timeouts[probe] else remaining
+                    log.write('$ '+probe.cmd+'\n')
+                    probe.run(cwd,None,log,True)
+                    log.write('# '+probe.describe()+'\n')
+                probes=[probe for probe in probes if probe.rc != 0 or probe.timed_out]
+                if not probes: break
+                if time.time()-start+interval > timeout:
+                    print "Error: Package "+self.name+" is not ready after "+('%g' % timeout)+"s, probe "+probes[0].describe()+", see "+log_path
+                    deploy_inst.logHistory("Package "+self.name+" at "+deploy_inst.install_root+" is not ready after "+str(attempts)+" checks")
+                    return False
+                time.sleep(interval)
+                interval=min(interval*2,READY_MAX_INTERVAL)
+        deploy_inst.logHistory("Package "+self.name+" at "+deploy_inst.install_root+" is ready after "+str(attempts)+" checks in "+('%.2f' % (time.time()-start))+"s")
+
+        return True
+
+    '''Extract tarball_path under stage_dir in a single streaming read, returns the digest of the tarball.
+    Directories are made writable while extracting and get their archived attributes at the end, as tar does.
+    The per-file manifest precedes the payload in the archive, and the files listed in it that are found in
+    the object store are linked from there instead of being written. The digests of the files written are
+    computed on the way and handed to the object store, so those are not read again to install targets.
+    Files are not linked if the package has pre-deploy steps, which run in stage_dir and could change
+    the files there in place, and with those the objects shared with the installations.
+    '''
+    def extract(self,tarball_path,stage_dir,object_store=None):
+        directories=list()
+        safe_dirs=set()
+        files=None
+        manifest=None
+        carry=object_store is not None
+        self.files_written,self.files_carried=0,0
+        try:
+            codec,f=Codec.openTarball(tarball_path)
+            with f:
+                st=os.fstat(f.fileno())
+                reader=DigestReader(f,newDigest(self.digest_algo))
+                tar=codec.openTar(reader)
+                for member in tar:
+                    names=[member.name]+([member.linkname] if member.islnk() else [])
+                    if [name for name in names if os.path.isabs(name) or '..' in name.split('/')]:
+                        print "Error: Illegal path "+member.name+" in "+tarball_path
+                        codec.close()
+                        return None
+                    if not all(Pkg.isUnderDirs(stage_dir,name,safe_dirs) for name in names):
+                        print "Error: Illegal path "+member.name+" in "+tarball_path+", it's through a symlink in the archive"
+                        codec.close()
+                        return None
+                    member_path=os.path.join(stage_dir,member.name)
+                    '''A symlink extracted earlier at the path is replaced, not written through, as tar does'''
+                    if not member.isdir() and os.path.islink(member_path): os.remove(member_path)
+                    if member.isreg() and object_store:
+                        name=os.path.normpath(member.name)
+                        if carry and files and name in files and object_store.carry(files[name][0],member.mode,member_path):
+                            self.files_carried+=1
+                            continue
+                        object_store.extractFile(tar,member,member_path)
+                        if files is not None: self.files_written+=1
+                        '''The compiled manifest goes first, and the YAML one after it is not parsed'''
+                        if files is None and manifest is None and name in ('.deploy/'+self.compiled_manifest_file,'.deploy/'+self.manifest_file):
+                            manifest=Manifest(member_path)
+                            if not manifest.getConfig() or manifest.getConfig().get('pre_deploy'): carry=False
+                        if name == '.deploy/'+self.files_manifest_file:
+                            algo,files=Pkg.loadFilesManifest(member_path)
+                            if algo != object_store.algo: files=None
+                        continue
+                    if member.isdir():
+                        directories.append(member)
+                        member=copy.copy(member)
+                        member.mode=0700
+                    tar.extract(member,stage_dir)
+                directories.sort(key=lambda m: m.name,reverse=True)
+                for member in directories:
+                    dir_path=os.path.join(stage_dir,member.name)
+                    tar.chown(member,dir_path)
+                    tar.utime(member,dir_path)
+                    tar.chmod(member,dir_path)
+                tar.close()
+                codec.close()
+                reader.drain()
+        except (IOError,OSError,tarfile.TarError) as e:
+            print(e)
+            return None
+
+        self.digest_cache.update(tarball_path,self.digest_algo,reader.hexdigest(),st)
+
+        return reader.hexdigest()
+
+    '''Checks that the parents of name under stage_dir are directories, or are not there yet, so a member extracted at name
+    is not written outside stage_dir through a symlink extracted earlier. safe_dirs are the directories checked already,
+    which stay directories as a symlink is not extracted over a directory.
+    '''
+    @staticmethod
+    def isUnderDirs(stage_dir,name,safe_dirs):
+        path=stage_dir
+        for part in os.path.normpath(name).split('/')[:-1]:
+            path=path+'/'+part
+            if path in safe_dirs: continue
+            try:
+                st=os.lstat(path)
+            except OSError as e:
+                if e.errno == errno.ENOENT: return True
+                raise
+            if not stat.S_ISDIR(st.st_mode): return False
+            safe_dirs.add(path)
+
+        return True
+
+    '''Reports how many files changed since the release installed at the install root, from the per-file manifests of both.'''
+    def reportChanges(self,deploy_inst):
+        files_path=deploy_inst.opkg_dir+'/pkgs/'+self.name+'/'+deploy_inst.deploy_ts+'/.deploy/'+self.files_manifest_file
+        if not os.path.isfile(files_path): return
+        self.files_manifest_path=files_path
+        algo,files=Pkg.loadFilesManifest(files_path)
+        latest=InstallDB.getInstance(deploy_inst.env_conf).getInstalls(self.name,deploy_inst.install_root)[0]
+        changed=len(files)
+        if latest and latest['files']:
+            latest_algo,latest_files=Pkg.parseFilesManifest(latest['files'])
+            if latest_algo == algo:
+                changed=len([f for f in files if files[f] != latest_files.get(f)])
+        print "Info: "+str(changed)+" of "+str(len(files))+" files changed since the installed release; "+str(self.files_written)+" files extracted, "+str(self.files_carried)+" linked from the object store."
+
+    '''Checks if the tarball is the latest installation of the package.
+    The digest cache is looked up first, the tarball is hashed only if compute is set and the cache misses.
+    '''
+    def isInstalled(self,tarball_path,compute=True):
         if not self.getMeta()['latest_install']:
             return False
-        md5_local = self.install_meta['latest_install']['pkg_md5']
+        algo=self.install_meta['latest_install']['digest_algo']
+        digest=self.digest_cache.lookup(tarball_path,algo)
+        if not digest and compute:
+            digest=getFileDigest(tarball_path,algo)
+            self.digest_cache.update(tarball_path,algo,digest)
+
+        return (digest is not None and digest == self.install_digest)
 
-        return (getFileMD5(tarball_path) == md5_local)
+    '''Digests are comparable only if computed using the same algorithm'''
+    def isInstalledDigest(self,digest):
+        if not self.install_meta['latest_install']: return False
+        if self.install_meta['latest_install']['digest_algo'] != self.digest_algo: return False
+
+        return (digest == self.install_digest)
 
 '''Class to process the main opkg actions'''
 class opkg():
-    ACTIONS=['create','ls','rls','get','put','deploy','clean','start','stop','restart','rollback']
+    ACTIONS=['create','ls','rls','info','get','put','deploy','clean','start','stop','restart','reload','rollback']
 
     '''action specific required configs'''
     ACTION_CONFIGS={
         'deploy': ['install_root'],
         'ls':['install_root'],
+        'start':['install_root'],
+        'stop':['install_root'],
+        'restart':['install_root'],
+        'reload':['install_root'],
         'put':['repo_type','repo_path'],
         'get': ['repo_type', 'repo_path']
     }
@@ -447,6 +1188,7 @@ class opkg():
         self.configs=dict()
         self.pkgs=None
         self.opkg_dir=None
+        self.jobs=CPU_COUNT
 
         if len(params) < 2:
             self.printHelp()
@@ -489,16 +1231,23 @@ class opkg():
         if 'opkg_dir' in self.arg_dict: opkg_conf_file=self.arg_dict['opkg_dir']+'/conf/opkg.env'
         self.conf_file=opkg_conf_file
         self.loadConfigFile()
-        self.opkg_dir=self.configs['basic']['opkg_dir']
+        if 'digest_algo' not in self.configs['basic']: self.configs['basic']['digest_algo']=DEFAULT_DIGEST_ALGO
 
         '''Override config items specified in config file with those from command-line'''
         for section in self.configs:
             for item in self.configs[section]:
                 if item in self.arg_dict: self.configs[section][item]=self.arg_dict[item]
+        self.opkg_dir=self.configs['basic']['opkg_dir']
+
+        if self.configs['basic']['digest_algo'] not in DIGEST_ALGOS:
+            print "Error: Unsupported digest algorithm "+self.configs['basic']['digest_algo']+", use one of "+', '.join(DIGEST_ALGOS)
+            Exit(1)
 
         '''Parse out common options such as pkg'''
         if 'pkg' in self.arg_dict:
             self.pkgs=re.split(',',self.arg_dict['pkg'])
+        if 'jobs' in self.arg_dict:
+            self.jobs=int(self.arg_dict['jobs'])
 
         return
 
@@ -525,216 +1274,2583 @@ class opkg():
         print "Usages:"
         print script + " --version"
         print script + " --help"
-        print script + " ls [--pkg=pkg1,pkg2,...]"
+        print script + " ls [--pkg=pkg1,pkg2,... [--history]]"
         print script + " rls [--pkg=pkg1,pkg2,...]"
-        print script + " create --pkg=pkg1,pkg2,... [--release]"
+        print script + " info --pkg=/path/to/pkg1.tgz,pkg2[-REL_NUM|dev],... [--files]"
+        print script + " create --pkg=pkg1,pkg2,... [--release] [--jobs=N] [--build_root=/path/to/build] [--codec=gzip|bz2|xz|zstd|none[:LEVEL]] [--fingerprint=stat|content] [--force]"
         print script + " put --file=/tarball/with/full/path"
-        print script + " get --pkg=pkg1,pkg2,... [--release=REL_NUM|dev] [--path=/download/path]" 
-        print script + " deploy --pkg=pkg1,pkg2[-REL_NUM|dev],... [--install_root=/path/to/install]"
-        print script + " start|stop|restart|reload --pkg=pkg1,pkg2,... [--install_root=/path/to/install]"
+        print script + " get --pkg=pkg1,pkg2,... [--release=REL_NUM|dev] [--path=/download/path] [--jobs=N]"
+        print script + " deploy --pkg=pkg1,pkg2[-REL_NUM|dev],... [--install_root=/path/to/install,...|--install_roots=/path/to/roots.yml] [--jobs=N] [--profile] [--prepare]"
+        print script + " deploy --activate [--pkg=pkg1,pkg2[-REL_NUM|dev],...] [--install_root=/path/to/install,...|--install_roots=/path/to/roots.yml] [--jobs=N] [--profile]"
+        print script + " start|stop|restart|reload [--pkg=pkg1,pkg2,...] [--install_root=/path/to/install,...|--install_roots=/path/to/roots.yml] [--jobs=N]"
         print script + " rollback --pkg=pkg1,pkg2,... [--install_root=/path/to/install]"
         print script + " clean [--pkg=pkg1,pkg2,...] [--count=COUNT] [--install_root=/path/to/install]"
 
         return True
 
+    '''Returns the install roots to deploy to, as a dict of install_root: extra-vars of it, None if there is a single one.
+    Those are given as --install_root=/path1,/path2,... sharing the extra-vars,
+    or listed in a YAML file given as --install_roots, with the extra-vars of each under it.
+    install_root of the configs is set to the first of those.
+    '''
+    def getInstallRoots(self):
+        install_roots=collections.OrderedDict()
+        if self.arg_dict.get('install_roots'):
+            try:
+                roots=yaml.load(loadFile(self.arg_dict['install_roots']),Loader=getattr(yaml,'CSafeLoader',yaml.SafeLoader))
+            except (EnvironmentError,yaml.YAMLError) as e:
+                print "Error: Problem loading install roots from "+self.arg_dict['install_roots']+", "+str(e)
+                return False
+            if not isinstance(roots,dict) or not roots:
+                print "Error: Install roots in "+self.arg_dict['install_roots']+" should be install_root: extra-vars entries."
+                return False
+            for install_root in sorted(roots):
+                install_roots[str(install_root)]=dict((str(k),str(v)) for k,v in (roots[install_root] or dict()).items())
+        else:
+            for install_root in re.split(',',self.configs['basic']['install_root']):
+                install_roots[install_root]=dict()
+        self.configs['basic']['install_root']=install_roots.keys()[0]
+        if len(install_roots) == 1 and not install_roots.values()[0]: return None
+
+        return install_roots
+
+    '''Builds the packages, in worker processes if there are more than one, up to --jobs at a time.
+    The jobs are shared by the workers, each compresses its tarball on the jobs left for it.
+    The output of a package built in a worker is printed once it's done, followed by the results of all.
+    '''
+    def createPackages(self):
+        build_root=os.path.abspath(self.arg_dict.get('build_root') or os.getcwd())
+        options=dict((k,self.arg_dict[k]) for k in ('codec','fingerprint','force','release') if k in self.arg_dict)
+        workers=max(1,min(self.jobs,len(self.pkgs)))
+        tasks=[(pkg,build_root,self.configs,options,max(1,self.jobs/workers),workers > 1) for pkg in self.pkgs]
+        start=time.time()
+        results=list()
+        if workers == 1:
+            for task in tasks: results.append(createPackage(task))
+        else:
+            pool=ProcessPool(workers)
+            try:
+                for result in pool.imap_unordered(createPackage,tasks):
+                    sys.stdout.write(result[2])
+                    results.append(result)
+                pool.close()
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise
+            pool.join()
+        failed=[pkg for pkg,status,output,elapsed in results if not status]
+        if len(results) > 1:
+            print "Results:"
+            for pkg,status,output,elapsed in sorted(results,key=lambda result: self.pkgs.index(result[0])):
+                print '  %-32s %-8s %8.2fs' % (pkg,'ok' if status else 'failed',elapsed)
+            print "%d of %d packages created in %.2fs on %d workers, %d failed" % (len(results)-len(failed),len(results),time.time()-start,workers,len(failed))
+
+        return not failed
+
     '''Execute the action'''
     def main(self):
 
         if self.action=='create':
             self.extra_vars['ACTION'] = 'create'
-            for pkg in self.pkgs:
-                pkg_inst=Pkg(pkg)
-                pkg_inst.create()
+            if not self.pkgs:
+                print "Error: Packages to be created are not specified, use --pkg option."
+                Exit(1)
+            if not self.createPackages(): Exit(1)
 
         elif self.action=='ls':
             self.extra_vars['ACTION'] = 'ls'
-            for pkg in self.pkgs:
-                pkg_name, pkg_name_rel_num, tarball_name = Pkg.parseName(pkg)
-                pkg_inst=Pkg(pkg_name)
-                pkg_inst.setEnvConfig(self.configs)
-                pkg_inst.loadMeta()
-                pkg_meta=pkg_inst.getMeta()
-                if not pkg_meta: continue
-                print pkg_name+'-'+pkg_meta['latest_install']['pkg_rel_num']
+            pkg_names=None
+            if self.pkgs: pkg_names=[Pkg.parseName(pkg)[0] for pkg in self.pkgs]
+            install_db=InstallDB.getInstance(self.configs)
+            if 'history' in self.arg_dict and pkg_names:
+                for pkg_name in pkg_names:
+                    for install in install_db.getHistory(pkg_name,self.configs['basic']['install_root']):
+                        print install['pkg_name']+'-'+(install['pkg_rel_num'] or 'dev')+' '+install['deploy_ts']
+            else:
+                for install in install_db.listInstalled(self.configs['basic']['install_root'],pkg_names):
+                    print install['pkg_name']+'-'+(install['pkg_rel_num'] or 'dev')
 
         elif self.action=='deploy':
             self.extra_vars['ACTION'] = 'deploy'
-            deploy_inst=Deploy(self.configs,self.arg_dict,self.extra_vars)
+            install_roots=self.getInstallRoots()
+            if install_roots is False: Exit(1)
+            deploy_inst=Deploy(self.configs,self.arg_dict,self.extra_vars,install_roots)
+            if 'activate' in self.arg_dict:
+                status=True
+                for root in deploy_inst.roots:
+                    if not root.activatePackages(self.pkgs,self.jobs): status=False
+                if not status: Exit(1)
+                return
+            if not self.pkgs:
+                print "Error: Packages to be deployed are not specified, use --pkg option."
+                Exit(1)
+            tarballs=collections.OrderedDict()
             for pkg in self.pkgs:
                 pkg_name,pkg_name_rel_num,tarball_name=Pkg.parseName(pkg)
                 is_local=False
-                if re.match('^.+?\.tgz',pkg): is_local=True
+                if Codec.getTarballExt(pkg): is_local=True
                 download_dir=self.opkg_dir+'/pkgs/'+pkg_name
-                execOSCommand("mkdir -p "+download_dir)
+                makeDirs(download_dir)
                 if is_local:
-                    if not execOSCommand("cp "+pkg+" "+download_dir+"/"):
+                    if not deploy_inst.pkg_cache.add(pkg,download_dir+'/'+tarball_name):
                         print "Error: Cannot copy tarball "+tarball_name+" to staging location "+download_dir
                         Exit(1)
                 else:
                     '''The tarball has to be downloaded in this case from a repo.
                     The possible values of pkg would be mypkg or mypkg-rel_num.
                     '''
-                    print "Error: tarball cannot be downloaded for package specified: "+pkg
-                    Exit(1)
+                    repo=getRepo(self.configs,self.jobs)
+                    if not repo: Exit(1)
+                    rel_num=Repo.parseLabel(pkg)[1]
+                    tarball_path=repo.get(pkg_name,rel_num,download_dir)
+                    if not tarball_path:
+                        print "Error: tarball cannot be downloaded for package specified: "+pkg
+                        Exit(1)
+                    PkgCache.touch(tarball_path)
+                    tarball_name=os.path.basename(tarball_path)
 
-                '''Start installation of the package once the tarball is copied to staging location.'''
-                deploy_inst.installPackage(pkg_name,tarball_name)
-        else:
-            print "Unsupported action: "+self.action
+                tarballs[pkg_name]=tarball_name
 
-'''Class for deployment specific methods'''
-class Deploy():
-    def __init__(self,env_conf,deploy_options,extra_vars=None):
-        self.deploy_ts=str(int(time.time()))
-        self.env_conf=env_conf
-        self.install_root=self.env_conf['basic']['install_root']
-        self.deploy_root=self.install_root+'/installs/'+self.deploy_ts
-        self.opkg_dir=self.env_conf['basic']['opkg_dir']
-        self.download_root=self.opkg_dir + '/pkgs'
-        self.history_dir=self.opkg_dir + '/history'
-        self.extra_vars=extra_vars
+            '''Start installation of the packages once the tarballs are copied to staging location.'''
+            status=deploy_inst.installPackages(tarballs,self.jobs)
+            deploy_inst.pkg_cache.evict()
+            if not status: Exit(1)
+        elif self.action=='rollback':
+            self.extra_vars['ACTION'] = 'rollback'
+            if not self.pkgs:
+                print "Error: Packages to be rolled back are not specified, use --pkg option."
+                Exit(1)
+            deploy_inst=Deploy(self.configs,self.arg_dict,self.extra_vars)
+            status=True
+            for pkg in self.pkgs:
+                pkg_inst=Pkg(Pkg.parseName(pkg)[0])
+                if not pkg_inst.rollback(deploy_inst): status=False
+            if not status: Exit(1)
 
-        self.deploy_force=False
-        if 'force' in deploy_options: self.deploy_force=True
+        elif self.action=='clean':
+            self.extra_vars['ACTION'] = 'clean'
+            deploy_inst=Deploy(self.configs,self.arg_dict,self.extra_vars)
+            count=DEFAULT_CLEAN_COUNT
+            if self.arg_dict.get('count'): count=int(self.arg_dict['count'])
+            if not deploy_inst.clean(self.pkgs,count): Exit(1)
 
-        if not self.extra_vars: self.extra_vars=dict()
-        self.extra_vars['OPKG_NAME'] = None
-        self.extra_vars['OPKG_REL_NUM'] = None
-        self.extra_vars['OPKG_TS'] = None
-        self.extra_vars['OPKG_ACTION'] = None
+        elif self.action=='info':
+            if not self.pkgs:
+                print "Error: Packages to be inspected are not specified, use --pkg option."
+                Exit(1)
+            digest_cache=DigestCache.getInstance(self.opkg_dir+'/meta/'+DIGEST_CACHE_FILE)
+            repo=None
+            for pkg in self.pkgs:
+                pkg_name,rel_num=Repo.parseLabel(pkg)
+                if Codec.getTarballExt(pkg):
+                    info=Pkg.readInfo(pkg_name,pkg,digest_cache)
+                    if not info: Exit(1)
+                    Pkg.printInfo(info,'files' in self.arg_dict)
+                    continue
+                '''A release in the repo is looked up in its index, the tarball is not downloaded'''
+                if not repo: repo=getRepo(self.configs,self.jobs)
+                if not repo: Exit(1)
+                release=repo.resolve(pkg_name,rel_num)
+                if not release: Exit(1)
+                Repo.printRelease(pkg_name,release)
 
-        if not execOSCommand('mkdir -p ' + self.download_root): return
-        if not execOSCommand('mkdir -p ' + self.history_dir): return
+        elif self.action=='put':
+            repo=getRepo(self.configs,self.jobs)
+            if not repo: Exit(1)
+            if not self.arg_dict.get('file'):
+                print "Error: Tarball to be added to the repo is not specified, use --file option."
+                Exit(1)
+            if not repo.put(self.arg_dict['file']): Exit(1)
 
-    '''Returns the extra-vars specified from commandline and the OPKG_ vars'''
-    def getVars(self):
-        return self.extra_vars
+        elif self.action=='get':
+            repo=getRepo(self.configs,self.jobs)
+            if not repo: Exit(1)
+            if not self.pkgs:
+                print "Error: Packages to be downloaded are not specified, use --pkg option."
+                Exit(1)
+            download_dir=self.arg_dict.get('path') or os.getcwd()
+            for pkg in self.pkgs:
+                pkg_name,rel_num=Repo.parseLabel(pkg)
+                if self.arg_dict.get('release'): rel_num=self.arg_dict['release']
+                if not repo.get(pkg_name,rel_num,download_dir): Exit(1)
 
-    def logHistory(self,log_entry):
-        history_log=self.deploy_ts+": "+log_entry
-        history_file=self.env_conf['basic']['deploy_history_file']
-        with open(self.history_dir + '/' + history_file, "a") as hf: hf.write(history_log+"\n")
+        elif self.action=='rls':
+            repo=getRepo(self.configs,self.jobs)
+            if not repo: Exit(1)
+            index=repo.loadIndex()
+            if index is None: Exit(1)
+            pkg_names=self.pkgs or sorted(index.keys())
+            for pkg_name in pkg_names:
+                releases=index.get(pkg_name,dict())
+                for rel_num in sorted(releases,key=lambda r: (releases[r].get('seq',0),releases[r]['ts'])):
+                    print pkg_name+'-'+rel_num
+        elif self.action in RUNTIME_ACTIONS:
+            self.extra_vars['ACTION'] = self.action
+            install_roots=self.getInstallRoots()
+            if install_roots is False: Exit(1)
+            deploy_inst=Deploy(self.configs,self.arg_dict,self.extra_vars,install_roots)
+            status=True
+            for root in deploy_inst.roots:
+                if not root.runPackages(self.action,self.pkgs,self.jobs): status=False
+            if not status: Exit(1)
 
-        return True
+        else:
+            print "Unsupported action: "+self.action
 
-    '''The tarball is downloaded/copied to download_dir'''
-    def installPackage(self,pkg_name,tarball_name):
-        rel_num,rel_ts=Pkg.parseTarballName(tarball_name)
+'''Package repository on a local or NFS mounted directory, repo_path.
+Tarballs are kept as repo_path/pkg_name/tarball_name, and repo_path/index.json lists those as
+pkg_name: rel_num: {tarball, digest, digest_algo, size, ts, seq}, so looking up a package doesn't need a directory scan.
+seq numbers the puts of a package in the order those are done, as several can be done in the same second of ts.
+The index is updated holding an exclusive lock on index.lock, and replaced atomically,
+so that concurrent puts from several hosts don't lose updates, and readers never see a partial index.
+'''
+class Repo():
+    def __init__(self,repo_path,opkg_dir,digest_algo=DEFAULT_DIGEST_ALGO):
+        self.repo_path=repo_path
+        self.index_path=repo_path+'/'+REPO_INDEX_FILE
+        self.digest_algo=digest_algo
+        self.digest_cache=DigestCache.getInstance(opkg_dir+'/meta/'+DIGEST_CACHE_FILE)
 
-        self.extra_vars['OPKG_NAME'] = pkg_name
-        self.extra_vars['OPKG_REL_NUM'] = rel_num
-        self.extra_vars['OPKG_TS'] = rel_ts
+    '''pkg label is mypkg, mypkg-latest, mypkg-dev or mypkg-rel_num. Returns pkg name and rel_num, None for latest'''
+    @staticmethod
+    def parseLabel(pkg_label):
+        pkg_name,pkg_name_rel_num,tarball_name=Pkg.parseName(pkg_label)
+        rel_num=pkg_name_rel_num[len(pkg_name)+1:]
+        if rel_num in ('','latest'): rel_num=None
 
-        pkg=Pkg(pkg_name)
-        pkg.setRelNum(rel_num)
-        pkg.setRelTs(rel_ts)
-        pkg.setEnvConfig(self.env_conf)
-        pkg.loadMeta()
-        tarball_path=self.download_root+'/'+pkg_name+'/'+tarball_name
-        if not pkg.isInstalled(tarball_path) or self.deploy_force:
-            pkg.install(tarball_path,self)
-        else:
-            print "Info: This revision of package "+pkg_name+" is already installed at "+self.install_root+'/installs/'+pkg.getMeta()['latest_install']['deploy_ts']+'/'+pkg_name
-            print "Info: Use --force option to override."
+        return pkg_name,rel_num
+
+    '''Prints the info of a release kept in the index'''
+    @staticmethod
+    def printRelease(pkg_name,release):
+        print "name: "+pkg_name
+        print "rel_num: "+release['rel_num']
+        print "codec: "+release.get('codec','gzip')
+        print "size: "+str(release['size'])
+        print "digest: "+release['digest_algo']+':'+release['digest']
+        if 'depends' in release:
+            print "depends: "+', '.join(release['depends'])
+            print "conflicts: "+', '.join(release['conflicts'])
+        if 'files' in release: print "files: "+str(release['files'])+", "+str(release['content_size'])+" bytes"
+        print "source: repo index, "+release['tarball']
 
         return True
 
-'''Utility classes '''
+    '''Returns the index as a dict, pkg_name: rel_num: release info'''
+    def loadIndex(self):
+        if not os.path.isfile(self.index_path): return dict()
+        try:
+            return json.loads(loadFile(self.index_path))
+        except (EnvironmentError,ValueError) as e:
+            print "Error: Cannot read repo index "+self.index_path+", "+str(e)
+            return None
 
-'''Utility class to do template related tasks'''
-class Tmpl():
-    TMPL_KEY_VAL_DELIM=':'
+    '''Returns the release info of a package, the one put last if rel_num is not given, by seq and by ts for those put before seq was kept.
+    dev is the latest only if there are no other releases.
+    '''
+    def resolve(self,pkg_name,rel_num=None):
+        index=self.loadIndex()
+        if index is None: return None
+        releases=index.get(pkg_name)
+        if not releases:
+            print "Error: Package "+pkg_name+" is not found in the repo."
+            return None
+        if not rel_num:
+            rel_nums=[r for r in releases if r != 'dev'] or releases.keys()
+            rel_num=max(rel_nums,key=lambda r: (releases[r].get('seq',0),releases[r]['ts']))
+        if rel_num not in releases:
+            print "Error: Release "+rel_num+" of package "+pkg_name+" is not found in the repo."
+            return None
+        release=dict(releases[rel_num])
+        release['rel_num']=rel_num
 
-    def __init__(self,tmpl_path):
-        self.tmpl_path=tmpl_path
-        self.is_dir=False
-        if not os.path.exists(tmpl_path):
-            print "Error: " + tmpl_path + " doesn't exist."
-            return
-        if os.path.isdir(tmpl_path): self.is_dir = True
+        return release
+
+    '''Adds a tarball to the repo. The tarball is copied in first and renamed in place with the index updated.'''
+    def put(self,tarball_path):
+        pkg_name,pkg_name_rel_num,tarball_name=Pkg.parseName(tarball_path)
+        if not os.path.isfile(tarball_path):
+            print "Error: "+tarball_path+" doesn't exist."
+            return False
+        info=Pkg.readInfo(pkg_name,tarball_path)
+        if not info: return False
+        manifest=Manifest(tarball_path+':'+info['manifest_name'],info['manifest'])
+        if not manifest.getConfig(): return False
+        rel_num='dev'
+        if pkg_name_rel_num != pkg_name:
+            if not manifest.rel_num: return False
+            rel_num=str(manifest.rel_num)
+            tarball_name=pkg_name+'-'+rel_num+Codec.getTarballExt(tarball_name)
+
+        pkg_dir=self.repo_path+'/'+pkg_name
+        if not makeDirs(pkg_dir): return False
+        repo_tarball_path=pkg_dir+'/'+tarball_name
+        tmp_path=getTempPath(repo_tarball_path)
+        try:
+            digest=copyFileWithDigest(tarball_path,tmp_path,self.digest_algo)
+            release={'tarball':pkg_name+'/'+tarball_name,'digest':digest,'digest_algo':self.digest_algo,
+                     'size':os.path.getsize(tmp_path),'ts':int(time.time()),'codec':info['codec'],
+                     'depends':manifest.getPkgNames('depends'),'conflicts':manifest.getPkgNames('conflicts')}
+            if info['files'] is not None:
+                release['files']=len(info['files'])
+                release['content_size']=sum(f[2] for f in info['files'].values())
+            with open(self.repo_path+'/'+REPO_LOCK_FILE,'a') as lock:
+                fcntl.lockf(lock,fcntl.LOCK_EX)
+                index=self.loadIndex()
+                if index is None: return False
+                os.rename(tmp_path,repo_tarball_path)
+                releases=index.setdefault(pkg_name,dict())
+                release['seq']=max([r.get('seq',0) for r in releases.values()]+[0])+1
+                releases[rel_num]=release
+                if not writeFileAtomic(self.index_path,json.dumps(index,indent=1,sort_keys=True)+'\n'): return False
+        except EnvironmentError as e:
+            print "Error: Couldn't add "+tarball_path+" to the repo, "+str(e)
+            return False
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        print "Info: Added "+pkg_name+'-'+rel_num+" to the repo as "+release['tarball']
+
+        return True
+
+    '''Copies a release of the package to download_dir, verifying its digest on the way.
+    Returns the path of the tarball downloaded.
+    '''
+    def get(self,pkg_name,rel_num,download_dir):
+        release=self.resolve(pkg_name,rel_num)
+        if not release: return None
+        if not makeDirs(download_dir): return None
+        tarball_path=download_dir+'/'+os.path.basename(release['tarball'])
+        if self.isDownloaded(tarball_path,release): return tarball_path
+        tmp_path=getTempPath(tarball_path)
+        try:
+            digest=copyFileWithDigest(self.repo_path+'/'+release['tarball'],tmp_path,release['digest_algo'])
+            if digest != release['digest']:
+                print "Error: Digest of "+release['tarball']+" doesn't match that in the repo index."
+                os.remove(tmp_path)
+                return None
+            os.rename(tmp_path,tarball_path)
+        except EnvironmentError as e:
+            print "Error: Couldn't download "+release['tarball']+", "+str(e)
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+            return None
+        self.digest_cache.update(tarball_path,release['digest_algo'],digest)
+        print "Info: Downloaded "+pkg_name+'-'+release['rel_num']+" to "+tarball_path
+
+        return tarball_path
+
+    '''Checks if the release is downloaded to tarball_path already'''
+    def isDownloaded(self,tarball_path,release):
+        if not os.path.isfile(tarball_path): return False
+        if getCachedDigest(self.digest_cache,tarball_path,release['digest_algo']) != release['digest']: return False
+        print "Info: "+os.path.basename(tarball_path)+" is downloaded already to "+os.path.dirname(tarball_path)
+
+        return True
+
+'''Package repository served over HTTP(S), a web server or an object store bucket, with repo_path as its base url.
+s3://bucket/prefix is accessed as https://bucket.s3.amazonaws.com/prefix.
+It has the same layout as the local repo, and it is read only here, packages are published to it by syncing a local repo.
+Tarballs are downloaded as byte ranges in parallel over persistent connections, into tarball.part along with tarball.part.ranges
+which lists the ranges completed, so that an interrupted download is resumed from there. From a server that doesn't serve
+byte ranges, answering those with the whole file, the tarball is downloaded whole in a single request instead.
+'''
+class HttpRepo(Repo):
+    RANGE_SIZE=8*1024*1024
+    RETRIES=3
+
+    def __init__(self,repo_url,opkg_dir,digest_algo=DEFAULT_DIGEST_ALGO,jobs=1):
+        Repo.__init__(self,repo_url.rstrip('/'),opkg_dir,digest_algo)
+        m=re.match('^s3://([^/]+)(.*)$',self.repo_path)
+        if m: self.repo_path='https://'+m.group(1)+'.s3.amazonaws.com'+m.group(2)
+        self.index_path=self.repo_path+'/'+REPO_INDEX_FILE
+        self.jobs=max(jobs,1)
+        self.pool=HttpConnectionPool()
+
+    def loadIndex(self):
+        try:
+            status,content=self.pool.fetch(self.index_path)
+            if status==404: return dict()
+            if status != 200:
+                print "Error: Cannot read repo index "+self.index_path+", HTTP status "+str(status)
+                return None
+            return json.loads(content)
+        except (httplib.HTTPException,EnvironmentError,ValueError) as e:
+            print "Error: Cannot read repo index "+self.index_path+", "+str(e)
+            return None
+
+    def put(self,tarball_path):
+        print "Error: put is not supported on repo "+self.repo_path+", put the package in a local repo and sync that."
+
+        return False
+
+    def get(self,pkg_name,rel_num,download_dir):
+        release=self.resolve(pkg_name,rel_num)
+        if not release: return None
+        if not makeDirs(download_dir): return None
+        tarball_path=download_dir+'/'+os.path.basename(release['tarball'])
+        if self.isDownloaded(tarball_path,release): return tarball_path
+        url=self.repo_path+'/'+release['tarball']
+        try:
+            digest=self.download(url,tarball_path+'.part',release)
+            if digest is None:
+                print "Error: Couldn't download "+url
+                return None
+            if digest != release['digest']:
+                print "Error: Digest of "+release['tarball']+" doesn't match that in the repo index."
+                removePath(tarball_path+'.part')
+                removePath(tarball_path+'.part.ranges')
+                return None
+            os.rename(tarball_path+'.part',tarball_path)
+            removePath(tarball_path+'.part.ranges')
+        except (httplib.HTTPException,EnvironmentError) as e:
+            print "Error: Couldn't download "+url+", "+str(e)
+            return None
+        self.digest_cache.update(tarball_path,release['digest_algo'],digest)
+        print "Info: Downloaded "+pkg_name+'-'+release['rel_num']+" to "+tarball_path
+
+        return tarball_path
+
+    '''Downloads the ranges not done yet into part_path in parallel, and returns the digest of the whole file.
+    The ranges are hashed in order as they are completed, reading them back from the part file while still in page cache.
+    '''
+    def download(self,url,part_path,release):
+        size=release['size']
+        ranges=[(start,min(start+self.RANGE_SIZE,size)) for start in range(0,size,self.RANGE_SIZE)] or [(0,0)]
+        ranges_path=part_path+'.ranges'
+        done=set()
+        if os.path.isfile(part_path) and os.path.isfile(ranges_path):
+            lines=loadFile(ranges_path).split('\n')
+            if lines[0]==release['digest']:
+                done=set(int(line) for line in lines[1:-1])
+        if not done:
+            with open(part_path,'wb') as f:
+                f.truncate(size)
+            writeFileAtomic(ranges_path,release['digest']+'\n')
+        elif len(done) < len(ranges):
+            print "Info: Resuming download of "+url+", "+str(len(done))+" of "+str(len(ranges))+" ranges done."
+
+        ranges_lock=threading.Lock()
+        no_ranges=threading.Event()
+        '''Returns the range index and True if it's done, False if it failed, or None if the server doesn't serve ranges'''
+        def fetchRange(i):
+            if i in done: return i,True
+            for attempt in range(self.RETRIES):
+                if no_ranges.is_set(): return i,None
+                try:
+                    rc=self.fetchRange(url,part_path,ranges[i],size)
+                    if rc is None: no_ranges.set()
+                    if rc:
+                        with ranges_lock:
+                            with open(ranges_path,'a') as f:
+                                f.write(str(i)+'\n')
+                    return i,rc
+                except (httplib.HTTPException,EnvironmentError) as e:
+                    if attempt==self.RETRIES-1:
+                        print "Error: Download of range "+str(ranges[i])+" of "+url+" failed, "+str(e)
+            return i,False
+
+        hasher=newDigest(release['digest_algo'])
+        completed=set()
+        next_range=0
+        status=True
+        pool=ThreadPool(min(self.jobs,len(ranges)))
+        try:
+            with open(part_path,'rb') as f:
+                for i,rc in pool.imap_unordered(fetchRange,range(len(ranges))):
+                    if rc is None: continue
+                    if not rc:
+                        status=False
+                        continue
+                    completed.add(i)
+                    while status and next_range in completed:
+                        start,end=ranges[next_range]
+                        f.seek(start)
+                        hasher.update(f.read(end-start))
+                        next_range+=1
+        finally:
+            pool.close()
+            pool.join()
+        if no_ranges.is_set():
+            print "Info: "+url+" is not served in byte ranges, downloading it whole."
+            removePath(ranges_path)
+            return self.downloadWhole(url,part_path,release)
+        if not status: return None
+
+        return hasher.hexdigest()
+
+    '''Downloads url into part_path in a single request, returns the digest of the file, None if it fails'''
+    def downloadWhole(self,url,part_path,release):
+        for attempt in range(self.RETRIES):
+            try:
+                conn,resp=self.pool.request('GET',url)
+                try:
+                    if resp.status != 200:
+                        print "Error: Cannot download "+url+", HTTP status "+str(resp.status)
+                        conn.close()
+                        return None
+                    hasher=newDigest(release['digest_algo'])
+                    with open(part_path,'wb') as f:
+                        shutil.copyfileobj(DigestReader(resp,hasher),f,DigestReader.CHUNK_SIZE)
+                        received=f.tell()
+                    if received != release['size']: raise httplib.IncompleteRead('',release['size']-received)
+                except:
+                    conn.close()
+                    raise
+                self.pool.release(url,conn,resp)
+                return hasher.hexdigest()
+            except (httplib.HTTPException,EnvironmentError) as e:
+                if attempt==self.RETRIES-1:
+                    print "Error: Download of "+url+" failed, "+str(e)
+
+        return None
+
+    '''Downloads a byte range of url into the part file.
+    Returns True when it's done, False if the server fails it, or None if the server sends the whole file instead,
+    in which case the connection is closed without reading that.
+    '''
+    def fetchRange(self,url,part_path,byte_range,size):
+        start,end=byte_range
+        headers=dict()
+        if end > start and (start,end) != (0,size): headers['Range']='bytes='+str(start)+'-'+str(end-1)
+        conn,resp=self.pool.request('GET',url,headers)
+        try:
+            if resp.status==200 and 'Range' in headers:
+                conn.close()
+                return None
+            if resp.status not in (200,206):
+                print "Error: Cannot download "+url+", HTTP status "+str(resp.status)
+                conn.close()
+                return False
+            with open(part_path,'r+b') as f:
+                f.seek(start)
+                remaining=end-start
+                while remaining > 0:
+                    data=resp.read(min(DigestReader.CHUNK_SIZE,remaining))
+                    if not data: raise httplib.IncompleteRead(data,remaining)
+                    f.write(data)
+                    remaining-=len(data)
+            resp.read()
+        except:
+            conn.close()
+            raise
+        self.pool.release(url,conn,resp)
+
+        return True
+
+'''Pool of persistent HTTP(S) connections per host, shared across threads'''
+class HttpConnectionPool():
+    TIMEOUT=60
+
+    def __init__(self):
+        self.idle=collections.defaultdict(list)
+        self.lock=threading.Lock()
+
+    '''Sends a request on an idle connection to the host, or a new one. Returns the connection and the response,
+    which has to be read fully and the connection released, or closed on errors.
+    Idle connections that fail are dropped, and the request is tried on the next, and at last on a new connection,
+    whose errors are raised.
+    '''
+    def request(self,method,url,headers=None):
+        parts=urlparse.urlsplit(url)
+        path=parts.path or '/'
+        if parts.query: path+='?'+parts.query
+        while True:
+            conn=None
+            with self.lock:
+                if self.idle[parts.netloc]: conn=self.idle[parts.netloc].pop()
+            '''A connection from the pool might have been closed by the server meanwhile, so it's retried on another one.'''
+            reused=conn is not None
+            if not reused:
+                if parts.scheme=='https': conn=httplib.HTTPSConnection(parts.netloc,timeout=self.TIMEOUT)
+                else: conn=httplib.HTTPConnection(parts.netloc,timeout=self.TIMEOUT)
+            try:
+                conn.request(method,path,headers=headers or dict())
+                return conn,conn.getresponse()
+            except (httplib.HTTPException,socket.error):
+                conn.close()
+                if not reused: raise
+
+    def release(self,url,conn,resp):
+        if resp.will_close:
+            conn.close()
+            return
+        with self.lock:
+            self.idle[urlparse.urlsplit(url).netloc].append(conn)
+
+    '''Returns the status and content of url'''
+    def fetch(self,url):
+        conn,resp=self.request('GET',url)
+        try:
+            content=resp.read()
+        except:
+            conn.close()
+            raise
+        self.release(url,conn,resp)
+
+        return resp.status,content
+
+'''Class for deployment specific methods'''
+class Deploy():
+    '''install_roots is a dict of install_root: extra-vars of it, to deploy to several install roots in a single pass.
+    An install root is deployed to by a Deploy of its own in roots, with the deploy_ts of this one.
+    '''
+    def __init__(self,env_conf,deploy_options,extra_vars=None,install_roots=None,deploy_ts=None):
+        self.deploy_ts=deploy_ts or str(int(time.time()))
+        self.env_conf=env_conf
+        self.install_root=self.env_conf['basic']['install_root']
+        self.deploy_root=self.install_root+'/installs/'+self.deploy_ts
+        self.opkg_dir=self.env_conf['basic']['opkg_dir']
+        self.download_root=self.opkg_dir + '/pkgs'
+        self.history_dir=self.opkg_dir + '/history'
+        self.extra_vars=extra_vars
+
+        store_mode=self.env_conf['basic'].get('object_store',DEFAULT_OBJECT_STORE)
+        if store_mode not in OBJECT_STORE_MODES:
+            print "Warning: Unknown object_store mode "+store_mode+", files will be copied."
+            store_mode='off'
+        elif store_mode == 'hardlink' and not deploy_ts:
+            print "Warning: object_store is hardlink, the deployed files are shared with the object store and the other installations, and must never be modified in place."
+        self.object_store=ObjectStore(self.install_root+'/'+OBJECT_STORE_DIR,self.env_conf['basic']['digest_algo'],store_mode)
+        self.pkg_cache=PkgCache(self.download_root,InstallDB.getInstance(self.env_conf),
+                                parseSize(self.env_conf['basic'].get('pkgs_cache_size',DEFAULT_PKGS_CACHE_SIZE)),
+                                DigestCache.getInstance(self.opkg_dir+'/meta/'+DIGEST_CACHE_FILE),self.env_conf['basic']['digest_algo'])
+
+        self.deploy_force=False
+        if 'force' in deploy_options: self.deploy_force=True
+        self.deploy_profile='profile' in deploy_options
+        self.hook_timeout=self.env_conf['basic'].get('hook_timeout') #default timeout of the hook steps, in seconds
+        '''install, or prepare to leave the installations staged for deploy --activate'''
+        self.deploy_mode='install'
+        if 'prepare' in deploy_options: self.deploy_mode='prepare'
+        self.profile_lock=threading.Lock()
+        self.reserve_lock=threading.Lock()
+        self.deploy_ts_reserved=False
+
+        if not self.extra_vars: self.extra_vars=dict()
+        self.extra_vars['OPKG_NAME'] = None
+        self.extra_vars['OPKG_REL_NUM'] = None
+        self.extra_vars['OPKG_TS'] = None
+        self.extra_vars['OPKG_ACTION'] = None
+
+        '''The install roots share the digests of the files in stage, so those are hashed once'''
+        self.roots=[self]
+        if install_roots:
+            self.roots=list()
+            for install_root in install_roots:
+                root_conf=copy.deepcopy(env_conf)
+                root_conf['basic']['install_root']=install_root
+                root_vars=dict(self.extra_vars)
+                root_vars.update(install_roots[install_root])
+                root=Deploy(root_conf,deploy_options,root_vars,deploy_ts=self.deploy_ts)
+                root.profile_lock=self.profile_lock
+                root.object_store.known=self.object_store.known
+                self.roots.append(root)
+
+        if not makeDirs(self.download_root): return
+        if not makeDirs(self.history_dir): return
+
+    '''Makes deploy_ts unique to this deploy at the install roots, claiming installs/deploy_ts at each of those.
+    A deploy in the same second as another, which has claimed the directory, gets deploy_ts-2, deploy_ts-3 and so on,
+    instead of installing into the directories of the other.
+    '''
+    def reserveDeployTs(self):
+        with self.reserve_lock:
+            if self.deploy_ts_reserved: return True
+            base_ts=self.deploy_ts
+            seq=1
+            while True:
+                deploy_ts=base_ts if seq == 1 else base_ts+'-'+str(seq)
+                claimed=list()
+                for root in self.roots:
+                    if not makeDirs(root.install_root+'/installs'): break
+                    try:
+                        os.mkdir(root.install_root+'/installs/'+deploy_ts)
+                    except OSError as e:
+                        if e.errno != errno.EEXIST:
+                            print "Error: Couldn't create "+root.install_root+'/installs/'+deploy_ts+", "+str(e)
+                            seq=None
+                        break
+                    claimed.append(root)
+                if len(claimed) == len(self.roots): break
+                for root in claimed: os.rmdir(root.install_root+'/installs/'+deploy_ts)
+                if seq is None: return False
+                seq+=1
+            for root in set(self.roots+[self]):
+                root.deploy_ts=deploy_ts
+                root.deploy_root=root.install_root+'/installs/'+deploy_ts
+                root.deploy_ts_reserved=True
+
+        return True
+
+    '''Orders deploy_ts values, those of the deploys in the same second by their sequence number'''
+    @staticmethod
+    def getDeployTsKey(deploy_ts):
+        fields=deploy_ts.split('-')
+        if len(fields) > 2 or not all(field.isdigit() for field in fields): return (0,0)
+
+        return (int(fields[0]),int(fields[1]) if len(fields) == 2 else 1)
+
+    '''Returns the extra-vars specified from commandline and the OPKG_ vars common to the packages'''
+    def getVars(self):
+        return self.extra_vars
+
+    def logHistory(self,log_entry):
+        history_log=self.deploy_ts+": "+log_entry
+        history_file=self.env_conf['basic']['deploy_history_file']
+        with open(self.history_dir + '/' + history_file, "a") as hf: hf.write(history_log+"\n")
+
+        return True
+
+    '''Appends the profile of a package installation to the deploy profile log as a line of JSON.
+    With --profile, the phases are also printed along with the functions that took most time.
+    '''
+    def logProfile(self,profile):
+        profile['deploy_ts']=self.deploy_ts
+        profile['host']=HOST_NAME
+        profile['install_root']=self.install_root
+        profile_file=self.env_conf['basic'].get('deploy_profile_file',DEPLOY_PROFILE_FILE)
+        with self.profile_lock:
+            with open(self.history_dir+'/'+profile_file,'a') as pf: pf.write(json.dumps(profile,sort_keys=True)+'\n')
+            if self.deploy_profile: Profiler.printProfile(profile)
+
+        return True
+
+    '''Installs the packages, a dict of pkg_name: tarball_name, on jobs threads.
+    The order is set by the depends of the packages among them, and a package is skipped if a dependency fails.
+    A package conflicting with another being installed or already installed fails.
+    '''
+    def installPackages(self,tarballs,jobs=1):
+        manifests=dict()
+        for pkg_name in tarballs:
+            manifests[pkg_name]=Pkg.readManifest(pkg_name,self.download_root+'/'+pkg_name+'/'+tarballs[pkg_name],self.pkg_cache.digest_cache)
+            if not manifests[pkg_name] or not manifests[pkg_name].getConfig(): return False
+
+        scheduler=TaskScheduler(jobs)
+        for pkg_name in tarballs:
+            depends=list()
+            for dep in manifests[pkg_name].getPkgNames('depends'):
+                if dep in tarballs:
+                    depends.append(dep)
+                    continue
+                for root in self.roots:
+                    if not root.isPkgInstalled(dep):
+                        print "Warning: Package "+dep+" required by "+pkg_name+" is not installed at "+root.install_root
+            conflicts=[c for c in manifests[pkg_name].getPkgNames('conflicts') if c in tarballs or any(root.isPkgInstalled(c) for root in self.roots)]
+            if conflicts:
+                print "Error: Package "+pkg_name+" conflicts with "+', '.join(conflicts)
+                scheduler.addTask(pkg_name,lambda: False)
+                continue
+            scheduler.addTask(pkg_name,self.installPackage,(pkg_name,tarballs[pkg_name]),depends)
+
+        if not self.reserveDeployTs(): return False
+        '''Objects added to the store are not linked yet until the packages are installed, so they must not be collected meanwhile.'''
+        store_locks=[root.object_store.lock(exclusive=False) for root in self.roots]
+        try:
+            results=scheduler.run()
+        finally:
+            for store_lock in store_locks: store_lock.close()
+        '''The deploy directories claimed are left empty if no package was installed'''
+        for root in self.roots:
+            try:
+                os.rmdir(root.deploy_root)
+            except OSError:
+                pass
+        failed=[p for p in tarballs if results[p] is False]
+        skipped=[p for p in tarballs if results[p] is None]
+        if failed: print "Error: Failed to install "+', '.join(failed)
+        if skipped: print "Error: Skipped "+', '.join(skipped)+" as dependencies failed."
+
+        return not failed and not skipped
+
+    '''Runs start, stop, restart or reload of the packages installed, or of all those at the install root if pkgs is not given.
+    The packages are started and reloaded in the order of their dependencies, and stopped in the reverse order,
+    those independent of each other in parallel on jobs threads. restart stops all the packages, then starts those.
+    A package is not started if any of its dependencies failed to start, nor stopped if any package depending on it failed to stop.
+    '''
+    def runPackages(self,action,pkgs=None,jobs=1):
+        install_db=InstallDB.getInstance(self.env_conf)
+        pkg_names=[Repo.parseLabel(pkg)[0] for pkg in pkgs] if pkgs else None
+        installs=collections.OrderedDict((install['pkg_name'],install) for install in install_db.listInstalled(self.install_root,pkg_names))
+        for pkg_name in pkg_names or list():
+            if pkg_name not in installs:
+                print "Error: Package "+pkg_name+" is not installed at "+self.install_root
+                return False
+        if not installs:
+            print "Info: No packages installed at "+self.install_root
+            return True
+
+        manifests=dict()
+        depends=dict()
+        for pkg_name in installs:
+            if not installs[pkg_name]['manifest']:
+                print "Error: The manifest of the installation of "+pkg_name+" is not recorded, it has to be deployed again."
+                return False
+            manifests[pkg_name]=Manifest(pkg_name+COMPILED_MANIFEST_EXT,installs[pkg_name]['manifest'])
+            if not manifests[pkg_name].getConfig(): return False
+            depends[pkg_name]=[dep for dep in manifests[pkg_name].getPkgNames('depends') if dep in installs]
+
+        for step in (['stop','start'] if action == 'restart' else [action]):
+            scheduler=TaskScheduler(jobs)
+            for pkg_name in installs:
+                if step == 'stop': after=[dependent for dependent in installs if pkg_name in depends[dependent]]
+                else: after=depends[pkg_name]
+                scheduler.addTask(pkg_name,Pkg(pkg_name).runAction,(self,step,manifests[pkg_name]),after)
+            results=scheduler.run()
+            failed=[p for p in installs if results[p] is False]
+            skipped=[p for p in installs if results[p] is None]
+            if failed: print "Error: Failed to "+step+" "+', '.join(failed)
+            if skipped: print "Error: Skipped "+step+" of "+', '.join(skipped)+" as "+('dependent packages' if step == 'stop' else 'dependencies')+" failed."
+            if failed or skipped: return False
+
+        return True
+
+    '''Activates the installations prepared by deploy --prepare, pkgs given as in deploy, all those prepared if not given.
+    Those are activated in the order of the depends among them, on jobs threads, only switching to the prepared
+    trees and running the post-deploy steps. A tarball, or a release, given must be the one prepared.
+    '''
+    def activatePackages(self,pkgs=None,jobs=1):
+        install_db=InstallDB.getInstance(self.env_conf)
+        if not pkgs: pkgs=[prepared['pkg_name'] for prepared in install_db.listPrepared(self.install_root)]
+        if not pkgs:
+            print "Info: No prepared installations to activate at "+self.install_root
+            return True
+
+        prepared=collections.OrderedDict()
+        tarball_paths=dict()
+        for pkg in pkgs:
+            pkg_name,rel_num=Repo.parseLabel(pkg)
+            prepared[pkg_name]=install_db.getPrepared(pkg_name,self.install_root)
+            if not prepared[pkg_name]:
+                print "Error: No prepared installation of "+pkg_name+" found at "+self.install_root+", use deploy --prepare."
+                return False
+            if Codec.getTarballExt(pkg): tarball_paths[pkg_name]=pkg
+            elif rel_num and rel_num != (prepared[pkg_name]['pkg_rel_num'] or 'dev'):
+                print "Error: Release "+rel_num+" of "+pkg_name+" is not the one prepared, "+prepared[pkg_name]['pkg_rel_num']
+                return False
+
+        scheduler=TaskScheduler(jobs)
+        for pkg_name in prepared:
+            manifest=Manifest(pkg_name+COMPILED_MANIFEST_EXT,prepared[pkg_name]['manifest'])
+            if not manifest.getConfig(): return False
+            depends=[dep for dep in manifest.getPkgNames('depends') if dep in prepared]
+            scheduler.addTask(pkg_name,self.activatePackage,(pkg_name,prepared[pkg_name],tarball_paths.get(pkg_name)),depends)
+
+        results=scheduler.run()
+        failed=[p for p in prepared if results[p] is False]
+        skipped=[p for p in prepared if results[p] is None]
+        if failed: print "Error: Failed to activate "+', '.join(failed)
+        if skipped: print "Error: Skipped "+', '.join(skipped)+" as dependencies failed."
+
+        return not failed and not skipped
+
+    def activatePackage(self,pkg_name,prepared,tarball_path=None):
+        pkg_vars=dict(self.extra_vars)
+        pkg_vars['OPKG_NAME'] = pkg_name
+        pkg_vars['OPKG_REL_NUM'] = prepared['pkg_rel_num']
+        pkg_vars['OPKG_TS'] = prepared['pkg_ts']
+
+        pkg=Pkg(pkg_name)
+        pkg.setVars(pkg_vars)
+        pkg.setEnvConfig(self.env_conf)
+        pkg.loadMeta()
+
+        return pkg.activatePrepared(self,prepared,tarball_path)
+
+    def isPkgInstalled(self,pkg_name):
+        return InstallDB.getInstance(self.env_conf).getInstalls(pkg_name,self.install_root)[0] is not None
+
+    '''The tarball is downloaded/copied to download_dir.
+    With several install roots, the tarball is extracted and hashed once into a stage_dir shared by those, files unchanged
+    are carried from the object store, and it's installed at the install roots in parallel, rendering the templates for each.
+    '''
+    def installPackage(self,pkg_name,tarball_name):
+        if not self.reserveDeployTs(): return False
+        tarball_path=self.download_root+'/'+pkg_name+'/'+tarball_name
+        installs=list()
+        for root in self.roots:
+            pkg=root.newPkg(pkg_name,tarball_name)
+            '''An unchanged tarball is found installed from the digest cache without reading it.
+            Otherwise, install checks the digest against the latest installation while extracting the tarball.
+            '''
+            if pkg.isInstalled(tarball_path,compute=False) and not self.deploy_force:
+                print "Info: This revision of package "+pkg_name+" is already installed at "+root.install_root+'/installs/'+pkg.getMeta()['latest_install']['deploy_ts']+'/'+pkg_name
+                print "Info: Use --force option to override."
+                continue
+            installs.append((root,pkg))
+        if not installs: return True
+        if len(installs) == 1: return installs[0][1].install(tarball_path,installs[0][0])
+
+        stage_dir=self.download_root+'/'+pkg_name+'/'+self.deploy_ts
+        if not makeDirs(stage_dir): return False
+        root,pkg=installs[0]
+        pkg_digest=pkg.extract(tarball_path,stage_dir,root.object_store)
+        if not pkg_digest:
+            print "Error: Problem extracting " + tarball_path + " in " + stage_dir
+            self.removeStage(stage_dir)
+            return False
+        for root,root_pkg in installs:
+            root_pkg.pkg_digest=pkg_digest
+            root_pkg.files_written,root_pkg.files_carried=pkg.files_written,pkg.files_carried
+
+        pool=ThreadPool(len(installs))
+        try:
+            results=pool.map(lambda install: install[1].install(tarball_path,install[0],stage_dir),installs)
+        finally:
+            pool.close()
+            pool.join()
+        self.removeStage(stage_dir)
+        failed=[install[0].install_root for install,status in zip(installs,results) if not status]
+        if failed:
+            print "Error: Failed to install "+pkg_name+" at "+', '.join(failed)
+            return False
+
+        return True
+
+    '''Returns the Pkg to install the tarball at the install root of this deploy'''
+    def newPkg(self,pkg_name,tarball_name):
+        rel_num,rel_ts=Pkg.parseTarballName(tarball_name)
+
+        pkg_vars=dict(self.extra_vars)
+        pkg_vars['OPKG_NAME'] = pkg_name
+        pkg_vars['OPKG_REL_NUM'] = rel_num
+        pkg_vars['OPKG_TS'] = rel_ts
+
+        pkg=Pkg(pkg_name)
+        pkg.setRelNum(rel_num)
+        pkg.setRelTs(rel_ts)
+        pkg.setVars(pkg_vars)
+        pkg.setEnvConfig(self.env_conf)
+        pkg.loadMeta()
+
+        return pkg
+
+    '''Removes a stage_dir, unless an installation prepared at an install root is still to be activated from it'''
+    def removeStage(self,stage_dir):
+        if [p for p in InstallDB.getInstance(self.env_conf).listPrepared() if p['stage_dir'] == stage_dir]: return True
+        if not removePath(stage_dir):
+            print "Warning: Couldn't delete " + stage_dir
+            return False
+
+        return True
+
+    '''Removes the installations of the packages, all if pkg_names is not given, except the latest count of those.
+    The active and previous installations, and the one prepared to be activated, are always kept. Then the package cache is trimmed,
+    and the objects no more linked from any installation are removed from the store.
+    '''
+    def clean(self,pkg_names=None,count=DEFAULT_CLEAN_COUNT):
+        install_db=InstallDB.getInstance(self.env_conf)
+        if not pkg_names:
+            pkg_names=[install['pkg_name'] for install in install_db.listInstalled(self.install_root)]
+        installs_dir=self.install_root+'/installs'
+        deploy_tss=sorted(os.listdir(installs_dir),key=Deploy.getDeployTsKey) if os.path.isdir(installs_dir) else list()
+        status=True
+        removed=0
+        for pkg_name in pkg_names:
+            keep=set(install['deploy_ts'] for install in install_db.getInstalls(pkg_name,self.install_root) if install)
+            prepared=install_db.getPrepared(pkg_name,self.install_root)
+            if prepared: keep.add(prepared['deploy_ts'])
+            installs=[ts for ts in deploy_tss if os.path.isdir(installs_dir+'/'+ts+'/'+pkg_name)]
+            if count > 0: keep.update(installs[-count:])
+            for ts in installs:
+                if ts in keep: continue
+                if not removePath(installs_dir+'/'+ts+'/'+pkg_name):
+                    status=False
+                    continue
+                removed+=1
+                try:
+                    os.rmdir(installs_dir+'/'+ts)
+                except OSError:
+                    pass
+        print "Info: Removed "+str(removed)+" installations of "+', '.join(pkg_names or ['no packages'])+"."
+
+        self.pkg_cache.evict()
+        store_lock=self.object_store.lock(exclusive=True)
+        try:
+            deploy_dirs=list()
+            for ts in deploy_tss:
+                if not os.path.isdir(installs_dir+'/'+ts): continue
+                deploy_dirs+=[installs_dir+'/'+ts+'/'+name for name in os.listdir(installs_dir+'/'+ts) if os.path.isdir(installs_dir+'/'+ts+'/'+name)]
+            self.object_store.collectGarbage(deploy_dirs)
+        finally:
+            store_lock.close()
+
+        return status
+
+'''Utility classes '''
+
+'''A step of a hook, a command run in the shell in cwd, killed if it runs longer than timeout seconds, if set.
+The lines it writes to stdout and stderr are streamed to those of opkg, prefixed with label if given, and written to log.
+'''
+class HookStep():
+    POLL_INTERVAL=0.1 #longest wait between checks of the command having exited
+    KILL_GRACE=5 #seconds a command is given to exit on SIGTERM, once timed out, before it's killed
+    READ_GRACE=1 #seconds the output is read for after the command exits, for what its background children write
+    popen_lock=threading.Lock() #preexec_fn isn't safe with processes started concurrently on other threads
+
+    def __init__(self,cmd,timeout=None):
+        self.cmd=cmd
+        self.timeout=timeout
+        self.rc=None
+        self.timed_out=False
+        self.elapsed=0
+
+    '''Runs the command, returns True if it exits with 0. With quiet, the output is not streamed, only written to log.'''
+    def run(self,cwd,label=None,log=None,quiet=False):
+        start=time.time()
+        self.timed_out=False
+        '''The command is run in a session of its own, for the processes it starts to be killed along with it on timeout.
+        It's not let inherit the pipes of the steps run beside it, those would be held open until it exits, as would their output.
+        '''
+        with HookStep.popen_lock:
+            proc=subprocess.Popen(self.cmd,shell=True,cwd=cwd,stdout=subprocess.PIPE,stderr=subprocess.PIPE,preexec_fn=os.setsid,close_fds=True)
+        readers=list()
+        for pipe,out,stream in ((proc.stdout,None if quiet else sys.stdout,'out'),(proc.stderr,None if quiet else sys.stderr,'err')):
+            reader=threading.Thread(target=self.read,args=(pipe,out,stream,label,log))
+            reader.daemon=True
+            reader.start()
+            readers.append(reader)
+        interval=0.005
+        while proc.poll() is None:
+            if self.timeout and time.time()-start > self.timeout:
+                self.timed_out=True
+                self.kill(proc)
+                break
+            time.sleep(interval)
+            interval=min(interval*2,HookStep.POLL_INTERVAL)
+        for reader in readers: reader.join(HookStep.READ_GRACE)
+        self.rc=proc.returncode
+        self.elapsed=time.time()-start
+
+        return self.rc == 0 and not self.timed_out
+
+    def kill(self,proc):
+        try:
+            os.killpg(proc.pid,signal.SIGTERM)
+            deadline=time.time()+HookStep.KILL_GRACE
+            while proc.poll() is None and time.time() < deadline: time.sleep(HookStep.POLL_INTERVAL)
+            if proc.poll() is None: os.killpg(proc.pid,signal.SIGKILL)
+        except OSError:
+            pass
+        proc.wait()
+
+    def read(self,pipe,out,stream,label,log):
+        for line in iter(pipe.readline,''):
+            with Hook.output_lock:
+                if out:
+                    out.write(('['+label+'] ' if label else '')+line)
+                    out.flush()
+                if log: log.write('['+(label+' ' if label else '')+stream+'] '+line)
+        pipe.close()
+
+    '''Returns how the step went, as recorded in the deploy history'''
+    def describe(self):
+        if self.timed_out: status="timed out after "+('%g' % self.timeout)+"s"
+        elif self.rc < 0: status="was killed by signal "+str(-self.rc)
+        else: status="exited with "+str(self.rc)
+
+        return "'"+self.cmd+"' "+status+" in "+('%.2f' % self.elapsed)+"s"
+
+'''Runs the steps of a hook section of a manifest, like pre_deploy and post_deploy, in cwd.
+groups is a list of the groups of steps, run one after the other, as those are listed in the manifest.
+The steps of a group declared with parallel are run concurrently, and the next group is run once all of those are done.
+The steps after one that failed are not run. The output of the steps is written to log_path, if given.
+'''
+class Hook():
+    output_lock=threading.Lock() #the hooks of the packages installed concurrently write their output a line at a time
+
+    def __init__(self,name,groups,cwd,log_path=None):
+        self.name=name
+        self.groups=groups
+        self.cwd=cwd
+        self.log_path=log_path
+        self.steps=list() #the steps run, in the order those are listed in the manifest
+
+    def run(self,profiler=None):
+        log=None
+        if self.log_path:
+            if not makeDirs(os.path.dirname(self.log_path)): return False
+            log=open(self.log_path,'a',1)
+        try:
+            for group in self.groups:
+                self.steps.extend(group)
+                if log:
+                    for step in group: log.write('$ '+step.cmd+'\n')
+                if profiler: profiler.startStep(' & '.join(step.cmd for step in group))
+                Profiler.count('subprocesses',len(group))
+                if len(group) == 1:
+                    statuses=[group[0].run(self.cwd,None,log)]
+                else:
+                    pool=ThreadPool(len(group))
+                    try:
+                        statuses=pool.map(lambda (n,step): step.run(self.cwd,self.name+':'+str(n),log),enumerate(group,1))
+                    finally:
+                        pool.close()
+                if log:
+                    for step in group: log.write('# '+step.describe()+'\n')
+                if not all(statuses): return False
+        finally:
+            if log: log.close()
+
+        return True
+
+'''Runs tasks with dependencies among them on a pool of threads.
+A task is started once all the tasks it depends on have succeeded, and it's skipped if any of those fails or is skipped.
+'''
+class TaskScheduler():
+    def __init__(self,jobs=1):
+        self.jobs=max(1,jobs)
+        self.tasks=collections.OrderedDict() #name: (func,args,depends)
+
+    '''depends are names of other tasks, those not added to the scheduler are ignored'''
+    def addTask(self,name,func,args=(),depends=None):
+        self.tasks[name]=(func,args,depends or list())
+
+    '''Returns a dict of task name: True, False if failed or None if skipped'''
+    def run(self):
+        results=dict()
+        pending=collections.OrderedDict((name,True) for name in self.tasks)
+        running=set()
+        cond=threading.Condition()
+        pool=ThreadPool(min(self.jobs,max(1,len(self.tasks))))
+
+        def runTask(name):
+            func,args,depends=self.tasks[name]
+            try:
+                rc=func(*args)
+            except Exception as e:
+                print "Error: "+name+" failed, "+str(e)
+                rc=False
+            with cond:
+                results[name]=(rc is not False and rc is not None)
+                running.discard(name)
+                cond.notify()
+
+        with cond:
+            while pending or running:
+                for name in pending.keys():
+                    depends=[d for d in self.tasks[name][2] if d in self.tasks]
+                    if [d for d in depends if d in results and results[d] is not True]:
+                        results[name]=None
+                        del pending[name]
+                    elif not [d for d in depends if d not in results]:
+                        del pending[name]
+                        running.add(name)
+                        pool.apply_async(runTask,(name,))
+                if not running and pending:
+                    print "Error: Circular dependency among "+', '.join(pending.keys())
+                    for name in pending: results[name]=False
+                    break
+                if running: cond.wait(1)
+        pool.close()
+        pool.join()
+
+        return results
+
+'''Records the wall time and the work done, bytes read and written, files touched and subprocesses run,
+in each phase of a package installation and each step in those, the entries in the manifest sections.
+The work is counted by the code doing it using Profiler.count, which adds to the profiler of the current thread if any.
+With detail, the functions run are profiled too, which is costly, so it's done only with --profile.
+'''
+class Profiler():
+    COUNTERS=['bytes_read','bytes_written','files','subprocesses']
+    TOP_FUNCTIONS=25
+    current=threading.local()
+
+    def __init__(self,name,detail=False):
+        self.name=name
+        self.detail=detail
+        self.counters=dict.fromkeys(Profiler.COUNTERS,0)
+        self.lock=threading.Lock()
+        self.start=time.time()
+        self.phases=list()
+        self.phase=None
+        self.step=None
+        self.cprofile=None
+
+    @staticmethod
+    def getCurrent():
+        return getattr(Profiler.current,'profiler',None)
+
+    @staticmethod
+    def setCurrent(profiler):
+        Profiler.current.profiler=profiler
+
+    @staticmethod
+    def count(counter,n=1):
+        profiler=Profiler.getCurrent()
+        if not profiler: return
+        with profiler.lock:
+            profiler.counters[counter]+=n
+
+    def activate(self):
+        Profiler.setCurrent(self)
+        if self.detail:
+            self.cprofile=cProfile.Profile()
+            self.cprofile.enable()
+
+    def mark(self,name,key):
+        with self.lock:
+            entry=dict((counter,-n) for counter,n in self.counters.items())
+        entry[key]=name
+        entry['wall']=-time.time()
+
+        return entry
+
+    def close(self,entry):
+        entry['wall']=round(entry['wall']+time.time(),6)
+        with self.lock:
+            for counter,n in self.counters.items(): entry[counter]+=n
+
+    def startPhase(self,name):
+        self.endPhase()
+        self.phase=self.mark(name,'phase')
+        self.phase['steps']=list()
+
+    def endPhase(self):
+        self.endStep()
+        if not self.phase: return
+        self.close(self.phase)
+        self.phases.append(self.phase)
+        self.phase=None
+
+    def startStep(self,name):
+        self.endStep()
+        self.step=self.mark(name,'step')
+
+    def endStep(self):
+        if not self.step: return
+        self.close(self.step)
+        self.phase['steps'].append(self.step)
+        self.step=None
+
+    '''Returns the profile of the installation as a dict'''
+    def finish(self,status):
+        self.endPhase()
+        Profiler.setCurrent(None)
+        profile={'pkg_name':self.name,'status':status,'wall':round(time.time()-self.start,6),'phases':self.phases}
+        profile.update(self.counters)
+        if self.cprofile:
+            self.cprofile.disable()
+            stats=pstats.Stats(self.cprofile,stream=StringIO.StringIO())
+            functions=list()
+            for (file_name,line,func),(cc,nc,tottime,cumtime,callers) in stats.stats.items():
+                functions.append({'function':file_name+':'+str(line)+'('+func+')','calls':nc,
+                                  'tottime':round(tottime,6),'cumtime':round(cumtime,6)})
+            profile['functions']=sorted(functions,key=lambda f: f['cumtime'],reverse=True)[:Profiler.TOP_FUNCTIONS]
+
+        return profile
+
+    @staticmethod
+    def printProfile(profile):
+        print "Profile of "+profile['pkg_name']+" installation, "+str(profile['wall'])+"s:"
+        print '  %-40s %10s %12s %12s %8s %6s' % ('phase/step','wall(s)','read','written','files','procs')
+        for phase in profile['phases']:
+            for entry,indent in [(phase,'')]+[(step,'  ') for step in phase['steps']]:
+                name=entry.get('phase') or entry.get('step')
+                print '  %-40s %10.3f %12d %12d %8d %6d' % ((indent+name)[:40],entry['wall'],entry['bytes_read'],
+                                                          entry['bytes_written'],entry['files'],entry['subprocesses'])
+        for function in profile.get('functions',list()):
+            print '  %10.3f %10.3f %8d  %s' % (function['cumtime'],function['tottime'],function['calls'],function['function'])
+
+'''Utility class to do template related tasks'''
+class Tmpl():
+    TMPL_KEY_VAL_DELIM=':'
+    TMPL_VAR_PATTERN=re.compile(r'(\{\{\s*(\w+)\s*\}\})')
+    TMPL_JOBS=min(8,CPU_COUNT) #threads to process files in a directory
+    BINARY_CHECK_SIZE=8192
+
+    compiled=dict() #content digest: compiled template
+    compiled_lock=threading.Lock()
+    pool=None #shared by all the templates, as joining a pool takes up to 0.1s in Python 2
+    pool_lock=threading.Lock()
+
+    def __init__(self,tmpl_path):
+        self.tmpl_path=tmpl_path
+        self.is_dir=False
+        if not os.path.exists(tmpl_path):
+            print "Error: " + tmpl_path + " doesn't exist."
+            return
+        if os.path.isdir(tmpl_path): self.is_dir = True
+
+    '''Returns the files under tmpl_path, recursively if it's a directory'''
+    def getFiles(self):
+        if not self.is_dir: return [self.tmpl_path]
+        files=list()
+        for root,dirs,names in os.walk(self.tmpl_path):
+            for name in sorted(names):
+                if not os.path.islink(root+'/'+name): files.append(root+'/'+name)
+
+        return files
+
+    '''Runs func on each file under tmpl_path, on a pool of threads if there are many, returns False if any fails'''
+    def processFiles(self,func,*args):
+        files=self.getFiles()
+        if len(files) < 2:
+            results=[func(f,*args) for f in files]
+        else:
+            with Tmpl.pool_lock:
+                if not Tmpl.pool: Tmpl.pool=ThreadPool(Tmpl.TMPL_JOBS)
+            profiler=Profiler.getCurrent()
+            def processFile(f):
+                Profiler.setCurrent(profiler)
+                return func(f,*args)
+            results=Tmpl.pool.map(processFile,files)
+
+        return False not in results
 
     '''Recreates files under tmpl_path with values from vars_dict
-    The template vars are searched for using pattern {{ var }}
+    The template vars are searched for using pattern {{ var }}, spaces around var are optional.
     tmpl_path could be single file or a directory, 
     in the latter case all files in the dir will be checked for recursively.
     '''
-    def resolveVars(self,vars_dict,backup=False):
-        if self.is_dir:
-            files=os.listdir(self.tmpl_path)
-            for f in files:
-                ftmpl=Tmpl(self.tmpl_path+'/'+f)
-                ftmpl.resolveVars(vars_dict,backup)
+    def resolveVars(self,vars_dict,backup=False):
+        if not self.processFiles(self.resolveVarsFile,vars_dict,backup):
+            print "Error: Failed to resolve template "+self.tmpl_path
+            return False
+
+        return True
+
+    '''Recreates files under tmpl_path with values from vars_list
+    vars_list contains a search/replace pair SEARCH-STR:REPLACE-STR, the file is updated by replacing all SEARCH-STR with REPLACE-STR
+    tmpl_path could be single file or a directory, 
+    in the latter case all files in the dir will be checked for recursively.
+    '''
+    def replaceTokens (self,tokens_list,backup=False):
+        tokens=list()
+        for token in tokens_list:
+            pattern, replace = re.split(Tmpl.TMPL_KEY_VAL_DELIM,token)
+            tokens.append((re.compile(pattern),replace))
+        if not self.processFiles(self.replaceTokensFile,tokens,backup):
+            print "Error: Failed to resolve template " + self.tmpl_path
+            return False
+
+        return True
+
+    '''Splits the template content on the vars in one scan, the compiled template is cached by content digest.
+    It's a list of literal text, var token and var name, repeated, and ending with literal text.
+    '''
+    @staticmethod
+    def compile(content):
+        key=hashlib.md5(content).hexdigest()
+        with Tmpl.compiled_lock:
+            parts=Tmpl.compiled.get(key)
+        if parts is None:
+            parts=Tmpl.TMPL_VAR_PATTERN.split(content)
+            with Tmpl.compiled_lock:
+                Tmpl.compiled[key]=parts
+
+        return parts
+
+    '''Resolves the vars in the strings in obj, a parsed manifest, returns a copy of obj with those'''
+    @staticmethod
+    def renderObject(obj,vars_dict):
+        if isinstance(obj,dict):
+            return dict((Tmpl.renderObject(k,vars_dict),Tmpl.renderObject(v,vars_dict)) for k,v in obj.items())
+        if isinstance(obj,list):
+            return [Tmpl.renderObject(item,vars_dict) for item in obj]
+        if isinstance(obj,basestring) and '{{' in obj:
+            return Tmpl.render(Tmpl.TMPL_VAR_PATTERN.split(obj),vars_dict)
+
+        return obj
+
+    '''Substitutes all the vars in a single pass, vars with no value are left as is'''
+    @staticmethod
+    def render(parts,vars_dict):
+        out=[parts[0]]
+        for i in range(1,len(parts),3):
+            val=vars_dict.get(parts[i+1])
+            if val: out.append(str(val))
+            else: out.append(parts[i])
+            out.append(parts[i+2])
+
+        return ''.join(out)
+
+    def resolveVarsFile(self,file_path, vars_dict, backup=False):
+        file_st = os.stat(file_path)
+        content = loadFile(file_path)
+        Profiler.count('bytes_read',len(content))
+        if '\0' in content[:Tmpl.BINARY_CHECK_SIZE]: return True
+        parts = Tmpl.compile(content)
+        if len(parts) == 1: return True
+        return self.saveFile(file_path,Tmpl.render(parts,vars_dict),file_st,backup)
+
+    def replaceTokensFile(self,file_path, tokens, backup=False):
+        file_st = os.stat(file_path)
+        content = loadFile(file_path)
+        Profiler.count('bytes_read',len(content))
+        for pattern, replace in tokens:
+            content = pattern.sub(replace, content)
+        return self.saveFile(file_path,content,file_st,backup)
+
+    def saveFile(self,file_path,content,file_st,backup=False):
+        if backup:
+            if not movePath(file_path,file_path + '.' + str(int(time.time()))):
+                print "Error: Couldn't backup " + file_path
+                return False
+        '''The file is replaced, not rewritten in place, as it may be a link to an object in the store.'''
+        if not writeFileAtomic(file_path,content,file_st):
+            print "Error: Cannot save updated " + file_path
+            return False
+        Profiler.count('files')
+        Profiler.count('bytes_written',len(content))
+
+        return True
+
+'''File-like object writing a single gzip member, compressed pigz style.
+The input is cut into blocks which are deflated independently on a pool of threads,
+each block ending with a sync flush on a byte boundary, so the blocks concatenate into
+a regular deflate stream that gzip and tar xzf can read.
+'''
+class ParallelGzipFile():
+    BLOCK_SIZE=1024*1024
+
+    def __init__(self,fileobj,jobs=1,level=6):
+        self.fileobj=fileobj
+        self.jobs=max(1,jobs)
+        self.level=level
+        self.pool=None
+        if self.jobs > 1: self.pool=ThreadPool(self.jobs)
+        self.pending=collections.deque()
+        self.buf=list()
+        self.buf_len=0
+        self.crc=0
+        self.size=0
+        self.closed=False
+
+        '''gzip header: magic, deflate, no flags, no mtime, unix'''
+        self.fileobj.write(struct.pack('<BBBBIBB',0x1f,0x8b,8,0,0,0,3))
+
+    def write(self,data):
+        self.crc=zlib.crc32(data,self.crc)
+        self.size+=len(data)
+        self.buf.append(data)
+        self.buf_len+=len(data)
+        if self.buf_len >= ParallelGzipFile.BLOCK_SIZE:
+            data=''.join(self.buf)
+            while len(data) >= ParallelGzipFile.BLOCK_SIZE:
+                self.submitBlock(data[:ParallelGzipFile.BLOCK_SIZE],False)
+                data=data[ParallelGzipFile.BLOCK_SIZE:]
+            self.buf=[data]
+            self.buf_len=len(data)
+
+    '''Blocks are written out in order, only 2 blocks per thread are kept in flight to bound memory use.'''
+    def submitBlock(self,block,last):
+        if not self.pool:
+            self.fileobj.write(deflateBlock(block,self.level,last))
+            return
+        self.pending.append(self.pool.apply_async(deflateBlock,(block,self.level,last)))
+        while len(self.pending) > 2*self.jobs:
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        if self.closed: return
+        self.submitBlock(''.join(self.buf),True)
+        self.buf=list()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().get())
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+        self.fileobj.write(struct.pack('<II',self.crc & 0xffffffff,self.size & 0xffffffff))
+        self.closed=True
+
+'''Compression codecs of package tarballs, chosen in create as codec[:level], like xz:9.
+The codec of a tarball is detected from the magic bytes at its head on install, whatever its name is.
+xz and zstd use the backports.lzma and zstandard modules if installed, or else the xz and zstd commands.
+'''
+class Codec():
+    DEFAULT='gzip'
+    CODECS={
+        'gzip':{'ext':'.tgz','magic':'\x1f\x8b','levels':(1,9),'level':6},
+        'bz2':{'ext':'.tbz2','magic':'BZh','levels':(1,9),'level':9},
+        'xz':{'ext':'.txz','magic':'\xfd7zXZ\x00','levels':(0,9),'level':6},
+        'zstd':{'ext':'.tzst','magic':'\x28\xb5\x2f\xfd','levels':(1,19),'level':3},
+        'none':{'ext':'.tar','magic':None,'levels':None,'level':None}
+    }
+    ALIASES={'gz':'gzip','bzip2':'bz2','lzma':'xz','zst':'zstd','tar':'none'}
+    MODULES={'xz':('backports.lzma',),'zstd':('zstandard',)}
+    HEAD_SIZE=512
+
+    def __init__(self,name,level=None):
+        self.name=name
+        self.level=level
+        if self.level is None: self.level=Codec.CODECS[name]['level']
+        self.ext=Codec.CODECS[name]['ext']
+        self.reader=None
+
+    '''Returns the codec for spec, codec[:level], None if it's not valid'''
+    @staticmethod
+    def parse(spec):
+        name,level=(str(spec).split(':',1)+[None])[:2]
+        name=Codec.ALIASES.get(name,name)
+        if name not in Codec.CODECS:
+            print "Error: Unknown codec "+name+", use one of "+', '.join(sorted(Codec.CODECS))
+            return None
+        levels=Codec.CODECS[name]['levels']
+        if level is not None:
+            if not levels or not level.isdigit() or not levels[0] <= int(level) <= levels[1]:
+                print "Error: Invalid level "+level+" for codec "+name+(", use "+str(levels[0])+'-'+str(levels[1]) if levels else '')
+                return None
+            level=int(level)
+
+        return Codec(name,level)
+
+    '''Returns the codec of a tarball from its head, None if it's not a tarball'''
+    @staticmethod
+    def detect(head):
+        for name in Codec.CODECS:
+            magic=Codec.CODECS[name]['magic']
+            if magic and head.startswith(magic): return Codec(name)
+        if head[257:262] == 'ustar': return Codec('none')
+
+        return None
+
+    '''Returns the extension of the tarball name, one of those of the codecs, or None'''
+    @staticmethod
+    def getTarballExt(tarball_name):
+        for name in Codec.CODECS:
+            if tarball_name.endswith(Codec.CODECS[name]['ext']): return Codec.CODECS[name]['ext']
+
+        return None
+
+    @staticmethod
+    def getTarballExts():
+        return [Codec.CODECS[name]['ext'] for name in sorted(Codec.CODECS)]
+
+    def getModule(self):
+        for module_name in Codec.MODULES.get(self.name,()):
+            module=importOptional(module_name)
+            if module: return module
+
+        return None
+
+    '''Returns the command line of the xz or zstd command, raises IOError if the command is not found'''
+    def getCommand(self,args):
+        cmd=findCommand(self.name)
+        if not cmd: raise IOError("Codec "+self.name+" is not available, install "+' or '.join(Codec.MODULES[self.name])+" module, or "+self.name+" command")
+
+        return [cmd]+args
+
+    '''Returns a file-like object compressing the data written to it into fileobj, on jobs threads where supported.
+    The output doesn't depend on jobs, so xz is run single-threaded, as its multi-threaded output differs from that.
+    '''
+    def openWriter(self,fileobj,jobs=1):
+        if self.name == 'gzip': return ParallelGzipFile(fileobj,jobs,self.level)
+        if self.name == 'bz2': return CompressorWriter(fileobj,bz2.BZ2Compressor(self.level))
+        if self.name == 'none': return CompressorWriter(fileobj)
+        module=self.getModule()
+        if self.name == 'xz':
+            if module: return CompressorWriter(fileobj,module.LZMACompressor(preset=self.level))
+            return PipeWriter(self.getCommand(['-z','-c','-q','-'+str(self.level),'-T1']),fileobj)
+        if module: return CompressorWriter(fileobj,module.ZstdCompressor(level=self.level,threads=jobs).compressobj())
+        return PipeWriter(self.getCommand(['-c','-q','-'+str(self.level),'-T'+str(jobs)]),fileobj)
+
+    '''Opens a tar stream on fileobj compressed with the codec, close the codec once done with the stream'''
+    def openTar(self,fileobj):
+        if self.name == 'gzip': return tarfile.open(mode='r|gz',fileobj=fileobj)
+        if self.name == 'bz2': return tarfile.open(mode='r|bz2',fileobj=fileobj)
+        if self.name == 'none': return tarfile.open(mode='r|',fileobj=fileobj)
+        module=self.getModule()
+        if self.name == 'xz':
+            if module: self.reader=DecompressorReader(fileobj,module.LZMADecompressor())
+            else: self.reader=PipeReader(self.getCommand(['-d','-c','-q']),fileobj)
+        elif module: self.reader=DecompressorReader(fileobj,module.ZstdDecompressor().decompressobj())
+        else: self.reader=PipeReader(self.getCommand(['-d','-c','-q']),fileobj)
+
+        return tarfile.open(mode='r|',fileobj=self.reader)
+
+    def close(self):
+        if self.reader: self.reader.close()
+        self.reader=None
+
+    '''Opens the tarball at path detecting its codec, returns the codec and the file positioned at its start'''
+    @staticmethod
+    def openTarball(tarball_path):
+        f=open(tarball_path,'rb')
+        codec=Codec.detect(f.read(Codec.HEAD_SIZE))
+        if not codec:
+            f.close()
+            raise IOError("Unknown format of tarball "+tarball_path)
+        f.seek(0)
+
+        return codec,f
+
+'''File-like object writing the data compressed with compressor, one with compress and flush methods, to fileobj.
+The data is written as is if there is no compressor.
+'''
+class CompressorWriter():
+    def __init__(self,fileobj,compressor=None):
+        self.fileobj=fileobj
+        self.compressor=compressor
+
+    def write(self,data):
+        if self.compressor: data=self.compressor.compress(data)
+        if data: self.fileobj.write(data)
+
+    def close(self):
+        if self.compressor: self.fileobj.write(self.compressor.flush())
+        self.compressor=None
+
+'''File-like object reading the data from fileobj decompressed with decompressor, one with a decompress method.
+The data decompressed is kept as a list of chunks, and data is decompressed only as it's read. With a decompressor
+taking max_length, like those of zlib and lzma, at most OUTPUT_SIZE bytes are decompressed at a time.
+'''
+class DecompressorReader():
+    OUTPUT_SIZE=1024*1024
+
+    def __init__(self,fileobj,decompressor):
+        self.fileobj=fileobj
+        self.decompressor=decompressor
+        self.chunks=collections.deque()
+        self.offset=0 #read offset in the first chunk
+        self.size=0 #bytes decompressed and not read yet
+        self.tail='' #input not consumed by a decompressor with unconsumed_tail
+
+    '''Decompresses the next piece of the data, returns False at the end of it'''
+    def fill(self):
+        decompressor=self.decompressor
+        if hasattr(decompressor,'unconsumed_tail'):
+            data=self.tail or self.fileobj.read(DigestReader.CHUNK_SIZE)
+            if not data: return False
+            out=decompressor.decompress(data,DecompressorReader.OUTPUT_SIZE)
+            self.tail=decompressor.unconsumed_tail
+        elif hasattr(decompressor,'needs_input'):
+            if getattr(decompressor,'eof',False): return False
+            data=self.fileobj.read(DigestReader.CHUNK_SIZE) if decompressor.needs_input else ''
+            if decompressor.needs_input and not data: return False
+            out=decompressor.decompress(data,DecompressorReader.OUTPUT_SIZE)
         else:
-            if not self.resolveVarsFile(self.tmpl_path,vars_dict,backup):
-                print "Error: Failed to resolve template "+self.tmpl_path
-                return False
+            data=self.fileobj.read(DigestReader.CHUNK_SIZE)
+            if not data: return False
+            out=decompressor.decompress(data)
+        if out:
+            self.chunks.append(out)
+            self.size+=len(out)
 
         return True
 
-    '''Recreates files under tmpl_path with values from vars_list
-    vars_list contains a search/replace pair SEARCH-STR:REPLACE-STR, the file is updated by replacing all SEARCH-STR with REPLACE-STR
-    tmpl_path could be single file or a directory, 
-    in the latter case all files in the dir will be checked for recursively.
+    def read(self,size=-1):
+        while size < 0 or self.size < size:
+            if not self.fill(): break
+        if size < 0 or size > self.size: size=self.size
+        parts=list()
+        left=size
+        while left:
+            chunk=self.chunks[0]
+            available=len(chunk)-self.offset
+            if available <= left:
+                parts.append(chunk[self.offset:] if self.offset else chunk)
+                self.chunks.popleft()
+                self.offset=0
+                left-=available
+            else:
+                parts.append(chunk[self.offset:self.offset+left])
+                self.offset+=left
+                left=0
+        self.size-=size
+
+        return ''.join(parts)
+
+    def close(self):
+        self.chunks.clear()
+        self.offset,self.size,self.tail=0,0,''
+
+'''File-like object writing the data to the stdin of cmd, a compressor, whose output is copied to fileobj on a thread'''
+class PipeWriter():
+    def __init__(self,cmd,fileobj):
+        Profiler.count('subprocesses')
+        self.cmd=cmd
+        self.proc=subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,close_fds=True)
+        self.error=None
+        self.drainer=threading.Thread(target=self.drain,args=(fileobj,))
+        self.drainer.daemon=True
+        self.drainer.start()
+
+    def drain(self,fileobj):
+        try:
+            while True:
+                data=self.proc.stdout.read(DigestReader.CHUNK_SIZE)
+                if not data: break
+                fileobj.write(data)
+        except IOError as e:
+            self.error=e
+
+    def write(self,data):
+        self.proc.stdin.write(data)
+
+    def close(self):
+        if not self.proc: return
+        self.proc.stdin.close()
+        self.drainer.join()
+        rc=self.proc.wait()
+        self.proc=None
+        if self.error: raise self.error
+        if rc != 0: raise IOError(' '.join(self.cmd)+" failed with exit code "+str(rc))
+
+'''File-like object reading the output of cmd, a decompressor which is fed the data read from fileobj on a thread.
+The data is read from fileobj till its end, for the digest of a DigestReader to cover the whole of it.
+'''
+class PipeReader():
+    def __init__(self,cmd,fileobj):
+        Profiler.count('subprocesses')
+        self.cmd=cmd
+        self.proc=subprocess.Popen(cmd,stdin=subprocess.PIPE,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
+        self.eof=False
+        self.feeder=threading.Thread(target=self.feed,args=(fileobj,))
+        self.feeder.daemon=True
+        self.feeder.start()
+
+    def feed(self,fileobj):
+        try:
+            while True:
+                data=fileobj.read(DigestReader.CHUNK_SIZE)
+                if not data: break
+                self.proc.stdin.write(data)
+        except IOError:
+            '''The reader has stopped reading, like when only the manifest is read'''
+            pass
+        finally:
+            try:
+                self.proc.stdin.close()
+            except IOError:
+                pass
+
+    def read(self,size=-1):
+        data=self.proc.stdout.read() if size < 0 else self.proc.stdout.read(size)
+        if not data: self.eof=True
+
+        return data
+
+    '''Fails if cmd failed, unless the output was not read to its end, when cmd fails writing to the pipe closed'''
+    def close(self):
+        if not self.proc: return
+        self.proc.stdout.close()
+        self.feeder.join()
+        errors=self.proc.stderr.read().strip()
+        rc=self.proc.wait()
+        self.proc=None
+        if rc != 0 and self.eof: raise IOError(' '.join(self.cmd)+" failed with exit code "+str(rc)+(", "+errors if errors else ''))
+
+'''File-like wrapper on a file being written, which updates digest with the data written through it'''
+class DigestWriter():
+    def __init__(self,fileobj,digest):
+        self.fileobj=fileobj
+        self.digest=digest
+
+    def write(self,data):
+        self.digest.update(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+'''File-like wrapper on a file being read, which updates digest with the data read through it'''
+class DigestReader():
+    CHUNK_SIZE=1024*1024
+
+    def __init__(self,fileobj,digest):
+        self.fileobj=fileobj
+        self.digest=digest
+
+    def read(self,size=-1):
+        data=self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+    '''Reads to the end of file, for the digest to cover the data the consumer didn't read, like tar padding'''
+    def drain(self):
+        while self.read(DigestReader.CHUNK_SIZE): pass
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+'''Persistent cache of file digests, so an unchanged file is not hashed again.
+An entry is valid as long as the path has the same identity, inode, size and mtime, as when it was hashed.
+The cache file has one entry per line: path,inode,size,mtime,algo,digest delimited by tabs.
+'''
+class DigestCache():
+    DELIM='\t'
+    instances=dict()
+    instances_lock=threading.Lock()
+
+    '''The packages installed concurrently share the cache instance, for updates from those not to be lost'''
+    @staticmethod
+    def getInstance(cache_file):
+        with DigestCache.instances_lock:
+            if cache_file not in DigestCache.instances: DigestCache.instances[cache_file]=DigestCache(cache_file)
+            return DigestCache.instances[cache_file]
+
+    def __init__(self,cache_file):
+        self.cache_file=cache_file
+        self.entries=None
+        self.updates=dict() #entries updated since loaded, merged with those in the cache file on save
+        self.lock=threading.Lock()
+
+    def load(self):
+        self.entries=dict()
+        if not os.path.isfile(self.cache_file): return
+        for line in loadFile(self.cache_file).splitlines():
+            fields=line.split(DigestCache.DELIM)
+            if len(fields) != 6: continue
+            path,ino,size,mtime,algo,digest=fields
+            self.entries[(path,algo)]=(ino,size,mtime,digest)
+
+    @staticmethod
+    def fileIdentity(st):
+        return str(st.st_ino),str(st.st_size),repr(st.st_mtime)
+
+    def lookup(self,file_path,algo):
+        file_path=os.path.abspath(file_path)
+        try:
+            st=os.stat(file_path)
+        except OSError:
+            return None
+        with self.lock:
+            if self.entries is None: self.load()
+            entry=self.entries.get((file_path,algo))
+        if not entry or entry[:3] != DigestCache.fileIdentity(st): return None
+
+        return entry[3]
+
+    '''st is the stat of the file taken before it was hashed, if not given it's taken now.'''
+    def update(self,file_path,algo,digest,st=None):
+        file_path=os.path.abspath(file_path)
+        if not st: st=os.stat(file_path)
+        with self.lock:
+            if self.entries is None: self.load()
+            self.entries[(file_path,algo)]=DigestCache.fileIdentity(st)+(digest,)
+            self.updates[(file_path,algo)]=self.entries[(file_path,algo)]
+            return self.save()
+
+    '''Entries of files that are gone are dropped on save.
+    The cache file is loaded again under a lock before it's written, for the updates of other processes,
+    like the workers of a parallel create, not to be lost.
     '''
-    def replaceTokens (self,tokens_list,backup=False):
-        if self.is_dir:
-            files = os.listdir(self.tmpl_path)
-            for f in files:
-                fpath = self.tmpl_path + '/' + f
-                ftmpl = Tmpl(fpath)
-                ftmpl.replaceTokens(tokens_list,backup)
+    def save(self):
+        cache_dir=os.path.dirname(self.cache_file)
+        if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+        with open(self.cache_file+'.lock','a') as lock:
+            fcntl.lockf(lock,fcntl.LOCK_EX)
+            self.load()
+            self.entries.update(self.updates)
+            return self.write()
+
+    def write(self):
+        lines=list()
+        for (path,algo),(ino,size,mtime,digest) in sorted(self.entries.items()):
+            if not os.path.exists(path): continue
+            lines.append(DigestCache.DELIM.join([path,ino,size,mtime,algo,digest]))
+
+        return writeFileAtomic(self.cache_file,'\n'.join(lines)+'\n')
+
+'''Install state of the packages in a SQLite db, opkg_dir/meta/installs.db.
+installs has every installation of a package at an install root, with its per-file manifest, and packages points to
+the latest and previous of those, both updated in a single transaction as a package is installed. The db is in WAL mode, so readers don't wait on a writer.
+Latest.meta and Previous.meta files used earlier are migrated as the db is created.
+'''
+class InstallDB():
+    SCHEMA_VERSION=4
+    TIMEOUT=60
+    COLUMNS=['pkg_name','pkg_rel_num','pkg_ts','pkg_digest','deploy_ts','digest_algo','manifest','files']
+    instances=dict()
+    instances_lock=threading.Lock()
+
+    @staticmethod
+    def getInstance(env_conf):
+        opkg_dir=env_conf['basic']['opkg_dir']
+        with InstallDB.instances_lock:
+            if opkg_dir not in InstallDB.instances: InstallDB.instances[opkg_dir]=InstallDB(opkg_dir,env_conf['basic'].get('install_root'))
+            return InstallDB.instances[opkg_dir]
+
+    '''install_root is where the installations in the .meta files migrated are taken to be, those don't have it.'''
+    def __init__(self,opkg_dir,install_root=None):
+        self.meta_dir=opkg_dir+'/meta'
+        self.install_root=install_root
+        self.db_path=self.meta_dir+'/'+INSTALL_DB_FILE
+        self.ready=False
+        self.lock=threading.Lock()
+
+    '''Returns a new connection, sqlite connections are not shared across threads'''
+    def connect(self):
+        with self.lock:
+            if not self.ready:
+                makeDirs(self.meta_dir)
+                conn=sqlite3.connect(self.db_path,timeout=InstallDB.TIMEOUT)
+                conn.execute('PRAGMA journal_mode=WAL')
+                if conn.execute('PRAGMA user_version').fetchone()[0] < InstallDB.SCHEMA_VERSION:
+                    self.createSchema(conn)
+                conn.close()
+                self.ready=True
+        conn=sqlite3.connect(self.db_path,timeout=InstallDB.TIMEOUT)
+        conn.row_factory=sqlite3.Row
+
+        return conn
+
+    def createSchema(self,conn):
+        with conn:
+            conn.execute('BEGIN EXCLUSIVE')
+            version=conn.execute('PRAGMA user_version').fetchone()[0]
+            if version >= InstallDB.SCHEMA_VERSION: return
+            '''manifest is the resolved manifest of an installation, used to run its rollback steps, and files its per-file manifest'''
+            conn.execute('''CREATE TABLE IF NOT EXISTS installs (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                install_root TEXT NOT NULL, pkg_name TEXT NOT NULL, pkg_rel_num TEXT, pkg_ts TEXT,
+                pkg_digest TEXT, deploy_ts TEXT, digest_algo TEXT, manifest TEXT, files TEXT)''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS packages (install_root TEXT NOT NULL, pkg_name TEXT NOT NULL,
+                latest_id INTEGER REFERENCES installs(id), previous_id INTEGER REFERENCES installs(id),
+                PRIMARY KEY (install_root,pkg_name))''')
+            conn.execute('CREATE INDEX IF NOT EXISTS installs_pkg ON installs (install_root,pkg_name)')
+            '''Installations prepared by deploy --prepare and not activated yet, the record has the rest of those'''
+            conn.execute('''CREATE TABLE IF NOT EXISTS prepared (install_root TEXT NOT NULL, pkg_name TEXT NOT NULL,
+                deploy_ts TEXT, pkg_digest TEXT, digest_algo TEXT, record TEXT, PRIMARY KEY (install_root,pkg_name))''')
+            self.migrateMetaFiles(conn)
+            conn.execute('PRAGMA user_version='+str(InstallDB.SCHEMA_VERSION))
+
+    def migrateMetaFiles(self,conn):
+        if not os.path.isdir(self.meta_dir) or not self.install_root: return
+        install_root=self.install_root
+        migrated=0
+        for pkg_name in sorted(os.listdir(self.meta_dir)):
+            if not os.path.isdir(self.meta_dir+'/'+pkg_name): continue
+            installs=[Pkg(pkg_name).loadMetaFile(self.meta_dir+'/'+pkg_name+'/'+f) for f in (META_FILE_PREVIOUS,META_FILE_LATEST)]
+            if not installs[1]: continue
+            ids=[self.insertInstall(conn,install,install_root) if install else None for install in installs]
+            conn.execute('INSERT OR REPLACE INTO packages VALUES (?,?,?,?)',(install_root,pkg_name,ids[1],ids[0]))
+            migrated+=1
+        if migrated: print "Info: Migrated the install meta of "+str(migrated)+" packages to "+self.db_path
+
+    def insertInstall(self,conn,install,install_root):
+        cursor=conn.execute('INSERT INTO installs (install_root,'+','.join(InstallDB.COLUMNS)+') VALUES (?'+',?'*len(InstallDB.COLUMNS)+')',
+                            [install_root]+[install.get(c) for c in InstallDB.COLUMNS])
+        return cursor.lastrowid
+
+    '''Records an installation as the latest of the package, and the latest until then as the previous one'''
+    def addInstall(self,install,install_root):
+        try:
+            conn=self.connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                install_id=self.insertInstall(conn,install,install_root)
+                row=conn.execute('SELECT latest_id FROM packages WHERE install_root=? AND pkg_name=?',(install_root,install['pkg_name'])).fetchone()
+                previous_id=row['latest_id'] if row else None
+                conn.execute('INSERT OR REPLACE INTO packages VALUES (?,?,?,?)',(install_root,install['pkg_name'],install_id,previous_id))
+            conn.close()
+        except sqlite3.Error as e:
+            print "Error: Couldn't update "+self.db_path+", "+str(e)
+            return False
+
+        return True
+
+    '''Makes the previous installation of the package the latest, and the one installed before that the previous'''
+    def rollback(self,pkg_name,install_root):
+        try:
+            conn=self.connect()
+            with conn:
+                conn.execute('BEGIN IMMEDIATE')
+                row=conn.execute('SELECT previous_id FROM packages WHERE install_root=? AND pkg_name=?',(install_root,pkg_name)).fetchone()
+                if not row or not row['previous_id']:
+                    print "Error: No previous installation of "+pkg_name+" to roll back to."
+                    return False
+                before=conn.execute('SELECT max(id) AS id FROM installs WHERE install_root=? AND pkg_name=? AND id<?',
+                                    (install_root,pkg_name,row['previous_id'])).fetchone()
+                conn.execute('UPDATE packages SET latest_id=?, previous_id=? WHERE install_root=? AND pkg_name=?',
+                             (row['previous_id'],before['id'],install_root,pkg_name))
+            conn.close()
+        except sqlite3.Error as e:
+            print "Error: Couldn't update "+self.db_path+", "+str(e)
+            return False
+
+        return True
+
+    def query(self,sql,params=()):
+        conn=self.connect()
+        try:
+            return [dict((c,row[c]) for c in row.keys()) for row in conn.execute(sql,params).fetchall()]
+        finally:
+            conn.close()
+
+    '''Returns the latest and previous installations of the package, None for those not found'''
+    def getInstalls(self,pkg_name,install_root):
+        rows=self.query('''SELECT i.*, i.id=p.latest_id AS is_latest FROM packages p JOIN installs i ON i.id IN (p.latest_id,p.previous_id)
+            WHERE p.install_root=? AND p.pkg_name=?''',(install_root,pkg_name))
+        latest=[r for r in rows if r['is_latest']]
+        previous=[r for r in rows if not r['is_latest']]
+
+        return (latest[0] if latest else None),(previous[0] if previous else None)
+
+    '''Returns the latest installations of all the packages, or those in pkg_names, at install_root'''
+    def listInstalled(self,install_root,pkg_names=None):
+        sql='SELECT i.* FROM packages p JOIN installs i ON i.id=p.latest_id WHERE p.install_root=?'
+        params=[install_root]
+        if pkg_names:
+            sql+=' AND p.pkg_name IN ('+','.join('?'*len(pkg_names))+')'
+            params+=pkg_names
+
+        return self.query(sql+' ORDER BY p.pkg_name',params)
+
+    '''Returns the latest and previous installations of all the packages, at all install roots'''
+    def listActive(self):
+        return self.query('SELECT i.* FROM packages p JOIN installs i ON i.id IN (p.latest_id,p.previous_id)')
+
+    '''Returns all the installations of a package at install_root, latest first'''
+    def getHistory(self,pkg_name,install_root):
+        return self.query('SELECT * FROM installs WHERE install_root=? AND pkg_name=? ORDER BY id DESC',(install_root,pkg_name))
+
+    '''Records the prepared installation of a package, replacing the one prepared earlier if any'''
+    def setPrepared(self,prepared,install_root):
+        return self.update('INSERT OR REPLACE INTO prepared VALUES (?,?,?,?,?,?)',
+                           (install_root,prepared['pkg_name'],prepared['deploy_ts'],prepared['pkg_digest'],prepared['digest_algo'],
+                            json.dumps(prepared,sort_keys=True)))
+
+    def removePrepared(self,pkg_name,install_root):
+        return self.update('DELETE FROM prepared WHERE install_root=? AND pkg_name=?',(install_root,pkg_name))
+
+    '''Returns the prepared installation of the package at install_root, None if there is none'''
+    def getPrepared(self,pkg_name,install_root):
+        rows=self.listPrepared(install_root,[pkg_name])
+
+        return rows[0] if rows else None
+
+    '''Returns the prepared installations at install_root, or at all install roots'''
+    def listPrepared(self,install_root=None,pkg_names=None):
+        sql='SELECT record FROM prepared WHERE 1=1'
+        params=list()
+        if install_root:
+            sql+=' AND install_root=?'
+            params.append(install_root)
+        if pkg_names:
+            sql+=' AND pkg_name IN ('+','.join('?'*len(pkg_names))+')'
+            params+=pkg_names
+
+        return [encodeStrings(json.loads(row['record'])) for row in self.query(sql+' ORDER BY pkg_name',params)]
+
+    def update(self,sql,params=()):
+        try:
+            conn=self.connect()
+            with conn:
+                conn.execute(sql,params)
+            conn.close()
+        except sqlite3.Error as e:
+            print "Error: Couldn't update "+self.db_path+", "+str(e)
+            return False
+
+        return True
+
+'''Cache of package tarballs under opkg_dir/pkgs, kept within max_size bytes by evicting the least recently used tarballs.
+The tarballs of the active and previous installations, by their digests in the install db, are never evicted.
+Use of a tarball is tracked by setting its access time, as the filesystem could be mounted with noatime.
+'''
+class PkgCache():
+    def __init__(self,pkgs_dir,install_db,max_size,digest_cache,digest_algo=DEFAULT_DIGEST_ALGO):
+        self.pkgs_dir=pkgs_dir
+        self.install_db=install_db
+        self.max_size=max_size
+        self.digest_cache=digest_cache
+        self.digest_algo=digest_algo
+
+    '''Records the tarball as used now, in the mtime of an empty file next to it.
+    The tarball itself is not touched, as its mtime is part of its identity in the digest cache.
+    '''
+    @staticmethod
+    def touch(tarball_path):
+        with open(tarball_path+TARBALL_USED_EXT,'a'): os.utime(tarball_path+TARBALL_USED_EXT,None)
+
+    @staticmethod
+    def getLastUsed(tarball_path,st):
+        try:
+            return os.stat(tarball_path+TARBALL_USED_EXT).st_mtime
+        except OSError:
+            return st.st_mtime
+
+    '''Copies tarball_path to cache_path, unless the tarball is there already.
+    Those are compared by their digests with digest_algo, the ones deploy computes, for those to be cached once.
+    '''
+    def add(self,tarball_path,cache_path):
+        if os.path.isfile(cache_path) and os.path.getsize(cache_path)==os.path.getsize(tarball_path):
+            algo=self.digest_algo
+            if getCachedDigest(self.digest_cache,tarball_path,algo)==getCachedDigest(self.digest_cache,cache_path,algo):
+                PkgCache.touch(cache_path)
+                return True
+        if not copyPath(tarball_path,cache_path): return False
+        PkgCache.touch(cache_path)
+        '''The sidecar index goes along with the tarball, and the one of the tarball replaced is removed'''
+        if os.path.isfile(tarball_path+TARBALL_INFO_EXT): copyPath(tarball_path+TARBALL_INFO_EXT,cache_path+TARBALL_INFO_EXT)
+        elif os.path.exists(cache_path+TARBALL_INFO_EXT): removePath(cache_path+TARBALL_INFO_EXT)
+
+        return True
+
+    '''Returns the set of (digest_algo,digest) of the tarballs installed, or prepared to be'''
+    def getPinned(self):
+        installs=self.install_db.listActive()+self.install_db.listPrepared()
+
+        return set((install['digest_algo'],install['pkg_digest']) for install in installs)
+
+    '''Removes the least recently used tarballs till the cache is within max_size'''
+    def evict(self):
+        tarballs=list()
+        for root,dirs,files in os.walk(self.pkgs_dir):
+            for name in files:
+                if Codec.getTarballExt(name) and not name.startswith('.'): tarballs.append((root+'/'+name,os.stat(root+'/'+name)))
+        total=sum(st.st_size for path,st in tarballs)
+        if total <= self.max_size: return True
+
+        pinned=self.getPinned()
+        algos=set(algo for algo,digest in pinned)
+        removed=0
+        for path,st in sorted(tarballs,key=lambda t: PkgCache.getLastUsed(*t)):
+            if total <= self.max_size: break
+            if any((algo,getCachedDigest(self.digest_cache,path,algo)) in pinned for algo in algos): continue
+            if not removePath(path): continue
+            for ext in (TARBALL_INFO_EXT,TARBALL_USED_EXT):
+                if os.path.exists(path+ext): removePath(path+ext)
+            total-=st.st_size
+            removed+=1
+        print "Info: Removed "+str(removed)+" tarballs from the package cache, "+str(total)+" bytes in use."
+        if total > self.max_size:
+            print "Warning: Package cache at "+self.pkgs_dir+" exceeds its size, "+str(self.max_size)+" bytes, with the tarballs installed."
+
+        return True
+
+'''Content addressed store of deployed files, kept under install_root/objects.
+Each unique file, by its content, mode and owner, is stored once as objects/algo/xx/digest.mode.uid.gid,
+and the deploy trees are built from reflinks to those, copies where reflinks are not supported, or hard links in hardlink mode.
+Objects are shared by the deploy trees in hardlink mode, which is opted in to, and must never be modified in place,
+so files in a deploy tree are updated by replacing them, and relinked to change their attributes.
+The objects a deploy tree is built from are recorded in objects/refs, under the path of the tree relative to install_root.
+'''
+class ObjectStore():
+    def __init__(self,store_dir,algo,mode=DEFAULT_OBJECT_STORE):
+        self.store_dir=store_dir
+        self.algo=algo
+        self.mode=mode
+        self.linked=dict() #deploy path: (digest,inode,object path), of files linked to the store
+        self.known=dict() #stage path: (inode,size,mtime,digest), of the files extracted or carried
+
+    '''Returns the lock file held, shared while installing packages and exclusive while collecting garbage'''
+    def lock(self,exclusive=False):
+        if not os.path.isdir(self.store_dir): os.makedirs(self.store_dir)
+        lock_file=open(self.store_dir+'/'+OBJECT_STORE_LOCK,'a')
+        fcntl.flock(lock_file,fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        return lock_file
+
+    def getRefsPath(self,deploy_dir):
+        return self.store_dir+'/'+OBJECT_REFS_DIR+'/'+os.path.relpath(deploy_dir,os.path.dirname(self.store_dir))
+
+    '''Records the objects the files of deploy_dir are linked or cloned from, the ones those are still the files of'''
+    def saveRefs(self,deploy_dir):
+        if self.mode == 'off': return True
+        prefix=os.path.abspath(deploy_dir)+'/'
+        refs=set()
+        for path,(digest,inode,obj_path) in self.linked.items():
+            if not path.startswith(prefix): continue
+            try:
+                if os.lstat(path).st_ino != inode: continue
+            except OSError:
+                continue
+            refs.add(os.path.relpath(obj_path,self.store_dir))
+        refs_path=self.getRefsPath(deploy_dir)
+        if not makeDirs(os.path.dirname(refs_path)): return False
+
+        return writeFileAtomic(refs_path,''.join(ref+'\n' for ref in sorted(refs)))
+
+    '''Removes the objects no deploy tree in deploy_dirs, the ones there are, is built from, and the refs of the trees removed.
+    Objects with other links, like from the stage of a prepared installation, are kept.
+    The trees deployed before the refs were recorded are told apart by the links to the objects, in hardlink mode,
+    and in reflink mode no objects are removed while there are such trees.
+    '''
+    def collectGarbage(self,deploy_dirs):
+        refs_dir=self.store_dir+'/'+OBJECT_REFS_DIR
+        refs_paths=set(self.getRefsPath(deploy_dir) for deploy_dir in deploy_dirs)
+        in_use=set()
+        for refs_path in refs_paths:
+            if os.path.isfile(refs_path): in_use.update(loadFile(refs_path).splitlines())
+            elif self.mode == 'reflink':
+                print "Warning: "+os.path.dirname(self.store_dir)+" has installations deployed before the objects used were recorded, no objects are removed till those are cleaned."
+                return True
+        for root,dirs,files in os.walk(refs_dir,topdown=False):
+            for name in files:
+                if root+'/'+name not in refs_paths: os.remove(root+'/'+name)
+            if root != refs_dir and not os.listdir(root): os.rmdir(root)
+
+        removed,freed=0,0
+        for root,dirs,files in os.walk(self.store_dir):
+            if root == self.store_dir and OBJECT_REFS_DIR in dirs: dirs.remove(OBJECT_REFS_DIR)
+            for name in files:
+                if name==OBJECT_STORE_LOCK: continue
+                if os.path.relpath(root+'/'+name,self.store_dir) in in_use: continue
+                st=os.lstat(root+'/'+name)
+                if st.st_nlink > 1: continue
+                os.remove(root+'/'+name)
+                removed+=1
+                freed+=st.st_size
+        print "Info: Removed "+str(removed)+" objects not in use from the store, "+str(freed)+" bytes freed."
+
+        return True
+
+    def getObjectPath(self,digest,mode,uid,gid):
+        return self.store_dir+'/'+self.algo+'/'+digest[:2]+'/'+digest+'.'+oct(stat.S_IMODE(mode))+'.'+str(uid)+'.'+str(gid)
+
+    '''Installs source_path, a file or a directory tree, at target_path like cp -r does'''
+    def installPath(self,source_path,target_path):
+        try:
+            if os.path.isdir(source_path) and not os.path.islink(source_path):
+                for root,dirs,files in os.walk(source_path):
+                    target_dir=os.path.normpath(target_path+'/'+os.path.relpath(root,source_path))
+                    if not os.path.isdir(target_dir): os.makedirs(target_dir)
+                    for name in dirs:
+                        if os.path.islink(root+'/'+name): files.append(name)
+                    for name in files:
+                        self.installFile(root+'/'+name,target_dir+'/'+name)
+            else:
+                if os.path.isdir(target_path): target_path=target_path+'/'+os.path.basename(source_path)
+                self.installFile(source_path,target_path)
+        except EnvironmentError as e:
+            print(e)
+            return False
+
+        return True
+
+    def installFile(self,source_path,target_path):
+        st=os.lstat(source_path)
+        tmp_path=getTempPath(target_path)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(source_path),tmp_path)
+        elif not stat.S_ISREG(st.st_mode) or self.mode == 'off':
+            shutil.copy(source_path,tmp_path)
+            Profiler.count('bytes_written',st.st_size)
         else:
-            if not self.replaceTokensFile(self.tmpl_path,tokens_list, backup):
-                print "Error: Failed to resolve template " + self.tmpl_path
-                return False
+            digest=self.getKnownDigest(source_path,st)
+            if not digest:
+                digest=getFileDigest(source_path,self.algo)
+                Profiler.count('bytes_read',st.st_size)
+            obj_path=self.addObject(source_path,st,digest)
+            self.linkObject(obj_path,tmp_path)
+            self.linked[os.path.abspath(target_path)]=(digest,os.lstat(tmp_path).st_ino,obj_path)
+        os.rename(tmp_path,target_path)
+        Profiler.count('files')
+
+    '''Records the digest of a file in stage, valid till the file is changed.'''
+    def setKnownDigest(self,path,digest):
+        self.known[os.path.abspath(path)]=DigestCache.fileIdentity(os.lstat(path))+(digest,)
+
+    def getKnownDigest(self,path,st):
+        entry=self.known.get(os.path.abspath(path))
+        if not entry or entry[:3] != DigestCache.fileIdentity(st): return None
+
+        return entry[3]
+
+    '''Extracts a regular file member from the tar stream, computing its digest on the way.'''
+    def extractFile(self,tar,member,path):
+        file_dir=os.path.dirname(path)
+        if not os.path.isdir(file_dir): os.makedirs(file_dir)
+        digest=newDigest(self.algo)
+        src=tar.extractfile(member)
+        with open(path,'wb') as f:
+            while True:
+                data=src.read(DigestReader.CHUNK_SIZE)
+                if not data: break
+                digest.update(data)
+                f.write(data)
+        Profiler.count('files')
+        Profiler.count('bytes_written',member.size)
+        tar.chown(member,path)
+        tar.chmod(member,path)
+        tar.utime(member,path)
+        self.setKnownDigest(path,digest.hexdigest())
+
+    '''Links the object with the digest and mode at path, in place of extracting the file.
+    Returns False if there is no such object or it cannot be linked, and the file has to be extracted.
+    '''
+    def carry(self,digest,mode,path):
+        if self.mode == 'off': return False
+        obj_path=self.getObjectPath(digest,mode,os.geteuid(),os.getegid())
+        if not os.path.exists(obj_path): return False
+        try:
+            file_dir=os.path.dirname(path)
+            if not os.path.isdir(file_dir): os.makedirs(file_dir)
+            os.link(obj_path,path)
+        except OSError:
+            return False
+        self.setKnownDigest(path,digest)
+        Profiler.count('files')
 
         return True
 
-    def resolveVarsFile(self,file_path, vars_dict, backup=False):
-        str = loadFile(file_path)
-        for var in vars_dict:
-            if var not in vars_dict or not vars_dict[var]: continue
-            str = re.sub('{{ ' + var + ' }}', vars_dict[var], str)
-        if backup:
-            if not execOSCommand("mv " + file_path + " " + file_path + '.' + str(int(time.time()))):
-                print "Error: Couldn't backup " + file_path
-                return False
+    '''Adds a file to the store unless its object exists already, returns the object path.
+    The object is created as a hard link to the source, which is in stage_dir, and copied only across filesystems.
+    Objects are owned by the deploying user, as files copied by cp are.
+    '''
+    def addObject(self,source_path,st,digest):
+        uid,gid=os.geteuid(),os.getegid()
+        obj_path=self.getObjectPath(digest,st.st_mode,uid,gid)
+        if os.path.exists(obj_path): return obj_path
+
+        obj_dir=os.path.dirname(obj_path)
+        if not os.path.isdir(obj_dir): os.makedirs(obj_dir)
+        tmp_path=getTempPath(obj_path)
         try:
-            with open(file_path, "w") as f:
-                f.write(str)
-        except EnvironmentError:
-            print "Error: Cannot save updated " + file_path
+            os.link(source_path,tmp_path)
+        except OSError:
+            copyFile(source_path,tmp_path)
+        if (st.st_uid,st.st_gid) != (uid,gid): os.lchown(tmp_path,uid,gid)
+        os.rename(tmp_path,obj_path)
+
+        return obj_path
+
+    '''Creates path from the object, a copy is made if it cannot be linked, like across filesystems'''
+    def linkObject(self,obj_path,path):
+        if self.mode == 'reflink':
+            cloneFile(obj_path,path)
+            return
+        try:
+            os.link(obj_path,path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV,errno.EMLINK,errno.EPERM): raise
+            copyFile(obj_path,path)
+
+    '''Sets owner and mode of a deployed file that is a link to an object, by linking it to the object
+    with the same content and those attributes. The object is made from a copy if it's not in the store yet.
+    Returns False if path is not linked to the store, in which case the attributes can be changed in place.
+    '''
+    def relink(self,path,st,uid,gid,mode):
+        if self.mode != 'hardlink': return False
+        entry=self.linked.get(os.path.abspath(path))
+        if not entry or entry[1] != st.st_ino: return False
+
+        obj_path=self.getObjectPath(entry[0],mode,uid,gid)
+        if not os.path.exists(obj_path):
+            obj_dir=os.path.dirname(obj_path)
+            if not os.path.isdir(obj_dir): os.makedirs(obj_dir)
+            tmp_path=getTempPath(obj_path)
+            copyFile(path,tmp_path)
+            os.chown(tmp_path,uid,gid)
+            os.chmod(tmp_path,mode)
+            os.rename(tmp_path,obj_path)
+        tmp_path=getTempPath(path)
+        self.linkObject(obj_path,tmp_path)
+        os.rename(tmp_path,path)
+        self.linked[os.path.abspath(path)]=(entry[0],os.lstat(path).st_ino,obj_path)
+
+        return True
+
+'''Sets owner and mode of files as specified by the permissions: entries of a manifest.
+The rules are merged and applied in a single walk of the paths, each inode getting the owner and mode
+resulting from all the rules covering it, applied in order as chown -R and chmod -R would.
+Inodes already having those are not touched. Directories are set after their content, so a mode that
+makes a directory unreadable doesn't stop the walk.
+'''
+class Permissions():
+    OCTAL_MODE_PATTERN=re.compile('^[0-7]+$')
+    SYMBOLIC_MODE_PATTERN=re.compile('^([ugoa]*)((?:[-+=](?:[ugo]|[rwxXst]*))+)$')
+    SYMBOLIC_OP_PATTERN=re.compile('([-+=])([ugo]|[rwxXst]*)')
+    WHO_BITS={'u':04700,'g':02070,'o':01007,'a':07777}
+    PERM_BITS={'r':0444,'w':0222,'x':0111,'s':06000,'t':01000}
+    COPY_BITS={'u':0700,'g':0070,'o':0007}
+
+    def __init__(self,object_store=None):
+        self.object_store=object_store
+        self.rules=list() #(path,uid,gid,mode_ops)
+        self.inodes_total,self.inodes_changed=0,0
+
+    '''chown_opt is owner[:group], either can be empty or numeric. chmod_opt is octal or symbolic like u+x,go-w'''
+    def addRule(self,path,chown_opt,chmod_opt):
+        try:
+            uid,gid=Permissions.parseOwner(chown_opt)
+        except KeyError:
+            print "Error: Unknown user or group in "+chown_opt
+            return False
+        mode_ops=Permissions.parseMode(chmod_opt)
+        if mode_ops is None:
+            print "Error: Invalid mode "+chmod_opt
             return False
+        self.rules.append((os.path.normpath(path),uid,gid,mode_ops))
 
         return True
 
-    def replaceTokensFile(self,file_path, tokens_list, backup=False):
-        str = loadFile(file_path)
-        for token in tokens_list:
-            pattern, replace = re.split(Tmpl.TMPL_KEY_VAL_DELIM,token)
-            str = re.sub(pattern, replace, str)
-        if backup:
-            if not execOSCommand("mv " + file_path + " " + file_path + '.' + str(int(time.time()))):
-                print "Error: Couldn't backup " + file_path
-                return False
+    @staticmethod
+    def parseOwner(chown_opt):
+        owner,group=chown_opt,None
+        if ':' in chown_opt: owner,group=chown_opt.split(':',1)
+        uid,gid=-1,-1
+        if owner:
+            pw=pwd.getpwnam(owner) if not owner.isdigit() else None
+            uid=pw.pw_uid if pw else int(owner)
+            if group == '' and pw: gid=pw.pw_gid
+        if group:
+            gid=grp.getgrnam(group).gr_gid if not group.isdigit() else int(group)
+
+        return uid,gid
+
+    '''Returns the mode as a list of (who_bits,op,perms,mentioned_bits) operations, None if invalid.
+    perms is the mode for an octal one, and the permission letters, or the who letter to copy those of, for a symbolic one.
+    mentioned_bits are those the mode sets or clears explicitly, the setuid and setgid bits of directories are kept unless mentioned.
+    As with GNU chmod, those are mentioned by an octal mode of 5 digits or more, like 00755, or one that sets those, like 2755.
+    '''
+    @staticmethod
+    def parseMode(chmod_opt):
+        if Permissions.OCTAL_MODE_PATTERN.match(chmod_opt):
+            mode=int(chmod_opt,8)
+            if mode > 07777: return None
+            return [(07777,'=',mode,07777 if len(chmod_opt) > 4 else (mode & 06000) | 01777)]
+        ops=list()
+        for clause in chmod_opt.split(','):
+            m=Permissions.SYMBOLIC_MODE_PATTERN.match(clause)
+            if not m: return None
+            who=0
+            for c in m.group(1) or 'a': who|=Permissions.WHO_BITS[c]
+            for op,perms in Permissions.SYMBOLIC_OP_PATTERN.findall(m.group(2)):
+                mentioned=0
+                for c in perms: mentioned|=Permissions.PERM_BITS.get(c,0)
+                ops.append((who,op,perms,mentioned & who))
+
+        return ops
+
+    '''Returns mode changed by mode_ops as chmod does, except that the umask is not applied to the modes without who letters'''
+    @staticmethod
+    def applyMode(mode,mode_ops,is_dir):
+        for who,op,perms,mentioned in mode_ops:
+            if isinstance(perms,int):
+                bits=perms
+            elif perms in Permissions.COPY_BITS:
+                copied=mode & Permissions.COPY_BITS[perms]
+                bits=0
+                for perm in 'rwx':
+                    if copied & Permissions.PERM_BITS[perm]: bits|=Permissions.PERM_BITS[perm]
+            else:
+                bits=0
+                for c in perms:
+                    if c == 'X':
+                        if is_dir or mode & 0111: bits|=0111
+                    else:
+                        bits|=Permissions.PERM_BITS[c]
+            bits&=who
+            if op == '+': mode|=bits
+            elif op == '-': mode&=~bits
+            else:
+                kept=~who | (06000 & ~mentioned if is_dir else 0)
+                mode=(mode & kept) | bits
+
+        return mode & 07777
+
+    def getRules(self,path):
+        return [r for r in self.rules if path == r[0] or path.startswith(r[0]+'/')]
+
+    def apply(self):
+        roots=[r[0] for r in self.rules]
+        roots=[p for p in roots if not [q for q in roots if p.startswith(q+'/')]]
         try:
-            with open(file_path, "w") as f:
-                f.write(str)
-        except EnvironmentError:
-            print "Error: Cannot save updated " + file_path
+            for root in sorted(set(roots)):
+                if os.path.isdir(root) and not os.path.islink(root):
+                    for dirpath,dirs,files in os.walk(root,topdown=False):
+                        for name in files+[d for d in dirs if os.path.islink(dirpath+'/'+d)]:
+                            self.applyPath(dirpath+'/'+name)
+                        self.applyPath(dirpath)
+                else:
+                    self.applyPath(root)
+        except EnvironmentError as e:
+            print(e)
             return False
+        print "Info: Permissions changed on "+str(self.inodes_changed)+" of "+str(self.inodes_total)+" files."
+        Profiler.count('files',self.inodes_changed)
 
         return True
 
+    def applyPath(self,path):
+        st=os.lstat(path)
+        uid,gid,mode=st.st_uid,st.st_gid,stat.S_IMODE(st.st_mode)
+        is_link=stat.S_ISLNK(st.st_mode)
+        for rule_path,rule_uid,rule_gid,mode_ops in self.getRules(path):
+            if rule_uid != -1: uid=rule_uid
+            if rule_gid != -1: gid=rule_gid
+            if not is_link: mode=Permissions.applyMode(mode,mode_ops,stat.S_ISDIR(st.st_mode))
+        self.inodes_total+=1
+        if (uid,gid,mode) == (st.st_uid,st.st_gid,stat.S_IMODE(st.st_mode)): return
+        self.inodes_changed+=1
+
+        if is_link:
+            os.lchown(path,uid,gid)
+            return
+        if stat.S_ISREG(st.st_mode) and self.object_store and self.object_store.relink(path,st,uid,gid,mode): return
+        if (uid,gid) != (st.st_uid,st.st_gid): os.chown(path,uid,gid)
+        if mode != stat.S_IMODE(st.st_mode): os.chmod(path,mode)
+
 ''' Utility Functions '''
 
+'''Converts the unicode strings from json to str, as used elsewhere'''
+def encodeStrings(obj):
+    if isinstance(obj,dict):
+        return dict((encodeStrings(k),encodeStrings(v)) for k,v in obj.items())
+    if isinstance(obj,list):
+        return [encodeStrings(item) for item in obj]
+    if isinstance(obj,unicode):
+        return obj.encode('utf-8')
+
+    return obj
+
+def ThreadPool(processes=None):
+    from multiprocessing.pool import ThreadPool as Pool
+    return Pool(processes)
+
+'''Pool of worker processes, those ignore SIGINT so that an interrupt is handled in the parent, which terminates them'''
+def ProcessPool(processes=None):
+    from multiprocessing import Pool
+    return Pool(processes,ignoreInterrupt)
+
+def ignoreInterrupt():
+    signal.signal(signal.SIGINT,signal.SIG_IGN)
+
+'''Builds a package for opkg create, run in a worker process when packages are built in parallel.
+task is (pkg,build_root,env_conf,options,jobs,capture), with the output kept and returned if capture is set.
+Returns (pkg,status,output,elapsed).
+'''
+def createPackage(task):
+    pkg,build_root,env_conf,options,jobs,capture=task
+    start=time.time()
+    stdout=sys.stdout
+    if capture: sys.stdout=StringIO.StringIO()
+    try:
+        pkg_inst=Pkg(pkg)
+        pkg_inst.setBuildRoot(build_root)
+        pkg_inst.setEnvConfig(env_conf)
+        pkg_inst.setJobs(jobs)
+        if options.get('codec'): pkg_inst.setCodec(options['codec'])
+        if options.get('fingerprint'): pkg_inst.setFingerprintMode(options['fingerprint'])
+        if 'force' in options: pkg_inst.setForce()
+        if 'release' in options: pkg_inst.setRelease()
+        status=pkg_inst.create()
+    except Exception:
+        print "Error: Couldn't create package "+pkg
+        print traceback.format_exc().rstrip()
+        status=False
+    finally:
+        output=sys.stdout.getvalue() if capture else ''
+        sys.stdout=stdout
+
+    return pkg,bool(status),output,time.time()-start
+
+'''Returns the module, None if it's not installed'''
+def importOptional(module_name):
+    try:
+        __import__(module_name)
+    except ImportError:
+        return None
+
+    return sys.modules[module_name]
+
+'''Returns the path of the command found in PATH, None if it's not found'''
+def findCommand(name):
+    for path in os.environ.get('PATH',os.defpath).split(os.pathsep):
+        if os.access(path+'/'+name,os.X_OK) and os.path.isfile(path+'/'+name): return path+'/'+name
+
+    return None
+
 '''returns the status code after executing cmd in the shell'''
-def runCmd(cmd):
-    return subprocess.call(cmd,shell=True)
+def runCmd(cmd,cwd=None):
+    Profiler.count('subprocesses')
+    return subprocess.call(cmd,shell=True,cwd=cwd)
 
 '''process return status from a command execution '''
-def execOSCommand(cmd):
-   rc=runCmd(cmd)
+def execOSCommand(cmd,cwd=None):
+   rc=runCmd(cmd,cwd)
    if rc!=0:
        print "Error executing "+cmd
        return False
@@ -773,8 +3889,7 @@ def createTargetPath(source_path,target_path):
     if os.path.isfile(source_path): d=os.path.dirname(target_path)
     base_dir=d.split()[0]
     if not os.path.exists(base_dir):
-        cmd="mkdir -p "+base_dir
-        if not execOSCommand(cmd):
+        if not makeDirs(base_dir):
             print "Error: Couldn't create "+base_dir
             return False
 
@@ -783,10 +3898,259 @@ def createTargetPath(source_path,target_path):
 def Exit(rc):
     sys.exit(rc)
 
+'''Raw deflate of a block; all but the last block end with a sync flush so they can be concatenated.'''
+def deflateBlock(data,level,last):
+    c=zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+    if last: return c.compress(data)+c.flush(zlib.Z_FINISH)
+    return c.compress(data)+c.flush(zlib.Z_SYNC_FLUSH)
+
+def newDigest(algo):
+    return hashlib.new(algo)
+
+'''Hashes the file in chunks, so memory use doesn't depend on the file size'''
+def getFileDigest(file_path,algo=DEFAULT_DIGEST_ALGO):
+    digest=newDigest(algo)
+    with open(file_path,'rb') as f:
+        while True:
+            data=f.read(DigestReader.CHUNK_SIZE)
+            if not data: break
+            digest.update(data)
+
+    return digest.hexdigest()
+
 def getFileMD5(file_path):
-    return hashlib.md5(open(file_path, 'rb').read()).hexdigest()
+    return getFileDigest(file_path,'md5')
+
+'''Returns a digest of the tree at path from the path, type, mode, owner, size and mtime of each entry, and the symlink targets.
+The contents are not read, so a changed file is found by its mtime and size. The link count and ctime
+are left out, as those change when the objects shared with the tree are linked to other deploy trees.
+'''
+def getTreeDigest(path,algo=DEFAULT_DIGEST_ALGO):
+    digest=newDigest(algo)
+    for root,dirs,files in os.walk(path):
+        dirs.sort()
+        for name in dirs+sorted(files):
+            entry_path=root+'/'+name
+            st=os.lstat(entry_path)
+            entry=[os.path.relpath(entry_path,path),st.st_mode,st.st_uid,st.st_gid]
+            if stat.S_ISLNK(st.st_mode): entry.append(os.readlink(entry_path))
+            elif not stat.S_ISDIR(st.st_mode): entry+=[st.st_size,repr(st.st_mtime)]
+            digest.update('\0'.join(str(e) for e in entry)+'\n')
+
+    return digest.hexdigest()
+
+'''Returns a temp path next to file_path, unique to the process and thread'''
+def getTempPath(file_path):
+    return os.path.dirname(file_path)+'/.'+os.path.basename(file_path)+'.'+HOST_NAME+'.'+str(os.getpid())+'.'+str(threading.current_thread().ident)+'.tmp'
+
+'''Copies a file computing its digest on the way, returns the digest'''
+def copyFileWithDigest(src,dst,algo=DEFAULT_DIGEST_ALGO):
+    with open(src,'rb') as fsrc:
+        reader=DigestReader(fsrc,newDigest(algo))
+        with open(dst,'wb') as fdst:
+            shutil.copyfileobj(reader,fdst,DigestReader.CHUNK_SIZE)
+    shutil.copymode(src,dst)
+
+    return reader.hexdigest()
+
+'''Returns the digest of a file from the digest cache, computing it if not cached'''
+def getCachedDigest(digest_cache,file_path,algo=DEFAULT_DIGEST_ALGO):
+    digest=digest_cache.lookup(file_path,algo)
+    if digest: return digest
+    st=os.stat(file_path)
+    digest=getFileDigest(file_path,algo)
+    digest_cache.update(file_path,algo,digest,st)
+
+    return digest
+
+'''Converts a size like 512M or 2G to bytes'''
+def parseSize(size):
+    m=re.match('^\s*(\d+)\s*([KMGT]?)B?\s*$',str(size).upper())
+    if not m:
+        print "Warning: Invalid size "+str(size)+", using "+DEFAULT_PKGS_CACHE_SIZE
+        return parseSize(DEFAULT_PKGS_CACHE_SIZE)
+
+    return int(m.group(1))*1024**' KMGT'.index(m.group(2) or ' ')
+
+'''Returns the repo set up in the repo section of configs'''
+def getRepo(configs,jobs=1):
+    repo_conf=configs.get('repo',dict())
+    if not repo_conf.get('repo_type') or not repo_conf.get('repo_path'):
+        print "Error: repo_type and repo_path have to be set in the repo section of opkg.env"
+        return None
+    if repo_conf['repo_type'].lower() in LOCAL_REPO_TYPES:
+        return Repo(repo_conf['repo_path'],configs['basic']['opkg_dir'],configs['basic']['digest_algo'])
+    if repo_conf['repo_type'].lower() in HTTP_REPO_TYPES:
+        return HttpRepo(repo_conf['repo_path'],configs['basic']['opkg_dir'],configs['basic']['digest_algo'],jobs)
+    print "Error: Unsupported repo_type "+repo_conf['repo_type']
+
+    return None
+
+'''Writes content to file_path through a temp file renamed in place, readers never see a partial file.
+If st, the stat of the file being replaced, is given its mode and owner are kept.
+'''
+def writeFileAtomic(file_path,content,st=None):
+    tmp_path=getTempPath(file_path)
+    try:
+        with open(tmp_path,'w') as f:
+            f.write(content)
+        if st: copyAttrs(st,tmp_path)
+        os.rename(tmp_path,file_path)
+    except EnvironmentError as e:
+        print(e)
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        return False
+
+    return True
+
+'''The libc functions copying file data in the kernel, by name, looked up on first use'''
+KERNEL_COPY_FUNCS=dict()
+
+'''Returns the libc functions copy_file_range and sendfile, those libc has'''
+def getKernelCopyFuncs():
+    if 'looked_up' not in KERNEL_COPY_FUNCS:
+        try:
+            libc=ctypes.CDLL(None)
+        except OSError:
+            libc=None
+        for name,argtypes in (('copy_file_range',[ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_uint]),
+            ('sendfile',[ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t])):
+            func=getattr(libc,name,None)
+            if not func: continue
+            func.argtypes=argtypes
+            func.restype=ctypes.c_ssize_t
+            KERNEL_COPY_FUNCS[name]=func
+        KERNEL_COPY_FUNCS['looked_up']=True
+
+    return KERNEL_COPY_FUNCS
+
+'''Copies up to size bytes from fd_in to fd_out, at and advancing their file offsets, in the kernel.
+copy_file_range is used, or sendfile where it's missing or fails for the files, as across filesystems on older kernels.
+Returns the bytes copied, fewer than size if neither works.
+'''
+def kernelCopy(fd_in,fd_out,size):
+    funcs=getKernelCopyFuncs()
+    copied=0
+    for name in ('copy_file_range','sendfile'):
+        if name not in funcs: continue
+        while copied < size:
+            if name == 'copy_file_range':
+                n=funcs[name](fd_in,None,fd_out,None,size-copied,0)
+            else:
+                n=funcs[name](fd_out,fd_in,None,size-copied)
+            if n <= 0: break
+            copied+=n
+        if copied == size or n == 0: break
+
+    return copied
+
+'''Copies the content and mode of a regular file, as cp does.
+The data is copied in the kernel by kernelCopy, whatever it couldn't copy is read and written here.
+'''
+def copyFile(src,dst):
+    with open(src,'rb') as fsrc:
+        with open(dst,'wb') as fdst:
+            size=os.fstat(fsrc.fileno()).st_size
+            copied=kernelCopy(fsrc.fileno(),fdst.fileno(),size) if size > 0 else 0
+            if copied < size:
+                fsrc.seek(copied)
+                fdst.seek(copied)
+                shutil.copyfileobj(fsrc,fdst,DigestReader.CHUNK_SIZE)
+    shutil.copymode(src,dst)
+
+'''Filesystem operations done in-process, in place of the mkdir, cp, mv, rm and ln commands.
+Those print the error and return False on failure, like execOSCommand.
+'''
+
+'''mkdir -p'''
+def makeDirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            print "Error: Couldn't create "+path+", "+str(e)
+            return False
+
+    return True
+
+'''cp -r, a file is copied through a temp file renamed in place'''
+def copyPath(src,dst):
+    try:
+        if os.path.isdir(dst): dst=dst+'/'+os.path.basename(src)
+        if os.path.isdir(src):
+            shutil.copytree(src,dst,symlinks=True)
+        else:
+            tmp_path=getTempPath(dst)
+            copyFile(src,tmp_path)
+            os.rename(tmp_path,dst)
+    except (EnvironmentError,shutil.Error) as e:
+        print "Error: Couldn't copy "+src+" to "+dst+", "+str(e)
+        return False
+
+    return True
+
+'''mv -f, atomic within a filesystem'''
+def movePath(src,dst):
+    try:
+        if os.path.isdir(dst) and not os.path.islink(dst): dst=dst+'/'+os.path.basename(src)
+        try:
+            os.rename(src,dst)
+        except OSError as e:
+            if e.errno != errno.EXDEV: raise
+            if not copyPath(src,dst): return False
+            removePath(src)
+    except EnvironmentError as e:
+        print "Error: Couldn't move "+src+" to "+dst+", "+str(e)
+        return False
+
+    return True
+
+'''rm -rf'''
+def removePath(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+        elif os.path.lexists(path): os.remove(path)
+    except EnvironmentError as e:
+        print "Error: Couldn't delete "+path+", "+str(e)
+        return False
+
+    return True
+
+'''ln -sfn, the link is created under a temp name and renamed over tgt_path, so it's switched atomically.
+As with ln, if tgt_path is a directory the link is created in it.
+'''
+def swapSymlink(src_path,tgt_path):
+    if os.path.isdir(tgt_path) and not os.path.islink(tgt_path):
+        tgt_path=tgt_path+'/'+os.path.basename(src_path)
+    tmp_path=getTempPath(tgt_path)
+    try:
+        os.symlink(src_path,tmp_path)
+        os.rename(tmp_path,tgt_path)
+    except EnvironmentError as e:
+        print "Error: Couldn't create symlink "+tgt_path+", "+str(e)
+        if os.path.lexists(tmp_path): os.remove(tmp_path)
+        return False
+
+    return True
+
+'''Clones a file sharing the data blocks with src (reflink) on filesystems that support it, copies otherwise'''
+FICLONE=0x40049409
+def cloneFile(src,dst):
+    try:
+        with open(src,'rb') as fsrc:
+            with open(dst,'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(),FICLONE,fsrc.fileno())
+        shutil.copymode(src,dst)
+    except IOError:
+        copyFile(src,dst)
+
+'''Sets the mode and, if permitted, the owner of path to those in st'''
+def copyAttrs(st,path):
+    os.chmod(path,stat.S_IMODE(st.st_mode))
+    if os.geteuid() == 0: os.lchown(path,st.st_uid,st.st_gid)
 
 ''' main '''
 
-opkg_cmd=opkg(sys.argv)
-opkg_cmd.main()
+if __name__ == '__main__':
+    opkg_cmd=opkg(sys.argv)
+    opkg_cmd.main()
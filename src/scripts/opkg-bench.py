@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+'''Benchmarks for the hot paths of opkg: create, deploy, rollback, templates and digests.
+
+A synthetic package is generated in a scratch directory from the sizes given, and each benchmark is run
+in a child process forked for every run, so that the CPU time, peak RSS and I/O counted are of that run only.
+The results are written as JSON, and compared with the results of an earlier run if --compare is given,
+reporting the benchmarks that got slower than --threshold percent as regressions, with exit code 1.
+
+Usage:
+opkg-bench.py [--files=N] [--size=BYTES] [--depth=N] [--templates=N] [--replaces=N] [--permissions=N]
+              [--runs=N] [--jobs=N] [--codec=CODEC[:LEVEL]] [--bench=create,deploy,...] [--opkg=/path/to/openpkg.py]
+              [--output=results.json] [--compare=baseline.json] [--threshold=PERCENT] [--label=LABEL] [--verbose]
+'''
+import os
+import sys
+import re
+import imp
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import platform
+import pwd
+import grp
+
+BENCHMARKS=['create','deploy','redeploy','rollback','tmpl_resolve','tmpl_replace','md5']
+DEFAULTS={
+    'files': '1000',
+    'size': '64M',
+    'depth': '3',
+    'templates': '20',
+    'replaces': '20',
+    'permissions': '10',
+    'runs': '5',
+    'threshold': '10',
+}
+PKG_NAME='benchpkg'
+FANOUT=4
+
+'''Options are in the same --opt=val format as opkg'''
+def parseArgs(params):
+    args=dict(DEFAULTS)
+    for argx in params:
+        m=re.match('^--(.+?)(?:=(.*))?$',argx)
+        if not m:
+            print "Error: Unknown argument "+argx
+            sys.exit(1)
+        args[m.group(1)]=m.group(2) if m.group(2) is not None else ''
+    if 'help' in args:
+        print __doc__
+        sys.exit(0)
+
+    return args
+
+def parseSize(size):
+    m=re.match('^(\d+)([KMG]?)$',size.upper())
+    if not m:
+        print "Error: Invalid size "+size
+        sys.exit(1)
+
+    return int(m.group(1))*1024**' KMG'.index(m.group(2) or ' ')
+
+'''The content is half text and half random bytes, so that compression has some work to do but can't skip through it'''
+def genFile(file_path,size,seq):
+    if not os.path.isdir(os.path.dirname(file_path)): os.makedirs(os.path.dirname(file_path))
+    with open(file_path,'wb') as f:
+        text_size=size/2
+        line='line of file '+str(seq)+' with some text to compress\n'
+        f.write((line*(text_size/len(line)+1))[:text_size])
+        f.write(os.urandom(size-text_size))
+
+'''Generates the package sources under build_dir and its manifest, returns the manifest as a dict'''
+def genPackage(build_dir,args):
+    files=int(args['files'])
+    size=parseSize(args['size'])
+    depth=int(args['depth'])
+    content_dir=build_dir+'/content'
+    for i in range(files):
+        dirs=['d'+str((i/FANOUT**k)%FANOUT) for k in range(depth)]
+        genFile('/'.join([content_dir,'data']+dirs+['f'+str(i)+'.dat']),size/max(files,1),i)
+
+    for i in range(int(args['templates'])):
+        with open(makeParent(content_dir+'/tmpl/t'+str(i)+'.conf'),'w') as f:
+            for j in range(200):
+                f.write('key'+str(j)+'={{ BENCH_VAR'+str(j%10)+' }} and {{OPKG_NAME}} in {{ BENCH_UNSET }}\n')
+
+    for i in range(int(args['replaces'])):
+        with open(makeParent(content_dir+'/repl/r'+str(i)+'.conf'),'w') as f:
+            for j in range(200):
+                f.write('HTTP_PORT=80\nhost'+str(j)+'=localhost\n')
+
+    user=pwd.getpwuid(os.getuid()).pw_name
+    group=grp.getgrgid(os.getgid()).gr_name
+    data_dirs=sorted(set(os.path.dirname(os.path.relpath(os.path.join(root,name),build_dir))
+                         for root,dirs,names in os.walk(content_dir+'/data') for name in names))
+    manifest={
+        'name': PKG_NAME,
+        'rel_num': '1.0.0',
+        'files': ['content: content'],
+        'targets': ['content: content'],
+        'vars': ['BENCH_VAR'+str(j)+': value'+str(j) for j in range(10)],
+        'templates': ['content/tmpl'] if int(args['templates']) else [],
+        'replaces': {'content/repl': ['HTTP_PORT=80: HTTP_PORT=9090']} if int(args['replaces']) else {},
+        'permissions': [d+': '+user+':'+group+' 0644' for d in data_dirs[:int(args['permissions'])]],
+    }
+    with open(build_dir+'/'+PKG_NAME+'.yml','w') as f:
+        f.write(yamlDump(manifest))
+
+    return manifest
+
+def makeParent(file_path):
+    if not os.path.isdir(os.path.dirname(file_path)): os.makedirs(os.path.dirname(file_path))
+
+    return file_path
+
+'''The manifests are in the restricted form opkg reads, lists of "key: value" strings, so this is written out directly'''
+def yamlDump(manifest):
+    lines=list()
+    for key in ['name','rel_num']:
+        lines.append(key+': '+manifest[key])
+    for key in ['files','targets','vars','templates','permissions']:
+        if not manifest[key]: continue
+        lines.append(key+':')
+        lines+=['   - '+item for item in manifest[key]]
+    if manifest['replaces']:
+        lines.append('replaces:')
+        for path,tokens in manifest['replaces'].items():
+            lines.append('   '+path+':')
+            lines+=['      - '+token for token in tokens]
+
+    return '\n'.join(lines)+'\n'
+
+'''Counts of the bytes read and written by this process, from /proc/self/io where available'''
+def getIOCounters():
+    counters=dict()
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key,val=line.split(':')
+                counters[key.strip()]=int(val)
+    except (IOError,ValueError):
+        pass
+
+    return counters
+
+'''Runs func in a forked child, and returns its wall time, resource usage and I/O'''
+def measure(func,verbose=False):
+    rfd,wfd=os.pipe()
+    pid=os.fork()
+    if pid == 0:
+        os.close(rfd)
+        if not verbose:
+            devnull=os.open(os.devnull,os.O_WRONLY)
+            os.dup2(devnull,1)
+        status=True
+        start=time.time()
+        try:
+            status=func() is not False
+        except Exception as e:
+            sys.stderr.write('Error: '+str(e)+'\n')
+            status=False
+        wall=time.time()-start
+        sys.stdout.flush()
+        with os.fdopen(wfd,'w') as f:
+            f.write(json.dumps({'wall': wall,'ok': status,'io': getIOCounters()}))
+        os._exit(0)
+
+    os.close(wfd)
+    with os.fdopen(rfd) as f:
+        output=f.read()
+    pid,exit_status,rusage=os.wait4(pid,0)
+    if not output: return {'ok': False}
+    child=json.loads(output)
+
+    return {
+        'ok': child['ok'] and exit_status == 0,
+        'wall': child['wall'],
+        'user': rusage.ru_utime,
+        'sys': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'read_bytes': child['io'].get('read_bytes'),
+        'write_bytes': child['io'].get('write_bytes'),
+        'rchar': child['io'].get('rchar'),
+        'wchar': child['io'].get('wchar'),
+    }
+
+class Bench():
+    def __init__(self,opkg_mod,work_dir,args):
+        self.opkg=opkg_mod
+        self.work_dir=work_dir
+        self.args=args
+        self.build_dir=work_dir+'/build'
+        self.opkg_dir=work_dir+'/opkg'
+        self.scratch_dir=work_dir+'/scratch'
+        self.jobs=int(args.get('jobs') or 1)
+        self.configs={
+            'basic': {
+                'opkg_dir': self.opkg_dir,
+                'deploy_history_file': 'deploy_history.log',
+                'install_root': work_dir+'/apps',
+                'digest_algo': 'md5',
+                'object_store': 'hardlink',
+            }
+        }
+        self.runs=0
+        self.manifest=None
+        self.tarball_name=PKG_NAME+'.tgz'
+        if args.get('codec'):
+            codec=self.opkg.Codec.parse(args['codec'])
+            if not codec: sys.exit(1)
+            self.tarball_name=PKG_NAME+codec.ext
+
+    def setup(self):
+        os.makedirs(self.build_dir)
+        os.makedirs(self.opkg_dir+'/pkgs/'+PKG_NAME)
+        self.manifest=genPackage(self.build_dir,self.args)
+        if not measure(self.create)['ok']:
+            print "Error: Couldn't create the package to benchmark."
+            sys.exit(1)
+
+    def getConfigs(self,install_root=None):
+        configs=dict((section,dict(items)) for section,items in self.configs.items())
+        if install_root: configs['basic']['install_root']=install_root
+
+        return configs
+
+    def create(self):
+        os.chdir(self.build_dir)
+        pkg=self.opkg.Pkg(PKG_NAME)
+        pkg.setEnvConfig(self.getConfigs())
+        pkg.setJobs(self.jobs)
+        if hasattr(pkg,'setForce'): pkg.setForce() #every run builds the tarball, not only checks its inputs are unchanged
+        if self.args.get('codec'): pkg.setCodec(self.args['codec'])
+
+        return pkg.create()
+
+    def prepareDeploy(self):
+        self.runs+=1
+        shutil.copy(self.build_dir+'/'+self.tarball_name,self.opkg_dir+'/pkgs/'+PKG_NAME+'/'+self.tarball_name)
+        self.install_root=self.work_dir+'/apps'+str(self.runs)
+
+    def deploy(self):
+        deploy_inst=self.opkg.Deploy(self.getConfigs(self.install_root),{'force': ''},dict())
+
+        return deploy_inst.installPackage(PKG_NAME,self.tarball_name)
+
+    '''Deploys into the same install root each time, the installations are a second apart for their deploy_ts to differ'''
+    def prepareRedeploy(self):
+        shutil.copy(self.build_dir+'/'+self.tarball_name,self.opkg_dir+'/pkgs/'+PKG_NAME+'/'+self.tarball_name)
+        self.install_root=self.work_dir+'/apps'
+        if not os.path.isdir(self.install_root): measure(self.deploy)
+        now=int(time.time())
+        while int(time.time()) == now: time.sleep(0.05)
+
+    '''Deploys again for the rollback to have a previous installation to go back to'''
+    def prepareRollback(self):
+        self.prepareRedeploy()
+        measure(self.deploy)
+
+    def rollback(self):
+        deploy_inst=self.opkg.Deploy(self.getConfigs(self.install_root),dict(),dict())
+
+        return self.opkg.Pkg(PKG_NAME).rollback(deploy_inst)
+
+    def prepareScratch(self,src):
+        if os.path.exists(self.scratch_dir): shutil.rmtree(self.scratch_dir)
+        shutil.copytree(self.build_dir+'/content/'+src,self.scratch_dir)
+
+    def tmplResolve(self):
+        vars_dict=dict(('BENCH_VAR'+str(j),'value'+str(j)) for j in range(10))
+        vars_dict['OPKG_NAME']=PKG_NAME
+
+        return self.opkg.Tmpl(self.scratch_dir).resolveVars(vars_dict)
+
+    def tmplReplace(self):
+        return self.opkg.Tmpl(self.scratch_dir).replaceTokens(['HTTP_PORT=80:HTTP_PORT=9090'])
+
+    def md5(self):
+        for root,dirs,names in os.walk(self.build_dir+'/content/data'):
+            for name in names:
+                self.opkg.getFileMD5(root+'/'+name)
+
+        return True
+
+    '''Returns bench name: (prepare,func), prepare is run before each run and not measured'''
+    def getBenchmarks(self):
+        return {
+            'create': (lambda: None,self.create),
+            'deploy': (self.prepareDeploy,self.deploy),
+            'redeploy': (self.prepareRedeploy,self.deploy),
+            'rollback': (self.prepareRollback,self.rollback),
+            'tmpl_resolve': (lambda: self.prepareScratch('tmpl'),self.tmplResolve),
+            'tmpl_replace': (lambda: self.prepareScratch('repl'),self.tmplReplace),
+            'md5': (lambda: None,self.md5),
+        }
+
+def median(values):
+    values=sorted(v for v in values if v is not None)
+    if not values: return None
+    mid=len(values)/2
+    if len(values)%2: return values[mid]
+
+    return (values[mid-1]+values[mid])/2.0
+
+def summarize(results):
+    summary=dict()
+    for bench in set(r['bench'] for r in results):
+        runs=[r for r in results if r['bench'] == bench and r['ok']]
+        summary[bench]={'runs': len(runs)}
+        for key in ['wall','user','sys','max_rss_kb','read_bytes','write_bytes','rchar','wchar']:
+            summary[bench][key]=median([r.get(key) for r in runs])
+
+    return summary
+
+'''Prints the change of the median wall time from baseline, returns the benchmarks slower by more than threshold percent'''
+def compare(summary,baseline,threshold):
+    regressions=list()
+    print '%-14s %12s %12s %9s' % ('benchmark','baseline(s)','current(s)','change')
+    for bench in sorted(summary):
+        if bench not in baseline['summary'] or not baseline['summary'][bench]['wall'] or not summary[bench]['wall']:
+            continue
+        old=baseline['summary'][bench]['wall']
+        new=summary[bench]['wall']
+        change=(new-old)*100.0/old
+        flag=''
+        if change > threshold:
+            flag=' REGRESSION'
+            regressions.append(bench)
+        print '%-14s %12.3f %12.3f %8.1f%%%s' % (bench,old,new,change,flag)
+
+    return regressions
+
+def getLabel(opkg_path):
+    try:
+        return subprocess.check_output(['git','describe','--always','--dirty'],cwd=os.path.dirname(opkg_path),
+                                       stderr=open(os.devnull,'w')).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def main():
+    args=parseArgs(sys.argv[1:])
+    opkg_path=os.path.abspath(args.get('opkg') or os.path.dirname(os.path.abspath(__file__))+'/../openpkg.py')
+    opkg_mod=imp.load_source('openpkg',opkg_path)
+    benches=args['bench'].split(',') if args.get('bench') else BENCHMARKS
+    for bench in benches:
+        if bench not in BENCHMARKS:
+            print "Error: Unknown benchmark "+bench+", available ones are "+', '.join(BENCHMARKS)
+            sys.exit(1)
+
+    work_dir=tempfile.mkdtemp(prefix='opkg-bench.')
+    results=list()
+    try:
+        bench_inst=Bench(opkg_mod,work_dir,args)
+        bench_inst.setup()
+        benchmarks=bench_inst.getBenchmarks()
+        for bench in benches:
+            prepare,func=benchmarks[bench]
+            for run in range(int(args['runs'])):
+                prepare()
+                result=measure(func,'verbose' in args)
+                result.update({'bench': bench,'run': run})
+                results.append(result)
+                if not result['ok']: print "Error: "+bench+" run "+str(run)+" failed."
+    finally:
+        os.chdir('/')
+        shutil.rmtree(work_dir,ignore_errors=True)
+
+    summary=summarize(results)
+    report={
+        'label': args.get('label') or getLabel(opkg_path),
+        'timestamp': int(time.time()),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+        'params': dict((k,args[k]) for k in DEFAULTS.keys()+['jobs','codec'] if k in args),
+        'results': results,
+        'summary': summary,
+    }
+    print '%-14s %5s %9s %9s %9s %11s %12s %12s' % ('benchmark','runs','wall(s)','user(s)','sys(s)','rss(KB)','read','written')
+    for bench in benches:
+        s=summary[bench]
+        if not s['runs']: continue
+        print '%-14s %5d %9.3f %9.3f %9.3f %11d %12s %12s' % (bench,s['runs'],s['wall'],s['user'],s['sys'],s['max_rss_kb'],s['rchar'],s['wchar'])
+    if args.get('output'):
+        with open(args['output'],'w') as f:
+            f.write(json.dumps(report,indent=1,sort_keys=True)+'\n')
+
+    failed=[r for r in results if not r['ok']]
+    regressions=list()
+    if args.get('compare'):
+        with open(args['compare']) as f:
+            baseline=json.load(f)
+        if baseline.get('params') != report['params']:
+            print "Warning: Parameters differ from those of the baseline, the results may not be comparable."
+        regressions=compare(summary,baseline,float(args['threshold']))
+
+    if failed or regressions: sys.exit(1)
+
+if __name__ == '__main__':
+    main()
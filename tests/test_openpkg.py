@@ -0,0 +1,1120 @@
+'''Behavioral tests of opkg, run with: python2 -m unittest discover -s tests
+Each test builds packages in a sandbox directory, and runs opkg on those as a command, or calls its classes directly.
+'''
+import os
+import sys
+import stat
+import imp
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import unittest
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+import hashlib
+import StringIO
+import zlib
+import bz2
+import tarfile
+
+OPKG_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src','openpkg.py')
+openpkg=imp.load_source('openpkg',OPKG_PATH)
+BENCH_PATH=os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','src','scripts','opkg-bench.py')
+
+'''A sandbox with opkg_dir, install root, build dir and a local repo in a temporary directory'''
+class SandboxTest(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        self.opkg_dir=self.root+'/opkg'
+        self.install_root=self.root+'/apps'
+        self.build_root=self.root+'/build'
+        for path in (self.opkg_dir+'/conf',self.install_root,self.build_root): os.makedirs(path)
+        self.writeFile(self.opkg_dir+'/conf/opkg.env','\n'.join(['[basic]','opkg_dir='+self.opkg_dir,'deploy_history_file=deploy_history.log',
+            'install_root='+self.install_root,'digest_algo=md5','','[repo]','repo_type=local','repo_path='+self.root+'/repo',''])
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def writeFile(self,path,content):
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        with open(path,'w') as f: f.write(content)
+
+    def readFile(self,path):
+        with open(path) as f: return f.read()
+
+    '''Writes the manifest of pkg_name in the build dir, with the sections given as YAML'''
+    def writeManifest(self,pkg_name,rel_num,sections=''):
+        self.writeFile(self.build_root+'/'+pkg_name+'.yml','name: '+pkg_name+'\nrel_num: '+str(rel_num)+'\n'+sections)
+
+    '''Runs opkg with args in the build dir, returns its exit code and output'''
+    def opkg(self,*args):
+        proc=subprocess.Popen([sys.executable,OPKG_PATH]+list(args)+['--opkg_dir='+self.opkg_dir],cwd=self.build_root,
+                              stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output=proc.communicate()[0]
+
+        return proc.returncode,output
+
+    def assertOpkg(self,*args):
+        rc,output=self.opkg(*args)
+        self.assertEqual(rc,0,output)
+
+        return output
+
+    '''Creates and deploys pkg_name from the build dir, returns the exit code and output of deploy'''
+    def deploy(self,pkg_name,*args):
+        self.assertOpkg('create','--pkg='+pkg_name,'--force')
+
+        return self.opkg('deploy','--pkg='+self.build_root+'/'+pkg_name+'.tgz',*args)
+
+    def current(self,pkg_name):
+        path=self.install_root+'/current/'+pkg_name
+        return os.readlink(path) if os.path.islink(path) else None
+
+    def installed(self):
+        return self.assertOpkg('ls').split()
+
+class TestInstall(SandboxTest):
+    SECTIONS='''files:
+   - conf/app.conf: app.conf
+targets:
+   - conf: conf
+post_deploy:
+   - test ! -f {{ FAIL_FILE }}
+'''
+
+    def setUp(self):
+        SandboxTest.setUp(self)
+        self.fail_file=self.root+'/fail'
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+
+    def deployRelease(self,rel_num):
+        self.writeManifest('svca',rel_num,TestInstall.SECTIONS)
+        return self.deploy('svca','--extra-vars=FAIL_FILE='+self.fail_file)
+
+    def testPostDeployFailureRestoresCurrent(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        first=self.current('svca')
+        self.writeFile(self.fail_file,'')
+        rc,output=self.deployRelease(2)
+        self.assertNotEqual(rc,0,output)
+        self.assertEqual(self.current('svca'),first)
+        self.assertEqual(self.installed(),['svca-dev'])
+
+    def testFirstInstallFailureRemovesCurrent(self):
+        self.writeFile(self.fail_file,'')
+        rc,output=self.deployRelease(1)
+        self.assertNotEqual(rc,0,output)
+        self.assertIsNone(self.current('svca'))
+        self.assertEqual(self.installed(),[])
+
+    def testRollbackRestoresPreviousInstallation(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        first=self.current('svca')
+        self.writeFile(self.build_root+'/app.conf','port=81\n')
+        self.assertEqual(self.deployRelease(2)[0],0)
+        self.assertOpkg('rollback','--pkg=svca')
+        self.assertEqual(self.current('svca'),first)
+        self.assertEqual(self.readFile(self.install_root+'/current/svca/conf/app.conf'),'port=80\n')
+        rc,output=self.opkg('rollback','--pkg=svca')
+        self.assertNotEqual(rc,0,output)
+        self.assertIn('No previous installation',output)
+
+    def testDeploysInTheSameSecondAreKeptApart(self):
+        for port in ('80','81','82'):
+            self.writeFile(self.build_root+'/app.conf','port='+port+'\n')
+            self.assertEqual(self.deployRelease(1)[0],0)
+        installs=sorted(os.listdir(self.install_root+'/installs'),key=openpkg.Deploy.getDeployTsKey)
+        self.assertEqual(len(installs),3)
+        self.assertEqual(self.readFile(self.install_root+'/installs/'+installs[0]+'/svca/conf/app.conf'),'port=80\n')
+        self.assertOpkg('rollback','--pkg=svca')
+        self.assertEqual(self.readFile(self.install_root+'/current/svca/conf/app.conf'),'port=81\n')
+        self.assertOpkg('clean','--count=0')
+        self.assertEqual(sorted(os.listdir(self.install_root+'/installs'),key=openpkg.Deploy.getDeployTsKey),installs[:2])
+
+    def testRollbackToRemovedInstallationFails(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        shutil.rmtree(self.current('svca'))
+        self.assertEqual(self.deployRelease(2)[0],0)
+        second=self.current('svca')
+        rc,output=self.opkg('rollback','--pkg=svca')
+        self.assertNotEqual(rc,0,output)
+        self.assertEqual(self.current('svca'),second)
+
+    def testActivatePrepared(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        first=self.current('svca')
+        self.writeFile(self.build_root+'/app.conf','port=81\n')
+        rc,output=self.deploy('svca','--prepare','--extra-vars=FAIL_FILE='+self.fail_file)
+        self.assertEqual(rc,0,output)
+        self.assertEqual(self.current('svca'),first)
+        self.assertOpkg('deploy','--activate','--pkg=svca')
+        self.assertNotEqual(self.current('svca'),first)
+        self.assertEqual(self.readFile(self.install_root+'/current/svca/conf/app.conf'),'port=81\n')
+
+    def testActivateChangedPreparedFails(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        first=self.current('svca')
+        self.writeFile(self.build_root+'/app.conf','port=81\n')
+        rc,output=self.deploy('svca','--prepare','--extra-vars=FAIL_FILE='+self.fail_file)
+        self.assertEqual(rc,0,output)
+        prepared=[path for path in os.listdir(self.install_root+'/installs') if self.install_root+'/installs/'+path+'/svca' != first]
+        self.writeFile(self.install_root+'/installs/'+prepared[0]+'/svca/conf/app.conf','port=8080\n')
+        rc,output=self.opkg('deploy','--activate','--pkg=svca')
+        self.assertNotEqual(rc,0,output)
+        self.assertIn('has been changed',output)
+        self.assertEqual(self.current('svca'),first)
+
+    def testActivateFailureRestoresCurrent(self):
+        self.assertEqual(self.deployRelease(1)[0],0)
+        first=self.current('svca')
+        self.writeFile(self.build_root+'/app.conf','port=81\n')
+        rc,output=self.deploy('svca','--prepare','--extra-vars=FAIL_FILE='+self.fail_file)
+        self.assertEqual(rc,0,output)
+        self.writeFile(self.fail_file,'')
+        rc,output=self.opkg('deploy','--activate','--pkg=svca')
+        self.assertNotEqual(rc,0,output)
+        self.assertEqual(self.current('svca'),first)
+
+class TestCreate(SandboxTest):
+    def testPackagesAreCreatedInParallel(self):
+        for pkg_name in ('svca','svcb'):
+            self.writeFile(self.build_root+'/'+pkg_name+'.conf',pkg_name+'\n')
+            self.writeManifest(pkg_name,1,'files:\n   - conf/app.conf: '+pkg_name+'.conf\n')
+        self.writeManifest('svcc',1,'files:\n   - conf/app.conf: missing.conf\n')
+        rc,output=self.opkg('create','--pkg=svca,svcb,svcc','--jobs=3')
+        self.assertNotEqual(rc,0,output)
+        self.assertIn('2 of 3 packages created',output)
+        for pkg_name in ('svca','svcb'):
+            self.assertIn('files: 1,',self.assertOpkg('info','--pkg='+self.build_root+'/'+pkg_name+'.tgz'))
+        self.assertFalse(os.path.exists(self.build_root+'/svcc.tgz'))
+
+    def testPackageBuiltAgainHasSameDigest(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n'*100000)
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\n')
+        digests=list()
+        for jobs,mtime in (('1',1000000000),('4',2000000000)):
+            for path in (self.build_root+'/app.conf',self.build_root+'/svca.yml'): os.utime(path,(mtime,mtime))
+            self.assertOpkg('create','--pkg=svca','--codec=xz','--jobs='+jobs,'--force')
+            with open(self.build_root+'/svca.txz','rb') as f: digests.append(hashlib.md5(f.read()).hexdigest())
+        self.assertEqual(digests[0],digests[1])
+
+    def testInfoIsReadFromSidecar(self):
+        '''Without opening the tarball, which fails if it's tried'''
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\n')
+        self.assertOpkg('create','--pkg=svca')
+        self.assertIn('source: sidecar',self.assertOpkg('info','--pkg='+self.build_root+'/svca.tgz'))
+        open_tarball=openpkg.Codec.openTarball
+        def openTarball(tarball_path):
+            raise AssertionError('opened '+tarball_path)
+        openpkg.Codec.openTarball=staticmethod(openTarball)
+        try:
+            info=openpkg.Pkg.readInfo('svca',self.build_root+'/svca.tgz')
+        finally:
+            openpkg.Codec.openTarball=staticmethod(open_tarball)
+        self.assertEqual(info['source'],'sidecar')
+        self.assertEqual(info['rel_num'],'1')
+        self.assertEqual(sorted(info['files']),['conf/app.conf'])
+
+    def testSidecarOfAnotherTarballIsIgnored(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\n')
+        self.assertOpkg('create','--pkg=svca')
+        sidecar=self.readFile(self.build_root+'/svca.tgz.info')
+        self.writeFile(self.build_root+'/app.conf','port=8080\n'*100)
+        self.writeManifest('svca',2,'files:\n   - conf/app.conf: app.conf\n')
+        self.assertOpkg('create','--pkg=svca')
+        self.writeFile(self.build_root+'/svca.tgz.info',sidecar)
+        output=self.assertOpkg('info','--pkg='+self.build_root+'/svca.tgz')
+        self.assertIn('source: archive',output)
+        self.assertIn('rel_num: 2\n',output)
+
+class TestStartup(SandboxTest):
+    LAZY_MODULES=['yaml','ConfigParser','hashlib','tarfile','subprocess','sqlite3','httplib','urlparse','socket','cProfile','pstats']
+
+    '''Runs opkg with args in a process of its own, returns the output and the lazy modules it loaded'''
+    def opkgModules(self,*args):
+        script='''import sys,imp,json
+openpkg=imp.load_source('openpkg',sys.argv[1])
+try:
+    openpkg.opkg(['opkg']+sys.argv[3:]).main()
+except SystemExit:
+    pass
+sys.stdout.write('\\nmodules: '+json.dumps(sorted(m for m in json.loads(sys.argv[2]) if m in sys.modules))+'\\n')
+'''
+        output=subprocess.check_output([sys.executable,'-c',script,OPKG_PATH,json.dumps(TestStartup.LAZY_MODULES)]+list(args)+['--opkg_dir='+self.opkg_dir],
+                                       cwd=self.build_root,stderr=subprocess.STDOUT)
+        output,modules=output.rsplit('\nmodules: ',1)
+
+        return output,json.loads(modules)
+
+    def testCommandsLoadOnlyTheModulesThoseUse(self):
+        output,modules=self.opkgModules('--version')
+        self.assertIn('opkg v',output)
+        self.assertEqual(modules,[])
+        output,modules=self.opkgModules('ls')
+        self.assertEqual(modules,['ConfigParser','sqlite3'])
+
+    def testDeployDoesNotParseYaml(self):
+        self.writeFile(self.build_root+'/app.conf','port={{ PORT }}\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\ntargets:\n   - conf: conf\ntemplates:\n   - conf/app.conf\n')
+        self.assertOpkg('create','--pkg=svca')
+        with tarfile.open(self.build_root+'/svca.tgz') as tar:
+            self.assertEqual(tar.getnames()[:2],['.deploy/svca.json','.deploy/svca.yml'])
+        output,modules=self.opkgModules('deploy','--pkg='+self.build_root+'/svca.tgz','--extra-vars=PORT=8080')
+        self.assertIn('has been installed',output)
+        self.assertNotIn('yaml',modules)
+        self.assertEqual(self.readFile(self.current('svca')+'/conf/app.conf'),'port=8080\n')
+
+    def testTarballWithoutCompiledManifestIsDeployed(self):
+        '''As created before the compiled manifest was added'''
+        self.writeFile(self.build_root+'/app.conf','port={{ PORT }}\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\ntargets:\n   - conf: conf\ntemplates:\n   - conf/app.conf\n')
+        with tarfile.open(self.build_root+'/svca.tgz','w:gz') as tar:
+            tar.add(self.build_root+'/svca.yml','.deploy/svca.yml')
+            tar.add(self.build_root+'/app.conf','conf/app.conf')
+        rc,output=self.opkg('deploy','--pkg='+self.build_root+'/svca.tgz','--extra-vars=PORT=8080')
+        self.assertEqual(rc,0,output)
+        self.assertEqual(self.readFile(self.current('svca')+'/conf/app.conf'),'port=8080\n')
+
+class TestRuntimeActions(SandboxTest):
+    def setUp(self):
+        SandboxTest.setUp(self)
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+
+    def start(self,ready):
+        self.writeManifest('svca',1,'''files:
+   - conf/app.conf: app.conf
+targets:
+   - conf: conf
+start:
+   - echo started
+ready:
+'''+ready+'ready_timeout: 3\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        start=time.time()
+        rc,output=self.opkg('start','--pkg=svca')
+
+        return rc,output,time.time()-start
+
+    def testProbesAreBoundByReadyTimeout(self):
+        '''The probe fails slowly at first, then hangs, and is killed once ready_timeout is over'''
+        stamp=self.root+'/probed'
+        rc,output,elapsed=self.start('   - if [ -f '+stamp+' ]; then sleep 30; else touch '+stamp+'; sleep 2; false; fi\n')
+        self.assertNotEqual(rc,0,output)
+        self.assertIn('not ready',output)
+        self.assertLess(elapsed,4.5)
+
+    def testProbeTimedOutIsRetried(self):
+        stamp=self.root+'/probed'
+        rc,output,elapsed=self.start('   - cmd: if [ -f '+stamp+' ]; then true; else touch '+stamp+'; sleep 30; fi\n     timeout: 1\n')
+        self.assertEqual(rc,0,output)
+
+class TestProfile(SandboxTest):
+    PHASES=['extract','manifest','pre_deploy','targets','templates','replaces','symlinks','permissions','activate','post_deploy','register']
+
+    def setUp(self):
+        SandboxTest.setUp(self)
+        self.writeFile(self.build_root+'/app.conf','port={{ PORT }}\n')
+        self.writeManifest('svca',1,'''files:
+   - conf/app.conf: app.conf
+targets:
+   - conf: conf
+templates:
+   - conf/app.conf
+post_deploy:
+   - echo one
+   - echo two
+''')
+
+    def profiles(self):
+        return [json.loads(line) for line in self.readFile(self.opkg_dir+'/history/deploy_profile.log').splitlines()]
+
+    def testProfileIsLoggedAsJson(self):
+        rc,output=self.deploy('svca','--extra-vars=PORT=8080')
+        self.assertEqual(rc,0,output)
+        self.assertNotIn('Profile of',output)
+        profiles=self.profiles()
+        self.assertEqual(len(profiles),1)
+        profile=profiles[0]
+        self.assertEqual((profile['pkg_name'],profile['status'],profile['install_root']),('svca',True,self.install_root))
+        self.assertNotIn('functions',profile)
+        self.assertEqual([phase['phase'] for phase in profile['phases']],TestProfile.PHASES)
+        phases=dict((phase['phase'],phase) for phase in profile['phases'])
+        self.assertEqual([(step['step'],step['subprocesses']) for step in phases['post_deploy']['steps']],[('echo one',1),('echo two',1)])
+        self.assertEqual(phases['templates']['bytes_written'],len('port=8080\n'))
+        self.assertEqual(profile['subprocesses'],sum(phase['subprocesses'] for phase in profile['phases']))
+        self.writeFile(self.build_root+'/app.conf','port={{ PORT }}\nhost=localhost\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        self.assertEqual(len(self.profiles()),2)
+
+    def testProfileOptionPrintsPhasesAndFunctions(self):
+        rc,output=self.deploy('svca','--profile')
+        self.assertEqual(rc,0,output)
+        self.assertIn('Profile of svca installation',output)
+        self.assertRegexpMatches(output,'\n  post_deploy +[0-9.]+ +0 +0 +0 +2\n')
+        self.assertTrue(self.profiles()[0]['functions'])
+
+class TestInstallRoots(SandboxTest):
+    def testChangesAreCountedPerInstallRoot(self):
+        root_a,root_b=self.root+'/a',self.root+'/b'
+        for name in ('one','two','three'): self.writeFile(self.build_root+'/files/'+name,name+'\n')
+        self.writeManifest('svca',1,'files:\n   - files: files\ntargets:\n   - files: files\n')
+        rc,output=self.deploy('svca','--install_root='+root_a)
+        self.assertEqual(rc,0,output)
+        self.writeFile(self.build_root+'/files/one','changed\n')
+        rc,output=self.deploy('svca','--install_root='+root_a+','+root_b)
+        self.assertEqual(rc,0,output)
+        self.assertIn('1 of 3 files changed',output)
+        self.assertIn('3 of 3 files changed',output)
+
+    def testRollbackRestoresFilesManifest(self):
+        self.writeFile(self.build_root+'/files/one','one\n')
+        self.writeManifest('svca',1,'files:\n   - files: files\ntargets:\n   - files: files\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        self.writeFile(self.build_root+'/files/one','changed\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        self.assertOpkg('rollback','--pkg=svca')
+        self.writeFile(self.build_root+'/files/one','one\n')
+        rc,output=self.deploy('svca','--force')
+        self.assertEqual(rc,0,output)
+        self.assertIn('0 of 1 files changed',output)
+
+    def testDeploysToEachRootWithItsVars(self):
+        self.writeFile(self.build_root+'/app.conf','port={{ PORT }}\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\ntargets:\n   - conf: conf\ntemplates:\n   - conf/app.conf\n')
+        roots=dict((self.root+'/tenant'+str(i),{'PORT':8000+i}) for i in range(1,4))
+        self.writeFile(self.root+'/roots.yml',''.join(root+':\n  PORT: '+str(root_vars['PORT'])+'\n' for root,root_vars in roots.items()))
+        rc,output=self.deploy('svca','--install_roots='+self.root+'/roots.yml','--jobs=3')
+        self.assertEqual(rc,0,output)
+        for root,root_vars in roots.items():
+            self.assertEqual(self.readFile(root+'/current/svca/conf/app.conf'),'port='+str(root_vars['PORT'])+'\n')
+            self.assertEqual(self.opkg('ls','--install_root='+root)[1].split(),['svca-dev'])
+
+class TestInstallDB(SandboxTest):
+    '''Installs of svca recorded in the Latest.meta and Previous.meta files of earlier versions of opkg'''
+    def writeMetaFiles(self):
+        for meta_file,rel_num,deploy_ts in (('Previous.meta','1','1700000000'),('Latest.meta','2','1700000100')):
+            self.writeFile(self.opkg_dir+'/meta/svca/'+meta_file,','.join(['svca',rel_num,'1690000000','0'*32,deploy_ts])+'\n')
+            self.writeFile(self.install_root+'/installs/'+deploy_ts+'/svca/conf/app.conf','rel='+rel_num+'\n')
+        os.makedirs(self.install_root+'/current')
+        os.symlink(self.install_root+'/installs/1700000100/svca',self.install_root+'/current/svca')
+
+    def testMetaFilesAreMigrated(self):
+        self.writeMetaFiles()
+        rc,output=self.opkg('ls')
+        self.assertEqual(rc,0,output)
+        self.assertIn('Migrated the install meta of 1 packages',output)
+        self.assertEqual(self.installed(),['svca-2'])
+        self.assertOpkg('rollback','--pkg=svca')
+        self.assertEqual(self.installed(),['svca-1'])
+        self.assertEqual(self.current('svca'),self.install_root+'/installs/1700000000/svca')
+
+    def testMetaFilesAreMigratedOnce(self):
+        self.writeMetaFiles()
+        self.assertOpkg('ls')
+        self.writeFile(self.opkg_dir+'/meta/svca/Latest.meta','svca,3,1690000000,'+'0'*32+',1700000200\n')
+        rc,output=self.opkg('ls')
+        self.assertNotIn('Migrated',output)
+        self.assertEqual(output.split(),['svca-2'])
+
+class TestConfig(SandboxTest):
+    def testUnsupportedDigestAlgoIsRejected(self):
+        for algo in ('blake2b','SHA256'):
+            rc,output=self.opkg('ls','--digest_algo='+algo)
+            self.assertNotEqual(rc,0,output)
+            self.assertIn('Unsupported digest algorithm '+algo,output)
+        self.assertOpkg('ls','--digest_algo=sha256')
+
+class TestRepo(SandboxTest):
+    def testLatestIsPutLast(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        for rel_num in (1,2):
+            self.writeManifest('svca',rel_num,'files:\n   - conf/app.conf: app.conf\n')
+            self.assertOpkg('create','--pkg=svca','--force')
+            os.rename(self.build_root+'/svca.tgz',self.build_root+'/svca-'+str(rel_num)+'.tgz')
+            self.assertOpkg('put','--file='+self.build_root+'/svca-'+str(rel_num)+'.tgz')
+        '''Both put in the same second'''
+        index_path=self.root+'/repo/index.json'
+        index=json.loads(self.readFile(index_path))
+        for release in index['svca'].values(): release['ts']=1700000000
+        self.writeFile(index_path,json.dumps(index))
+        self.assertIn('rel_num: 2\n',self.assertOpkg('info','--pkg=svca-latest'))
+
+    def testReleasesAreListedInTheOrderPut(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        for rel_num in (2,1):
+            self.writeManifest('svca',rel_num,'files:\n   - conf/app.conf: app.conf\n')
+            self.assertOpkg('create','--pkg=svca','--force')
+            os.rename(self.build_root+'/svca.tgz',self.build_root+'/svca-'+str(rel_num)+'.tgz')
+            self.assertOpkg('put','--file='+self.build_root+'/svca-'+str(rel_num)+'.tgz')
+        index_path=self.root+'/repo/index.json'
+        index=json.loads(self.readFile(index_path))
+        for release in index['svca'].values(): release['ts']=1700000000
+        self.writeFile(index_path,json.dumps(index))
+        self.assertEqual(self.assertOpkg('rls').split(),['svca-2','svca-1'])
+
+class TestObjectStore(SandboxTest):
+    SECTIONS='''files:
+   - conf/app.conf: app.conf
+targets:
+   - conf: conf
+'''
+
+    '''Returns the content of the objects in the store'''
+    def objects(self):
+        contents=list()
+        for root,dirs,files in os.walk(self.install_root+'/objects/md5'):
+            contents+=[self.readFile(root+'/'+name) for name in files]
+
+        return sorted(contents)
+
+    def setStoreMode(self,mode):
+        self.writeFile(self.opkg_dir+'/conf/opkg.env',self.readFile(self.opkg_dir+'/conf/opkg.env').replace('digest_algo=md5\n','digest_algo=md5\nobject_store='+mode+'\n'))
+
+    def testCleanRemovesObjectsNoMoreUsed(self):
+        self.setStoreMode('hardlink')
+        self.writeManifest('svca',1,TestObjectStore.SECTIONS)
+        for port in ('80','81','82'):
+            self.writeFile(self.build_root+'/app.conf','port='+port+'\n')
+            self.assertEqual(self.deploy('svca')[0],0)
+        self.assertOpkg('clean','--count=0')
+        self.assertEqual(self.objects(),['port=81\n','port=82\n'])
+
+    def testCleanKeepsObjectsInUseInReflinkMode(self):
+        self.writeManifest('svca',1,TestObjectStore.SECTIONS)
+        for port in ('80','81','82'):
+            self.writeFile(self.build_root+'/app.conf','port='+port+'\n')
+            self.assertEqual(self.deploy('svca')[0],0)
+        self.assertOpkg('clean','--count=0')
+        self.assertEqual(self.objects(),['port=81\n','port=82\n'])
+
+    def testDeployedFilesAreNotSharedByDefault(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,TestObjectStore.SECTIONS)
+        rc,output=self.deploy('svca')
+        self.assertEqual(rc,0,output)
+        self.assertNotIn('Warning',output)
+        with open(self.current('svca')+'/conf/app.conf','a') as f: f.write('port=81\n')
+        self.assertEqual(self.objects(),['port=80\n'])
+
+    def testHardlinkModeWarns(self):
+        self.setStoreMode('hardlink')
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,TestObjectStore.SECTIONS)
+        rc,output=self.deploy('svca')
+        self.assertEqual(rc,0,output)
+        self.assertIn('Warning: object_store is hardlink',output)
+        self.assertEqual(os.stat(self.current('svca')+'/conf/app.conf').st_nlink,2)
+
+    def testPreDeployDoesNotChangeObjects(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,TestObjectStore.SECTIONS)
+        self.assertEqual(self.deploy('svca')[0],0)
+        first=self.current('svca')
+        self.writeManifest('svca',2,TestObjectStore.SECTIONS+'pre_deploy:\n   - echo "# stamped by pre_deploy" >> ../conf/app.conf\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        self.assertEqual(self.readFile(first+'/conf/app.conf'),'port=80\n')
+        self.assertEqual(self.readFile(self.current('svca')+'/conf/app.conf'),'port=80\n# stamped by pre_deploy\n')
+
+class TestPkgCache(SandboxTest):
+    def testRedeployKeepsDigestCached(self):
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        '''An mtime which a float doesn't hold to the microsecond, so it would be changed if it was written back'''
+        cache_path=self.opkg_dir+'/pkgs/svca/svca.tgz'
+        os.utime(cache_path,(1700000000,1700000000.916736))
+        digest_cache=openpkg.DigestCache(self.opkg_dir+'/meta/'+openpkg.DIGEST_CACHE_FILE)
+        digest_cache.update(cache_path,'md5',openpkg.getFileDigest(cache_path,'md5'))
+        mtime=os.stat(cache_path).st_mtime
+        rc,output=self.opkg('deploy','--pkg='+self.build_root+'/svca.tgz')
+        self.assertEqual(rc,0,output)
+        self.assertIn('already installed',output)
+        self.assertNotIn('extracted',output)
+        self.assertEqual(os.stat(cache_path).st_mtime,mtime)
+
+    def testTarballsAreComparedWithDigestAlgo(self):
+        self.writeFile(self.opkg_dir+'/conf/opkg.env',self.readFile(self.opkg_dir+'/conf/opkg.env').replace('digest_algo=md5','digest_algo=sha256'))
+        self.writeFile(self.build_root+'/app.conf','port=80\n')
+        self.writeManifest('svca',1,'files:\n   - conf/app.conf: app.conf\n')
+        self.assertEqual(self.deploy('svca')[0],0)
+        rc,output=self.opkg('deploy','--pkg='+self.build_root+'/svca.tgz')
+        self.assertIn('already installed',output)
+        entries=[line.split('\t') for line in self.readFile(self.opkg_dir+'/meta/'+openpkg.DIGEST_CACHE_FILE).splitlines()]
+        self.assertEqual(sorted(set((entry[0],entry[4]) for entry in entries)),
+                         [(self.build_root+'/svca.tgz','sha256'),(self.opkg_dir+'/pkgs/svca/svca.tgz','sha256')])
+
+class TestCodecs(SandboxTest):
+    def isAvailable(self,name):
+        codec=openpkg.Codec(name)
+        return name not in openpkg.Codec.MODULES or codec.getModule() or openpkg.findCommand(name)
+
+    def testTarballsOfEachCodecAreDeployed(self):
+        self.writeFile(self.build_root+'/files/app.conf','port=80\n')
+        self.writeFile(self.build_root+'/files/data',os.urandom(256*1024))
+        self.writeManifest('svca',1,'files:\n   - files: files\ntargets:\n   - files: files\n')
+        for name in sorted(openpkg.Codec.CODECS):
+            if not self.isAvailable(name): continue
+            self.assertOpkg('create','--pkg=svca','--codec='+name,'--force')
+            tarball_path=self.build_root+'/svca'+openpkg.Codec.CODECS[name]['ext']
+            self.assertIn('codec: '+name+'\n',self.assertOpkg('info','--pkg='+tarball_path))
+            rc,output=self.opkg('deploy','--pkg='+tarball_path,'--force')
+            self.assertEqual(rc,0,name+': '+output)
+            for path in ('app.conf','data'):
+                self.assertEqual(self.readFile(self.install_root+'/current/svca/files/'+path),self.readFile(self.build_root+'/files/'+path))
+
+class TestExtract(SandboxTest):
+    def setUp(self):
+        SandboxTest.setUp(self)
+        self.outside=self.root+'/outside'
+        self.writeFile(self.outside+'/target','kept\n')
+        self.stage_dir=self.root+'/stage'
+        os.makedirs(self.stage_dir)
+
+    '''Writes a tarball of the members, (name, type, linkname or content), in that order'''
+    def writeTarball(self,members):
+        path=self.root+'/evil.tgz'
+        tar=tarfile.open(path,'w:gz')
+        for name,member_type,data in members:
+            info=tarfile.TarInfo(name)
+            info.type=member_type
+            if member_type == tarfile.REGTYPE:
+                info.size=len(data)
+                tar.addfile(info,StringIO.StringIO(data))
+            else:
+                info.linkname=data
+                tar.addfile(info)
+        tar.close()
+
+        return path
+
+    def extract(self,members,object_store=None):
+        pkg=openpkg.Pkg('evil')
+        pkg.setEnvConfig({'basic':{'opkg_dir':self.opkg_dir,'digest_algo':'md5'}})
+        return pkg.extract(self.writeTarball(members),self.stage_dir,object_store)
+
+    def testMemberUnderSymlinkIsRejected(self):
+        members=[('a',tarfile.SYMTYPE,self.outside),('a/pwned',tarfile.REGTYPE,'pwned\n')]
+        self.assertIsNone(self.extract(members))
+        self.assertIsNone(self.extract(members,openpkg.ObjectStore(self.root+'/objects','md5')))
+        members=[('d',tarfile.DIRTYPE,''),('d/a',tarfile.SYMTYPE,self.outside),('d/a/b/c',tarfile.DIRTYPE,'')]
+        self.assertIsNone(self.extract(members))
+        self.assertEqual(os.listdir(self.outside),['target'])
+
+    def testSymlinkIsReplacedNotWrittenThrough(self):
+        members=[('b',tarfile.SYMTYPE,self.outside+'/target'),('b',tarfile.REGTYPE,'inside\n')]
+        self.assertIsNotNone(self.extract(members))
+        self.assertFalse(os.path.islink(self.stage_dir+'/b'))
+        self.assertEqual(self.readFile(self.stage_dir+'/b'),'inside\n')
+        self.assertEqual(self.readFile(self.outside+'/target'),'kept\n')
+
+    def testHardLinkOutsideIsRejected(self):
+        self.assertIsNone(self.extract([('h',tarfile.LNKTYPE,'../outside/target')]))
+        self.assertIsNone(self.extract([('a',tarfile.SYMTYPE,self.outside),('h',tarfile.LNKTYPE,'a/target')]))
+        self.assertFalse(os.path.exists(self.stage_dir+'/h'))
+
+class TestParallelGzipFile(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        '''Several blocks, some compressible and some not, and a last partial one'''
+        self.files={'a/text':'line of text\n'*300000,'a/random':os.urandom(3*openpkg.ParallelGzipFile.BLOCK_SIZE+123),'b/empty':''}
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def writeTarball(self,path,jobs):
+        with open(path,'wb') as f:
+            gz=openpkg.ParallelGzipFile(f,jobs)
+            tar=tarfile.open(fileobj=gz,mode='w|')
+            for name in sorted(self.files):
+                info=tarfile.TarInfo(name)
+                info.size=len(self.files[name])
+                tar.addfile(info,StringIO.StringIO(self.files[name]))
+            tar.close()
+            gz.close()
+
+    def testBlocksMakeOneGzipStream(self):
+        path=self.root+'/pkg.tgz'
+        self.writeTarball(path,4)
+        self.assertEqual(subprocess.call(['gzip','-t',path]),0)
+        self.assertEqual(subprocess.check_output(['tar','tzf',path]).split(),sorted(self.files))
+        tar=tarfile.open(path,'r:gz')
+        for name in self.files: self.assertEqual(tar.extractfile(name).read(),self.files[name])
+        tar.close()
+
+    def testOutputDoesNotDependOnJobs(self):
+        self.writeTarball(self.root+'/one.tgz',1)
+        self.writeTarball(self.root+'/four.tgz',4)
+        with open(self.root+'/one.tgz','rb') as one:
+            with open(self.root+'/four.tgz','rb') as four: self.assertEqual(one.read(),four.read())
+
+class TestDecompressorReader(unittest.TestCase):
+    def setUp(self):
+        self.data=''.join(str(i)+os.urandom(i%64) for i in range(100000))
+
+    def readAll(self,reader,sizes):
+        parts=list()
+        for size in sizes:
+            parts.append(reader.read(size))
+        parts.append(reader.read())
+        return ''.join(parts)
+
+    def testReadsInPieces(self):
+        sizes=[1,7,513,10000,1,1024*1024,3]
+        reader=openpkg.DecompressorReader(StringIO.StringIO(zlib.compress(self.data)),zlib.decompressobj())
+        self.assertEqual(self.readAll(reader,sizes),self.data)
+        reader=openpkg.DecompressorReader(StringIO.StringIO(bz2.compress(self.data)),bz2.BZ2Decompressor())
+        self.assertEqual(self.readAll(reader,sizes),self.data)
+        self.assertEqual(reader.read(),'')
+
+    def testDecompressesAsRead(self):
+        data='\0'*(64*1024*1024)
+        reader=openpkg.DecompressorReader(StringIO.StringIO(zlib.compress(data)),zlib.decompressobj())
+        self.assertEqual(reader.read(10),'\0'*10)
+        self.assertLessEqual(reader.size,openpkg.DecompressorReader.OUTPUT_SIZE)
+        self.assertEqual(len(self.readAll(reader,[4096]*1000)),len(data)-10)
+
+class TestHook(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        self.log_path=self.root+'/logs/hook.log'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def readLog(self):
+        with open(self.log_path) as f: return f.read()
+
+    def testStepsOfParallelGroupDontWaitForEachOther(self):
+        quick=openpkg.HookStep('sleep 0.2; echo quick')
+        slow=openpkg.HookStep('sleep 3; echo slow')
+        start=time.time()
+        self.assertTrue(openpkg.Hook('post_deploy',[[quick,slow]],self.root,self.log_path).run())
+        self.assertLess(time.time()-start,4)
+        self.assertLess(quick.elapsed,1)
+        self.assertGreaterEqual(slow.elapsed,3)
+        log=self.readLog()
+        self.assertIn('[post_deploy:1 out] quick\n',log)
+        self.assertIn('[post_deploy:2 out] slow\n',log)
+        self.assertLess(log.index('quick\n'),log.index('slow\n'))
+
+    def testStepDoesntInheritDescriptors(self):
+        '''Like the ends of the pipes of the steps started beside it, which it would hold open'''
+        read_fd,write_fd=os.pipe()
+        try:
+            step=openpkg.HookStep('[ ! -e /proc/$$/fd/'+str(write_fd)+' ]')
+            self.assertTrue(openpkg.Hook('post_deploy',[[step]],self.root).run())
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def testOutputIsLogged(self):
+        step=openpkg.HookStep('echo one; echo two >&2; exit 3')
+        self.assertFalse(openpkg.Hook('pre_deploy',[[step]],self.root,self.log_path).run())
+        self.assertEqual(step.rc,3)
+        log=self.readLog()
+        self.assertIn('$ echo one; echo two >&2; exit 3\n',log)
+        self.assertIn('[out] one\n',log)
+        self.assertIn('[err] two\n',log)
+        self.assertIn("# 'echo one; echo two >&2; exit 3' exited with 3 in ",log)
+
+    def testStepsAfterFailedGroupDontRun(self):
+        groups=[[openpkg.HookStep('true')],[openpkg.HookStep('true'),openpkg.HookStep('false')],[openpkg.HookStep('true')]]
+        self.assertFalse(openpkg.Hook('post_deploy',groups,self.root).run())
+        self.assertEqual([step.rc for group in groups for step in group],[0,0,1,None])
+
+    def testTimedOutStepIsKilledWithItsChildren(self):
+        marker=self.root+'/marker'
+        step=openpkg.HookStep('(sleep 2; touch '+marker+') & sleep 30',timeout=0.5)
+        start=time.time()
+        self.assertFalse(openpkg.Hook('post_deploy',[[step]],self.root,self.log_path).run())
+        self.assertLess(time.time()-start,3)
+        self.assertTrue(step.timed_out)
+        self.assertIn("# '"+step.cmd+"' timed out after 0.5s in ",self.readLog())
+        time.sleep(2.5)
+        self.assertFalse(os.path.exists(marker))
+
+class TestTmpl(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def writeFile(self,name,content):
+        path=self.root+'/'+name
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        with open(path,'wb') as f: f.write(content)
+        return path
+
+    def readFile(self,name):
+        with open(self.root+'/'+name,'rb') as f: return f.read()
+
+    def testCompiledTemplateIsCachedByContent(self):
+        content='port={{ PORT }}\nhost={{HOST}}\n'
+        parts=openpkg.Tmpl.compile(content)
+        self.assertEqual(parts,['port=','{{ PORT }}','PORT','\nhost=','{{HOST}}','HOST','\n'])
+        self.assertIs(openpkg.Tmpl.compile(''.join(list(content))),parts)
+        self.assertIsNot(openpkg.Tmpl.compile(content+'#\n'),parts)
+
+    def testChangedTemplateIsCompiledAgain(self):
+        path=self.writeFile('conf/app.conf','port={{ PORT }}\n')
+        self.assertTrue(openpkg.Tmpl(path).resolveVars({'PORT':80}))
+        self.assertEqual(self.readFile('conf/app.conf'),'port=80\n')
+        self.writeFile('conf/app.conf','listen={{ PORT }} {{ UNSET }}\n')
+        self.assertTrue(openpkg.Tmpl(path).resolveVars({'PORT':81}))
+        self.assertEqual(self.readFile('conf/app.conf'),'listen=81 {{ UNSET }}\n')
+
+    def testFilesOfDirectoryAreResolved(self):
+        for n in range(10): self.writeFile('conf/'+str(n)+'.conf','id={{ ID }}\n' if n % 2 else 'id=none\n')
+        self.writeFile('conf/data.bin','\0{{ ID }}')
+        static_ino=os.stat(self.root+'/conf/0.conf').st_ino
+        self.assertTrue(openpkg.Tmpl(self.root+'/conf').resolveVars({'ID':'svca'}))
+        for n in range(10): self.assertEqual(self.readFile('conf/'+str(n)+'.conf'),'id=svca\n' if n % 2 else 'id=none\n')
+        self.assertEqual(self.readFile('conf/data.bin'),'\0{{ ID }}')
+        self.assertEqual(os.stat(self.root+'/conf/0.conf').st_ino,static_ino)
+
+class TestPermissions(unittest.TestCase):
+    '''(mode,is_dir,mode before,mode after), as GNU chmod 9.1 sets those with umask 0'''
+    MODES=[('0755',False,04755,0755),('0755',True,02755,02755),('0755',True,06700,06755),('2755',True,04700,06755),
+           ('00755',True,06755,0755),('755',False,06755,0755),('u=rwx',True,06000,06700),('u=rwxs',True,06000,06700),
+           ('=rx',True,02777,02555),('g=u',False,0740,0770),('g=u,o=g',False,0751,0777),('u+x-w',False,0644,0544),
+           ('a+X',False,0644,0644),('a+X',False,0654,0755),('a+X',True,0600,0711),('go-w',True,03777,03755),
+           ('o+t',True,0755,01755),('u-s',True,06755,02755),('=,u+rw',False,0777,0600),('+s',False,0755,06755)]
+
+    def testModesAreAppliedAsChmodDoes(self):
+        for chmod_opt,is_dir,before,after in TestPermissions.MODES:
+            mode_ops=openpkg.Permissions.parseMode(chmod_opt)
+            self.assertEqual(oct(openpkg.Permissions.applyMode(before,mode_ops,is_dir)),oct(after),(chmod_opt,is_dir,oct(before)))
+
+    def testInvalidModesAreRejected(self):
+        for chmod_opt in ('','8','17777','u+q','g=uo','x+r'):
+            self.assertIsNone(openpkg.Permissions.parseMode(chmod_opt),chmod_opt)
+
+    def testRulesAreAppliedInOrder(self):
+        root=tempfile.mkdtemp(prefix='opkg-test-')
+        try:
+            os.makedirs(root+'/apps/bin')
+            for name in ('apps/app.conf','apps/bin/run'):
+                with open(root+'/'+name,'w'): pass
+                os.chmod(root+'/'+name,0644)
+            perms=openpkg.Permissions()
+            self.assertTrue(perms.addRule(root+'/apps',':','0600'))
+            self.assertTrue(perms.addRule(root+'/apps','','u+X,g=u'))
+            self.assertTrue(perms.addRule(root+'/apps/bin/run','','u+x'))
+            self.assertTrue(perms.apply())
+            self.assertEqual([oct(stat.S_IMODE(os.stat(root+'/'+name).st_mode)) for name in ('apps','apps/bin','apps/app.conf','apps/bin/run')],
+                             ['0770','0770','0660','0760'])
+        finally:
+            shutil.rmtree(root)
+
+class TestTaskScheduler(unittest.TestCase):
+    def setUp(self):
+        self.done=list()
+        self.lock=threading.Lock()
+
+    def task(self,name,rc=True):
+        with self.lock:
+            self.done.append(name)
+        return rc
+
+    def testDependenciesRunFirst(self):
+        scheduler=openpkg.TaskScheduler(4)
+        scheduler.addTask('app',self.task,('app',),['lib','db'])
+        scheduler.addTask('lib',self.task,('lib',),['base'])
+        scheduler.addTask('db',self.task,('db',),['base','missing'])
+        scheduler.addTask('base',self.task,('base',))
+        self.assertEqual(scheduler.run(),{'app':True,'lib':True,'db':True,'base':True})
+        self.assertEqual(self.done[0],'base')
+        self.assertEqual(self.done[-1],'app')
+
+    def testDependentsOfFailedTaskAreSkipped(self):
+        scheduler=openpkg.TaskScheduler(2)
+        scheduler.addTask('base',self.task,('base',False))
+        scheduler.addTask('lib',self.task,('lib',),['base'])
+        scheduler.addTask('app',self.task,('app',),['lib'])
+        scheduler.addTask('other',self.task,('other',))
+        self.assertEqual(scheduler.run(),{'base':False,'lib':None,'app':None,'other':True})
+        self.assertEqual(sorted(self.done),['base','other'])
+
+    def testCircularDependencyFails(self):
+        scheduler=openpkg.TaskScheduler(2)
+        scheduler.addTask('a',self.task,('a',),['b'])
+        scheduler.addTask('b',self.task,('b',),['a'])
+        self.assertEqual(scheduler.run(),{'a':False,'b':False})
+        self.assertEqual(self.done,[])
+
+    def testIndependentTasksRunConcurrently(self):
+        '''Each task waits for the other to start, which only finishes if those run at the same time'''
+        started=dict((name,threading.Event()) for name in ('a','b'))
+        def meet(name,other):
+            started[name].set()
+            return started[other].wait(10)
+        scheduler=openpkg.TaskScheduler(2)
+        scheduler.addTask('a',meet,('a','b'))
+        scheduler.addTask('b',meet,('b','a'))
+        self.assertEqual(scheduler.run(),{'a':True,'b':True})
+
+class TestDigestCache(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        self.cache_file=self.root+'/meta/digests.cache'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def writeFile(self,name,content):
+        with open(self.root+'/'+name,'w') as f: f.write(content)
+        return self.root+'/'+name
+
+    def testEntryIsValidTillFileChanges(self):
+        path=self.writeFile('one','one\n')
+        cache=openpkg.DigestCache(self.cache_file)
+        self.assertIsNone(cache.lookup(path,'md5'))
+        cache.update(path,'md5',openpkg.getFileDigest(path,'md5'))
+        self.assertEqual(openpkg.DigestCache(self.cache_file).lookup(path,'md5'),openpkg.getFileDigest(path,'md5'))
+        self.assertIsNone(cache.lookup(path,'sha256'))
+        self.writeFile('one','changed\n')
+        self.assertIsNone(cache.lookup(path,'md5'))
+
+    def testUpdatesOfInstancesAreMerged(self):
+        '''Like those of the worker processes of a parallel create'''
+        paths=[self.writeFile(name,name+'\n') for name in ('one','two')]
+        caches=[openpkg.DigestCache(self.cache_file) for path in paths]
+        for cache in caches: cache.lookup(paths[0],'md5')
+        for cache,path in zip(caches,paths): cache.update(path,'md5',openpkg.getFileDigest(path,'md5'))
+        cache=openpkg.DigestCache(self.cache_file)
+        for path in paths: self.assertEqual(cache.lookup(path,'md5'),openpkg.getFileDigest(path,'md5'))
+
+    def testEntriesOfRemovedFilesAreDropped(self):
+        paths=[self.writeFile(name,name+'\n') for name in ('one','two')]
+        cache=openpkg.DigestCache(self.cache_file)
+        cache.update(paths[0],'md5',openpkg.getFileDigest(paths[0],'md5'))
+        os.remove(paths[0])
+        cache.update(paths[1],'md5',openpkg.getFileDigest(paths[1],'md5'))
+        with open(self.cache_file) as f: self.assertNotIn(paths[0]+'\t',f.read())
+
+class TestCopyFile(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        self.src=self.root+'/src'
+        self.data=os.urandom(3*1024*1024+17)
+        with open(self.src,'wb') as f:
+            f.write(self.data)
+        os.chmod(self.src,0750)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assertCopied(self,dst):
+        with open(dst,'rb') as f:
+            self.assertEqual(f.read(),self.data)
+        self.assertEqual(os.stat(dst).st_mode,os.stat(self.src).st_mode)
+
+    def testCopiesInKernel(self):
+        with open(self.src,'rb') as fsrc:
+            with open(self.root+'/dst','wb') as fdst:
+                self.assertEqual(openpkg.kernelCopy(fsrc.fileno(),fdst.fileno(),len(self.data)),len(self.data))
+        openpkg.copyFile(self.src,self.root+'/dst')
+        self.assertCopied(self.root+'/dst')
+
+    def testCopiesWithoutKernelCopy(self):
+        funcs=dict(openpkg.getKernelCopyFuncs())
+        try:
+            openpkg.KERNEL_COPY_FUNCS.clear()
+            openpkg.KERNEL_COPY_FUNCS['looked_up']=True
+            openpkg.copyFile(self.src,self.root+'/dst')
+        finally:
+            openpkg.KERNEL_COPY_FUNCS.update(funcs)
+        self.assertCopied(self.root+'/dst')
+
+class StaleConnection():
+    def request(self,method,path,headers=None):
+        raise socket.error(32,'Broken pipe')
+
+    def close(self):
+        pass
+
+class TestHttpConnectionPool(unittest.TestCase):
+    def setUp(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version='HTTP/1.1'
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length','2')
+                self.end_headers()
+                self.wfile.write('ok')
+            def log_message(self,*args):
+                pass
+        self.server=BaseHTTPServer.HTTPServer(('127.0.0.1',0),Handler)
+        self.netloc='127.0.0.1:'+str(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testStaleConnectionsAreRetriedOnNewOne(self):
+        pool=openpkg.HttpConnectionPool()
+        pool.idle[self.netloc]=[StaleConnection(),StaleConnection()]
+        self.assertEqual(pool.fetch('http://'+self.netloc+'/'),(200,'ok'))
+        self.assertEqual(len(pool.idle[self.netloc]),1)
+        self.assertEqual(pool.fetch('http://'+self.netloc+'/'),(200,'ok'))
+
+    def testNewConnectionErrorIsRaised(self):
+        '''A port nothing listens on, once the socket bound to it is closed'''
+        sock=socket.socket()
+        sock.bind(('127.0.0.1',0))
+        netloc='127.0.0.1:'+str(sock.getsockname()[1])
+        sock.close()
+        pool=openpkg.HttpConnectionPool()
+        pool.idle[netloc]=[StaleConnection()]
+        self.assertRaises(socket.error,pool.request,'GET','http://'+netloc+'/')
+
+'''Stand-in of an HTTP repo serving the files in files, byte ranges of those if serve_ranges is set.
+Requests for ranges starting at fail_from or later get a 500. The path and range of the requests are kept in requests.
+'''
+class RepoServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    daemon_threads=True
+
+    def __init__(self):
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version='HTTP/1.1'
+            def do_GET(self):
+                server=self.server
+                content=server.files.get(self.path)
+                byte_range=self.headers.get('Range')
+                with server.lock:
+                    server.requests.append((self.path,byte_range))
+                if content is None: return self.reply(404,'')
+                if not byte_range or not server.serve_ranges: return self.reply(200,content)
+                start,end=[int(n) for n in byte_range.split('=')[1].split('-')]
+                if server.fail_from is not None and start >= server.fail_from: return self.reply(500,'')
+                self.reply(206,content[start:end+1],'bytes '+str(start)+'-'+str(end)+'/'+str(len(content)))
+            def reply(self,status,content,content_range=None):
+                self.send_response(status)
+                self.send_header('Content-Length',str(len(content)))
+                if content_range: self.send_header('Content-Range',content_range)
+                self.end_headers()
+                self.wfile.write(content)
+            def log_message(self,*args):
+                pass
+        BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',0),Handler)
+        self.files=dict()
+        self.serve_ranges=True
+        self.fail_from=None
+        self.requests=list()
+        self.lock=threading.Lock()
+
+    '''The connections closed by the client without reading the reply are expected'''
+    def handle_error(self,request,client_address):
+        if not isinstance(sys.exc_info()[1],socket.error): BaseHTTPServer.HTTPServer.handle_error(self,request,client_address)
+
+class TestHttpRepo(unittest.TestCase):
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+        self.server=RepoServer()
+        threading.Thread(target=self.server.serve_forever).start()
+        self.content=os.urandom(1024*1024+17)
+        release={'tarball':'svca/svca-1.tgz','digest':hashlib.md5(self.content).hexdigest(),'digest_algo':'md5',
+                 'size':len(self.content),'ts':1700000000,'seq':1}
+        self.server.files['/index.json']=json.dumps({'svca':{'1':release}})
+        self.server.files['/svca/svca-1.tgz']=self.content
+        self.download_dir=self.root+'/pkgs/svca'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def get(self):
+        repo=openpkg.HttpRepo('http://127.0.0.1:'+str(self.server.server_port),self.root+'/opkg','md5',4)
+        repo.RANGE_SIZE=100*1024
+        self.server.requests=list()
+
+        return repo.get('svca','1',self.download_dir)
+
+    def tarballRequests(self):
+        return [byte_range for path,byte_range in self.server.requests if path == '/svca/svca-1.tgz']
+
+    def assertDownloaded(self,tarball_path):
+        self.assertEqual(tarball_path,self.download_dir+'/svca-1.tgz')
+        with open(tarball_path,'rb') as f: self.assertEqual(f.read(),self.content)
+        self.assertEqual(os.listdir(self.download_dir),['svca-1.tgz'])
+
+    def testDownloadsInRanges(self):
+        self.assertDownloaded(self.get())
+        self.assertEqual(len(self.tarballRequests()),11)
+        self.assertNotIn(None,self.tarballRequests())
+
+    def testInterruptedDownloadIsResumed(self):
+        self.server.fail_from=500*1024
+        self.assertIsNone(self.get())
+        self.assertTrue(os.path.isfile(self.download_dir+'/svca-1.tgz.part.ranges'))
+        self.server.fail_from=None
+        self.assertDownloaded(self.get())
+        self.assertEqual(sorted(int(r.split('=')[1].split('-')[0]) for r in self.tarballRequests()),range(500*1024,len(self.content),100*1024))
+
+    def testServerWithoutRangesIsDownloadedWhole(self):
+        self.server.serve_ranges=False
+        self.assertDownloaded(self.get())
+        '''The ranges requested before the first reply are dropped, and the file is downloaded once in a single request'''
+        self.assertLessEqual(len(self.tarballRequests()),5)
+        self.assertEqual(self.tarballRequests()[-1],None)
+
+    def testDigestMismatchIsNotKept(self):
+        self.server.files['/svca/svca-1.tgz']=os.urandom(len(self.content))
+        self.assertIsNone(self.get())
+        self.assertEqual(os.listdir(self.download_dir),[])
+
+class TestBench(unittest.TestCase):
+    PARAMS=['--files=8','--size=64K','--depth=1','--templates=2','--replaces=2','--permissions=1','--runs=1']
+
+    def setUp(self):
+        self.root=tempfile.mkdtemp(prefix='opkg-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def bench(self,*args):
+        proc=subprocess.Popen([sys.executable,BENCH_PATH]+TestBench.PARAMS+list(args),cwd=self.root,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        output=proc.communicate()[0]
+
+        return proc.returncode,output
+
+    def testEveryBenchmarkIsRun(self):
+        rc,output=self.bench('--output='+self.root+'/results.json')
+        self.assertEqual(rc,0,output)
+        with open(self.root+'/results.json') as f: report=json.load(f)
+        self.assertEqual(sorted(report['summary']),sorted(['create','deploy','redeploy','rollback','tmpl_resolve','tmpl_replace','md5']))
+        for bench,summary in report['summary'].items():
+            self.assertEqual(summary['runs'],1,bench)
+            self.assertIsNotNone(summary['wall'],bench)
+        self.assertTrue(all(result['ok'] for result in report['results']))
+        self.assertEqual(report['params']['files'],'8')
+
+    def testRegressionsFailTheComparison(self):
+        rc,output=self.bench('--bench=create,md5','--output='+self.root+'/baseline.json')
+        self.assertEqual(rc,0,output)
+        with open(self.root+'/baseline.json') as f: baseline=json.load(f)
+        baseline['summary']['md5']['wall']=1000.0
+        baseline['summary']['create']['wall']=1e-9
+        with open(self.root+'/baseline.json','w') as f: json.dump(baseline,f)
+        rc,output=self.bench('--bench=create,md5','--compare='+self.root+'/baseline.json')
+        self.assertEqual(rc,1,output)
+        self.assertRegexpMatches(output,'create .* REGRESSION')
+        self.assertNotRegexpMatches(output,'md5 .* REGRESSION')
+
+    def testUnknownBenchmarkIsRejected(self):
+        rc,output=self.bench('--bench=create,unpack')
+        self.assertEqual(rc,1,output)
+        self.assertIn('Unknown benchmark unpack',output)
+
+if __name__ == '__main__':
+    unittest.main()